@@ -19,6 +19,19 @@ BACULA_DIR_PORT = 9101
 BACULA_FD_PORT = 9102
 BACULA_SD_PORT = 9103
 
+# Signals sent in place of a packet length (see bsock.h in the Bacula source)
+BNET_EOD = -1           # End of data
+BNET_EOD_POLL = -2      # End of data, and please reply
+BNET_STATUS = -3        # Send full status
+BNET_TERMINATE = -4     # Conversation terminated
+BNET_POLL = -5          # Poll request
+BNET_HEARTBEAT = -6     # Heartbeat
+BNET_HB_RESPONSE = -7   # Heartbeat response
+BNET_CMD_OK = -15       # Director command succeeded
+BNET_CMD_BEGIN = -16    # Director is starting on a command
+BNET_MSGS_PENDING = -17  # Director has messages waiting
+BNET_MAIN_PROMPT = -18  # Director is ready for the next command
+
 # Configuration files
 BACULA_DIR_CONF = '/etc/bacula/bacula-dir.conf'
 BACULA_FD_CONF = '/etc/bacula/bacula-fd.conf'
@@ -32,6 +45,10 @@ MYSQL_DB = 'OVERRIDE ME'
 MYSQL_HOST = 'OVERRIDE ME'
 MYSQL_USER = 'OVERRIDE ME'
 MYSQL_PASS = 'OVERRIDE ME'
+# Maximum number of simultaneous connections to the configuration database.
+MYSQL_POOL_SIZE = 8
+# How many seconds to wait for one of them to become free before giving up.
+MYSQL_POOL_TIMEOUT = 60
 
 _INTERNED = ['Append', 'Available', 'Catalog', 'comment', 'Cleaning', 'Error',
              'Full', 'Purged', 'Recycle', 'Used', 'actiononpurge', 'addprefix',
@@ -167,6 +184,7 @@ from .job import Job, JobDef
 from .scripts import Script
 from .device import Device
 from .counter import Counter
+from .renderer import DirectorRenderer, DaemonRenderer, FragmentCache, CONFIG_TABLES
 
 # Load the code a second time so imported functions/variables can be
 # overridden.
@@ -179,7 +197,7 @@ for filename in CUSTOM_LIST:
 # bconsole/daemon bits
 from .fd import FDaemon
 from .sd import SDaemon
-from .bacula_director import BDirector
+from .bacula_director import BDirector, DirectorSession
 
 
 _DISPATCHER = {
@@ -6,10 +6,228 @@ logger = logging.getLogger(__name__)
 
 import MySQLdb as db
 import MySQLdb.cursors
+import atexit
 import os
+import re
 import sys
+import threading
+import Queue
+from collections import OrderedDict
+from contextlib import contextmanager
 import bacula_tools
 
+# MySQL error codes that mean the connection is dead and should be replaced:
+# "MySQL server has gone away" and "Lost connection to MySQL server".
+RECONNECT_ERRORS = (2006, 2013)
+
+# MySQL error code for "Table doesn't exist": config_versions is missing
+# from databases created before it was added to the schema.
+NO_SUCH_TABLE = 1146
+
+# Statements that change a table (see Bacula_Config.bump_versions).
+WRITE_RE = re.compile(
+    r'^\s*(?:INSERT\s+(?:IGNORE\s+)?INTO|REPLACE\s+INTO|UPDATE|DELETE\s+FROM)\s+`?(\w+)`?', re.I)
+
+
+class ConnectionPool(object):
+
+    '''A bounded pool of connections to a single database.  Connections are
+    created lazily, up to size of them, and checked with a ping when they
+    are handed out.  If all of them are in use, get() blocks until one is
+    returned, or raises db.OperationalError if none is within timeout
+    seconds (None means wait forever, which will deadlock a thread that
+    already holds every connection, e.g. with stream_sql()).
+
+    You probably don't want to use this directly: Bacula_Config gives each
+    thread its own connection from the appropriate pool.
+
+    '''
+
+    def __init__(self, size=8, timeout=60, **connect_args):
+        object.__init__(self)
+        self.size = size
+        self.timeout = timeout
+        self.connect_args = connect_args
+        self.idle = Queue.LifoQueue()
+        self.created = 0
+        self.lock = threading.Lock()
+        self.versioned = False  # See Bacula_Config.connect()
+        self.pending = set()    # See Bacula_Config.flush_versions()
+        return
+
+    def _create(self):
+        '''Open a new connection.'''
+        connection = db.connect(**self.connect_args)
+        connection.autocommit(True)
+        return connection
+
+    def get(self):
+        '''Check out a connection, making sure it is still alive.'''
+        try:
+            connection = self.idle.get_nowait()
+        except Queue.Empty:
+            with self.lock:
+                grow = self.created < self.size
+                if grow:
+                    self.created += 1
+            if grow:
+                try:
+                    return self._create()
+                except:
+                    with self.lock:
+                        self.created -= 1
+                    raise
+            try:
+                connection = self.idle.get(timeout=self.timeout)
+            except Queue.Empty:
+                raise db.OperationalError(
+                    'ConnectionPool: all %d connections to %s are in use, '
+                    'gave up after %s seconds' % (self.size, self.connect_args.get('db'),
+                                                  self.timeout))
+        try:
+            connection.ping()
+        except db.OperationalError as the_exception:
+            logger.info('ConnectionPool: replacing dead connection (%s)',
+                        the_exception)
+            self.discard(connection)
+            return self.get()
+        return connection
+
+    def put(self, connection):
+        '''Return a connection to the pool.'''
+        self.idle.put(connection)
+        return
+
+    def discard(self, connection):
+        '''Throw away a broken connection, making room for a new one.'''
+        try:
+            connection.close()
+        except Exception:
+            pass
+        with self.lock:
+            self.created -= 1
+        return
+
+
+class IdentityMap(object):
+
+    '''A small LRU cache of database rows, keyed by (table, id) with a
+    secondary (table, name) index.  Each entry is a snapshot of the row plus
+    any extra attributes (e.g. a Job's scripts) that the _load_ hooks filled
+    in, so that a cached object can be restored without touching the
+    database at all.
+
+    You probably want Bacula_Config.resource_cache() rather than using this
+    directly.  It is safe to share between threads.
+
+    '''
+
+    def __init__(self, capacity=5000):
+        '''capacity is the maximum number of rows held before the least
+        recently used ones are discarded.'''
+        object.__init__(self)
+        self.capacity = capacity
+        self.entries = OrderedDict()
+        self.names = {}
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.RLock()
+        return
+
+    def get(self, table, field, value):
+        '''Look up a row by id or name.  Returns a (row, extras) tuple of
+        copies, or None if we don't have it.'''
+        with self.lock:
+            if field == bacula_tools.NAME:
+                value = self.names.get((table, value))
+            key = (table, value)
+            if value == None or not key in self.entries:
+                self.misses += 1
+                return None
+            self.hits += 1
+            row, extras = self.entries.pop(key)
+            self.entries[key] = (row, extras)  # most recently used goes last
+        return dict(row), dict((x, list(extras[x])) for x in extras)
+
+    def put(self, table, row, extras={}):
+        '''Store a snapshot of a row (and its extra attributes).'''
+        if not row.get(bacula_tools.ID):
+            return
+        snapshot = (dict(row), dict((x, list(extras[x])) for x in extras))
+        with self.lock:
+            self.invalidate(table, row[bacula_tools.ID])
+            self.entries[(table, row[bacula_tools.ID])] = snapshot
+            if row.get(bacula_tools.NAME):
+                self.names[(table, row[bacula_tools.NAME])
+                           ] = row[bacula_tools.ID]
+            while len(self.entries) > self.capacity:
+                (old_table, old_id), (old_row, old_extras) = self.entries.popitem(
+                    last=False)
+                self.names.pop(
+                    (old_table, old_row.get(bacula_tools.NAME)), None)
+        return
+
+    def invalidate(self, table, id=None):
+        '''Forget about a single row, or an entire table if no id is given.'''
+        with self.lock:
+            if id == None:
+                [self.invalidate(x[0], x[1])
+                 for x in list(self.entries) if x[0] == table]
+                return
+            entry = self.entries.pop((table, id), None)
+            if entry:
+                self.names.pop((table, entry[0].get(bacula_tools.NAME)), None)
+        return
+
+    def clear(self):
+        '''Forget everything.'''
+        with self.lock:
+            self.entries.clear()
+            self.names.clear()
+        return
+
+
+class SQLCache(dict):
+
+    '''Cache of generated SQL statements, keyed by a tuple describing the shape
+    of the statement: typically (table, operation, columns...).  Building
+    the same INSERT/UPDATE/SELECT text over and over again adds up during a
+    large import.
+
+    MySQLdb does not support server-side prepared statements (arguments are
+    interpolated on the client), so caching the statement text is as close
+    as we can get.
+
+    '''
+
+    def __init__(self):
+        dict.__init__(self)
+        self.hits = 0
+        self.misses = 0
+        return
+
+    def sql(self, key, builder):
+        '''Return the statement for key, calling builder() to generate it if
+        we don't have it yet.'''
+        try:
+            result = self[key]
+            self.hits += 1
+        except KeyError:
+            result = self[key] = builder()
+            self.misses += 1
+        return result
+
+    def hit_rate(self):
+        '''Percentage of lookups that were served from the cache.'''
+        total = self.hits + self.misses
+        if not total:
+            return 0.0
+        return 100.0 * self.hits / total
+
+    def __str__(self):
+        return 'SQL cache: %d statements, %d hits, %d misses (%.1f%%)' % (
+            len(self), self.hits, self.misses, self.hit_rate())
+
 
 class Bacula_Config(object):
 
@@ -19,41 +237,368 @@ class Bacula_Config(object):
 
     '''
 
-    CONNECTIONS = {}            # array of connections to the database
-    CURRENT_CONNECTION = None   # The currently in-use connection
+    POOLS = {}                  # connection pools, one per database
+    POOL_LOCK = threading.Lock()
+    identity_map = None         # Set while inside resource_cache()
+    sql_cache = SQLCache()      # Shared by everything that generates SQL
+
+    def __init__(self):
+        '''Each thread gets its own connection, checked out of the pool the first
+        time that thread needs one, and held until release() is called.'''
+        object.__init__(self)
+        self.pool = None
+        self.local = threading.local()
+        self.cache_lock = threading.Lock()
+        self.cache_users = 0
+        return
 
     def connect(self, database=bacula_tools.MYSQL_DB, user=bacula_tools.MYSQL_USER,
-                passwd=bacula_tools.MYSQL_PASS, host=bacula_tools.MYSQL_HOST):
-        '''Connect to the database.  Tries to look up an existing connection to use if possible'''
-        key = database + user + passwd + host
-        if not self.CONNECTIONS.has_key(key):
-            self.CONNECTIONS[key] = db.connect(
-                db=database, user=user, passwd=passwd, host=host)
-        self.CURRENT_CONNECTION = self.CONNECTIONS[key]
-        self.CURRENT_CONNECTION.autocommit(True)
-        return self.CONNECTIONS[key]
+                passwd=bacula_tools.MYSQL_PASS, host=bacula_tools.MYSQL_HOST,
+                versioned=True):
+        '''Connect to the database.  Connections are shared, via a pool, with
+        every other Bacula_Config connected to the same database.  Returns the
+        calling thread's connection.
+
+        Writes are versioned (see bump_versions()) only on a configuration
+        database: pass versioned=False for anything else, like a catalog.'''
+        key = (database, user, passwd, host)
+        with self.POOL_LOCK:
+            if not key in self.POOLS:
+                self.POOLS[key] = ConnectionPool(
+                    bacula_tools.MYSQL_POOL_SIZE, bacula_tools.MYSQL_POOL_TIMEOUT,
+                    db=database, user=user, passwd=passwd, host=host)
+                self.POOLS[key].versioned = versioned
+        self.pool = self.POOLS[key]
+        return self.get_connection()
+
+    def get_connection(self):
+        '''Returns the calling thread's connection, checking one out of the pool
+        (and connecting to the database if necessary) the first time.'''
+        if not self.pool:
+            self.connect()  # Assume default connection stuff
+        connection = getattr(self.local, 'connection', None)
+        if connection != None and not self.local.pool is self.pool:
+            self.release()      # connect() has switched databases on us
+            connection = None
+        if connection == None:
+            connection = self.local.connection = self.pool.get()
+            self.local.pool = self.pool
+        return connection
+
+    def release(self, discard=False):
+        '''Give the calling thread's connection back to the pool.  Worker threads
+        should call this when they are done with the database.  If discard is
+        True, the connection is assumed to be broken and is thrown away.'''
+        connection = getattr(self.local, 'connection', None)
+        if connection == None:
+            return
+        if self.in_transaction() and not discard:
+            raise db.ProgrammingError('release() called inside a transaction')
+        if not discard and self.local.pool is self.pool:
+            self.flush_versions()
+        self.local.connection = None
+        self.local.savepoints = []
+        if discard:
+            self.local.pool.discard(connection)
+        else:
+            self.local.pool.put(connection)
+        return
 
     def get_cursor(self, **kwargs):
         '''Returns a cursor for querying.  Will automatically connect to the
         database if necessary.'''
-        if not self.CURRENT_CONNECTION:
-            self.connect()  # Assume default connection stuff
-        return self.CURRENT_CONNECTION.cursor(**kwargs)
+        return self.get_connection().cursor(**kwargs)
 
     def do_sql(self, sql, args=None, asdict=False):
         '''A general-purpose SQL query function.  It handles acquiring a cursor
         that returns either a list (default) or dictionary as requested,
-        performs the sql, and returns the entire resultset.
+        performs the sql, and returns the entire resultset.  If the connection
+        has gone away, it is replaced and the query is tried once more.
+
+        You should not use this for extremely large resultsets: see
+        stream_sql() instead.'''
+        logger.debug('do_sql: %s:%s', sql, str(args))
+        try:
+            result = self._execute(sql, args, asdict)
+        except db.OperationalError as the_exception:
+            if not the_exception.args[0] in RECONNECT_ERRORS:
+                raise
+            if self.in_transaction():
+                # The transaction died with the connection: don't pretend
+                # otherwise by quietly carrying on with a new one.
+                self.release(discard=True)
+                raise
+            logger.warning('do_sql: reconnecting after %s', the_exception)
+            self.release(discard=True)
+            result = self._execute(sql, args, asdict)
+        self._note_write(sql)
+        return result
+
+    @property
+    def stamping(self):
+        '''True if writes to our database are versioned.  This is cleared if the
+        config_versions table turns out to be missing.'''
+        return self.pool != None and self.pool.versioned
+
+    def _versioned(self, sql):
+        '''If sql changes a table whose version we keep, return its name.'''
+        match = WRITE_RE.match(sql)
+        if not match or not self.stamping or match.group(1) == 'config_versions':
+            return None
+        return match.group(1)
+
+    def _note_write(self, sql):
+        '''If sql changed a table, make a note to bump its version: when the
+        current transaction commits, or (outside of a transaction) at the next
+        flush_versions().'''
+        table = self._versioned(sql)
+        if not table:
+            return
+        if self.in_transaction():
+            self.local.touched.add(table)
+        else:
+            with self.pool.lock:
+                self.pool.pending.add(table)
+        return
+
+    def flush_versions(self):
+        '''Bump the versions of the tables written to outside of a transaction
+        since the last flush, with a single statement.  This happens when a
+        thread release()s its connection, before config_stamp() and when the
+        program exits, so a run of writes costs one bump rather than one
+        each.  If the program dies before then, the bumps are lost, and
+        generate_configuration --force is needed to pick up the changes.'''
+        pool = self.pool
+        if not pool or not pool.pending or self.in_transaction():
+            return
+        with pool.lock:
+            tables, pool.pending = pool.pending, set()
+        try:
+            self.bump_versions(tables)
+        except:
+            with pool.lock:
+                pool.pending.update(tables)
+            raise
+        return
+
+    def _no_versions(self, the_exception):
+        '''True (after turning stamping off) if the_exception says that the
+        config_versions table doesn't exist.'''
+        if the_exception.args[0] != NO_SUCH_TABLE or not 'config_versions' in str(the_exception):
+            return False
+        if self.pool.versioned:
+            logger.warning('config_versions is missing, so change stamps are disabled: '
+                           'see the README for how to add it')
+        self.pool.versioned = False
+        return True
+
+    def bump_versions(self, tables):
+        '''Add one to the version of each table in the config_versions table.
+        Every write through do_sql() leads to this (see _note_write()), so
+        that anything generated from the database can tell whether it is out
+        of date (see config_stamp()).'''
+        tables = sorted(tables)
+        if not tables or not self.stamping:
+            return
+        try:
+            self._execute(self.sql_cache.sql(
+                ('config_versions', 'bump', len(tables)),
+                lambda: 'INSERT INTO config_versions (tablename, version) VALUES %s'
+                ' ON DUPLICATE KEY UPDATE version = version + 1' % ','.join(['(%s, 1)'] * len(tables))),
+                tables, False)
+        except db.ProgrammingError as the_exception:
+            if not self._no_versions(the_exception):
+                raise
+        return
+
+    def config_stamp(self, tables):
+        '''A number that goes up whenever any of tables is written to.  Versions
+        only ever go up, so their sum will do.  Returns None if stamps are
+        unavailable, in which case everything should be assumed to have
+        changed.'''
+        tables = sorted(tables)
+        if not self.pool:
+            self.connect()  # Assume default connection stuff
+        self.flush_versions()
+        if not self.stamping:
+            return None
+        try:
+            result = self.do_sql(self.sql_cache.sql(
+                ('config_versions', 'stamp', len(tables)),
+                lambda: 'SELECT COALESCE(SUM(version), 0) FROM config_versions'
+                ' WHERE tablename IN (%s)' % bacula_tools.placeholders(len(tables))),
+                tables)
+        except db.ProgrammingError as the_exception:
+            if not self._no_versions(the_exception):
+                raise
+            return None
+        return int(result[0][0])
+
+    def in_transaction(self):
+        '''True if the calling thread is inside transaction().'''
+        return bool(getattr(self.local, 'savepoints', None))
+
+    @contextmanager
+    def transaction(self):
+        '''Run a block of code in a single transaction on the calling thread's
+        connection, committing at the end, or rolling back if an exception
+        escapes.  Nested uses become savepoints, so an inner block that fails
+        can be rolled back without losing the work done by the outer one:
+
+            with bc.transaction():
+                for thing in things:
+                    try:
+                        with bc.transaction():
+                            ... do something with thing ...
+                    except Exception:
+                        ... only thing's changes were undone ...
 
-        You should not use this for extremely large resultsets.'''
+        Rolling back clears the identity map, as it may hold rows that no
+        longer exist.'''
+        connection = self.get_connection()
+        if not self.in_transaction():
+            self.local.savepoints = [None]  # None marks the real transaction
+            self.local.touched = set()      # See _note_write()
+            connection.autocommit(False)
+        else:
+            savepoint = 'bacula_%d' % len(self.local.savepoints)
+            self.local.savepoints.append(savepoint)
+            self._execute('SAVEPOINT %s' % savepoint, None, False)
+        try:
+            yield self
+        except:
+            self._rollback()
+            raise
+        else:
+            self._commit()
+        return
+
+    def _commit(self):
+        '''Finish the innermost transaction()/savepoint successfully.'''
+        savepoint = self.local.savepoints.pop()
+        if savepoint:
+            self._execute('RELEASE SAVEPOINT %s' % savepoint, None, False)
+            return
+        connection = self.local.connection
+        try:
+            self.bump_versions(self.local.touched)
+            connection.commit()
+        finally:
+            connection.autocommit(True)
+        return
+
+    def _rollback(self):
+        '''Undo the innermost transaction()/savepoint.'''
+        if not self.in_transaction():
+            return              # the connection went away
+        savepoint = self.local.savepoints.pop()
+        identity_map = self.identity_map
+        if identity_map != None:
+            identity_map.clear()
+        if savepoint:
+            self._execute('ROLLBACK TO SAVEPOINT %s' % savepoint, None, False)
+            return
+        connection = self.local.connection
+        try:
+            connection.rollback()
+        finally:
+            connection.autocommit(True)
+        return
+
+    def checkpoint(self):
+        '''Commit the work done so far by the outermost transaction(), and keep
+        going in a new one.  This is a no-op outside of a transaction, and is
+        not allowed while any savepoints are active.'''
+        if not self.in_transaction():
+            return
+        if len(self.local.savepoints) > 1:
+            raise db.ProgrammingError('checkpoint() called inside a savepoint')
+        self.bump_versions(self.local.touched)
+        self.local.touched = set()
+        self.local.connection.commit()
+        return
+
+    def stream_sql(self, sql, args=None, asdict=False, batch_size=1000):
+        '''Like do_sql(), but a generator that yields the rows one at a time from
+        a server-side cursor (SSCursor/SSDictCursor), fetching batch_size of
+        them from the server at a time.  Use this for large resultsets: memory
+        use is constant, no matter how many rows there are.
+
+        The query runs on a connection of its own, checked out of the pool
+        for as long as the generator is active, so it is fine to call
+        do_sql() while iterating.  That does mean each thread using this
+        needs a second free connection, so only half of MYSQL_POOL_SIZE
+        threads can stream at once; any more will wait for a connection (and
+        give up after MYSQL_POOL_TIMEOUT seconds).  Don't leave the generator
+        half-finished for long, either, as the server holds the resultset
+        open until it is exhausted or closed.'''
+        if not self.pool:
+            self.connect()  # Assume default connection stuff
+        pool = self.pool
+        connection = pool.get()
+        if asdict:
+            cursor = connection.cursor(cursorclass=db.cursors.SSDictCursor)
+        else:
+            cursor = connection.cursor(cursorclass=db.cursors.SSCursor)
+        logger.debug('stream_sql: %s:%s', sql, str(args))
+        try:
+            cursor.execute(sql, args)
+            while True:
+                rows = cursor.fetchmany(batch_size)
+                if not rows:
+                    break
+                for row in rows:
+                    yield row
+        except db.OperationalError as the_exception:
+            # Whatever else happens, this connection is no longer usable.
+            pool.discard(connection)
+            connection = None
+            raise
+        finally:
+            if connection != None:
+                try:
+                    cursor.close()  # Drains any unread rows
+                    pool.put(connection)
+                except db.Error:
+                    pool.discard(connection)
+        return
+
+    def _execute(self, sql, args, asdict):
+        '''Run a query on the calling thread's connection.'''
         if asdict:
             cursor = self.get_cursor(cursorclass=db.cursors.DictCursor)
         else:
             cursor = self.get_cursor()
-        logger.debug('do_sql: %s:%s', sql, str(args))
         cursor.execute(sql, args)
         return cursor.fetchall()
 
+    @contextmanager
+    def resource_cache(self, capacity=5000):
+        '''Scope an IdentityMap around a block of code, so that repeated
+        DbDict.search() calls for the same row (e.g. the Pool referenced by
+        every Job) only go to the database once.  Nested (or concurrent, from
+        several threads) uses share the same cache, which lasts until the
+        last of them exits.
+
+            with bc.resource_cache():
+                ... generate lots of configuration ...
+
+        '''
+        with self.cache_lock:
+            if self.identity_map == None:
+                self.identity_map = IdentityMap(capacity)
+            self.cache_users += 1
+            identity_map = self.identity_map
+        try:
+            yield identity_map
+        finally:
+            with self.cache_lock:
+                self.cache_users -= 1
+                if not self.cache_users:
+                    logger.debug('resource_cache: %d hits, %d misses',
+                                 identity_map.hits, identity_map.misses)
+                    self.identity_map = None
+
     def suggest(self, table, field, value):
         '''This is an effort to be helpful in the case where you have an idea on
         the name of a resource, but you aren't really sure of the *precise*
@@ -72,7 +617,8 @@ class Bacula_Config(object):
         '''Check the existence of a value in a column.  If it exists, return the
         row as a dictionary, otherwise die with a suggestion of possible
         alternatives to search for.'''
-        sql = "SELECT * FROM `%(table)s` where `%(field)s` = %%s" % locals()
+        sql = self.sql_cache.sql((table, 'value_check', field),
+                                 lambda: "SELECT * FROM `%s` where `%s` = %%s" % (table, field))
         result = self.do_sql(sql, value, asdict)
         if result:
             return result
@@ -86,8 +632,9 @@ class Bacula_Config(object):
         '''Ensure the existence of a value in a column.  Use this to find-or-create
         a resource record.'''
         if not self.value_check(table, field, value, asdict=asdict):
-            self.do_sql(
-                "INSERT INTO %(table)s (%(field)s) VALUES (%%s)" % locals(), value)
+            self.do_sql(self.sql_cache.sql((table, 'value_ensure', field),
+                                           lambda: "INSERT INTO %s (%s) VALUES (%%s)" % (table, field)),
+                        value)
         return self.value_check(table, field, value, asdict=asdict)
 
 
@@ -99,3 +646,14 @@ def Bacula_Factory():
     '''Returns a singleton instance of the Bacula_Config class.  This is a
     simple optimization to reduce the number of database connections used.'''
     return _singleton
+
+
+def _flush_at_exit():
+    '''Don't lose the version bumps for writes made since the last flush.'''
+    try:
+        _singleton.flush_versions()
+    except Exception as the_exception:
+        logger.warning('unable to bump config_versions: %s', the_exception)
+    return
+
+atexit.register(_flush_at_exit)
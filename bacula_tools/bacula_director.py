@@ -1,7 +1,11 @@
 # -*- coding: utf-8 -*-
 '''Client for communicating directly with a director. '''
 from __future__ import print_function, absolute_import
-from . import BSock, ADDRESS, PASSWORD, DIRPORT
+import time
+import logging
+from collections import deque
+from . import (BSock, ADDRESS, PASSWORD, DIRPORT, BNET_EOD, BNET_HEARTBEAT,
+               BNET_TERMINATE)
 
 
 class BDirector(BSock):
@@ -9,7 +13,115 @@ class BDirector(BSock):
     '''Client for communicating directly with a director.
     '''
 
-    def __init__(self, director_object, timeout=5):
+    def __init__(self, director_object, timeout=5, deadline=None):
         BSock.__init__(self, director_object[ADDRESS], director_object[PASSWORD], '*UserAgent*',
-                       int(director_object[DIRPORT]), timeout=timeout)
+                       int(director_object[DIRPORT]), timeout=timeout, deadline=deadline)
+        return
+
+
+class DirectorSession(BDirector):
+
+    '''A long-lived, authenticated conversation with a director.  Commands
+    can be pipelined: up to window of them are sent before we start reading
+    responses, so a long run of commands isn't dominated by round trips.
+    If the session sits idle for more than heartbeat seconds, the director is
+    poked before the next command so that nothing in between gives up on us.
+
+    Use it as a context manager to make sure the director is told when we're
+    done.
+    '''
+
+    def __init__(self, director_object, timeout=30, window=32, heartbeat=60):
+        BDirector.__init__(self, director_object, timeout=timeout)
+        self.window = window
+        self.heartbeat = heartbeat
+        BDirector.auth(self)
+        self.last_used = time.time()
+        return
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+        return False
+
+    def close(self):
+        '''Say goodbye and hang up.'''
+        try:
+            self.signal(BNET_TERMINATE)
+        except Exception as the_exception:
+            logging.debug('unable to say goodbye: %s', the_exception)
+        BDirector.close(self)
+        return
+
+    def keepalive(self):
+        '''Poke the director if we've been quiet for too long.  It answers any
+        signal with one of its own, which is read and discarded here.'''
+        if time.time() - self.last_used < self.heartbeat:
+            return
+        self.signal(BNET_HEARTBEAT)
+        self.recv()
+        self.last_used = time.time()
+        return
+
+    def packets(self):
+        '''Read one complete command response, as the list of packets it came
+        in.  Signals other than end of data (messages pending, command ok,
+        prompts and such) are skipped.'''
+        packets = []
+        while True:
+            data = self.recv()
+            if self.last_signal is None:
+                packets.append(data)
+            elif self.last_signal == BNET_EOD:
+                break
+        self.last_used = time.time()
+        return packets
+
+    def response(self):
+        '''Read one complete command response.'''
+        return ''.join(self.packets())
+
+    def command(self, command):
+        '''Run a single command, returning the response.'''
+        for command, response in self.pipeline([command]):
+            return response
+
+    def command_packets(self, command):
+        '''Run a single command, returning the packets of the response.  Some
+        dot commands (.sql, for one) send a packet per row.'''
+        self.keepalive()
+        self.send(command)
+        return self.packets()
+
+    def pipeline(self, commands):
+        '''Run every command in the iterable commands, yielding (command,
+        response) pairs in order as the responses arrive.
+
+        If the caller stops early, the responses still on their way are read
+        and thrown away, so that they don't turn up as the response to the
+        next command.  If anything goes wrong part way through, the session
+        is closed, as there's no telling where in the stream we are.'''
+        self.keepalive()
+        pending = deque()
+        try:
+            for command in commands:
+                if len(pending) >= self.window:
+                    yield pending.popleft(), self.response()
+                self.send(command)
+                pending.append(command)
+            while pending:
+                yield pending.popleft(), self.response()
+        except GeneratorExit:
+            try:
+                for command in pending:
+                    self.response()
+            except Exception as the_exception:
+                logging.debug('unable to drain the pipeline: %s', the_exception)
+                self.close()
+            raise
+        except Exception:
+            self.close()
+            raise
         return
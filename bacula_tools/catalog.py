@@ -43,9 +43,7 @@ class Catalog(bacula_tools.DbDict):
             self.update(new_me[0])
         except Exception as the_exception:
             logger.debug(str(the_exception))
-        for x in dir(self):
-            if '_load_' in x:
-                getattr(self, x)()
+        self._run_load_hooks()
         return self
 
     def _cli_special_setup(self):
@@ -89,7 +87,8 @@ class Catalog(bacula_tools.DbDict):
             if value == None:
                 value = ''
             args.append(value)
-        c_conn.connect(*args)
+        # The catalog has no config_versions table
+        c_conn.connect(*args, versioned=False)
         return c_conn
 
 # Implement the CLI for managing Catalogs
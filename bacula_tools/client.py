@@ -40,7 +40,8 @@ configuration.'''
                             self._fk_reference(bacula_tools.CATALOG_ID)[bacula_tools.NAME]))
         if getattr(self, bacula_tools.DIRECTOR_ID, None):
             pw_store = bacula_tools.PasswordStore(
-                self, bacula_tools.Director().search(self.director_id))
+                self, bacula_tools.Director().search(self.director_id),
+                self.passwords)
             if getattr(pw_store, bacula_tools.PASSWORD, None):
                 self.output.insert(-1, '  Password = "%s"' % pw_store.password)
         for key in [bacula_tools.ADDRESS, bacula_tools.FDPORT,
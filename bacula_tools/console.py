@@ -42,7 +42,7 @@ class Console(DbDict):
             'Director {\n  Name = "%(name)s"' % self, '  Monitor = yes', '}']
         if getattr(self, CLIENT_ID, None):
             c = bacula_tools.Client().search(self.client_id)
-            a = bacula_tools.PasswordStore(c, self)
+            a = bacula_tools.PasswordStore(c, self, self.passwords)
             self.output.insert(-1, '  Password = "%s"' % a.password)
         return '\n'.join(self.output)
 
@@ -52,7 +52,8 @@ class Director(DbDict):
         self.output = ['Director {\n  Name = "%(name)s"' % self, '}']
         if getattr(self, CLIENT_ID, None):
             a = bacula_tools.PasswordStore(
-                bacula_tools.Client().search(self.client_id), self)
+                bacula_tools.Client().search(self.client_id), self,
+                self.passwords)
             if getattr(a, PASSWORD, None):
                 self.output.insert(-1, '  Password = "%s"' % a.password)
         return '\n'.join(self.output)
@@ -62,7 +63,8 @@ class Director(DbDict):
         self.output = ['Director {\n  Name = "%(name)s"' % self, '}']
         if getattr(self, STORAGE_ID, None):
             a = bacula_tools.PasswordStore(
-                bacula_tools.Storage().search(self.storage_id), self)
+                bacula_tools.Storage().search(self.storage_id), self,
+                self.passwords)
             if getattr(a, PASSWORD, None):
                 self.output.insert(-1, '  Password = "%s"' % a.password)
         return '\n'.join(self.output)
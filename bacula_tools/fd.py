@@ -8,9 +8,10 @@ class FDaemon(BSock):
     '''Client for communicating directly with a file daemon.
     '''
 
-    def __init__(self, address, password, myname, port=BACULA_FD_PORT, timeout=5):
+    def __init__(self, address, password, myname, port=BACULA_FD_PORT, timeout=5,
+                 deadline=None):
         BSock.__init__(
-            self, address, password, 'Director ' + myname, port, timeout)
+            self, address, password, 'Director ' + myname, port, timeout, deadline)
         return
 
     def version(self):
@@ -3,7 +3,7 @@
 from __future__ import print_function, absolute_import
 from bacula_tools import (DbDict, ENABLEVSS, EXCLUDE, FILESETS,
                           FILESET_FILES, ID, IGNOREFILESETCHANGES, OPTIONS,
-                          NAME)
+                          NAME, placeholders)
 from re import compile, MULTILINE, IGNORECASE, DOTALL
 import optparse
 import logging
@@ -12,6 +12,7 @@ import logging
 class Fileset(DbDict):
     table = FILESETS
     BOOL_KEYS = [ENABLEVSS, IGNOREFILESETCHANGES, ]
+    CACHED_ATTRIBUTES = ['entries']
 
     def __init__(self, row={}, string=None):
         DbDict.__init__(self, row, string)
@@ -28,6 +29,19 @@ class Fileset(DbDict):
         self.entries = list(self.bc.do_sql(sql, self[ID]))
         return self
 
+    @classmethod
+    def _bulk_load_parts(kls, filesets):
+        '''Bulk version of _load_parts(), used by Find().'''
+        by_id = dict((fileset[ID], fileset) for fileset in filesets)
+        for fileset in filesets:
+            fileset.entries = []
+        sql = '''SELECT a.fileset_id, b.id AS id, b.name AS name, b.option, a.exclude
+                 FROM fileset_link a, fileset_files b
+                 WHERE a.file_id = b.id AND a.fileset_id IN (%s)''' % placeholders(len(by_id))
+        for row in kls.bc.do_sql(sql, tuple(by_id)):
+            by_id[row[0]].entries.append(row[1:])
+        return
+
     def _parse_add_entry(self, *args):
         '''Supports the string parser.  Extracts fileset Include/Exclude phrases.
         This should probably be thrown back into the parser, but I'll leave
@@ -58,6 +72,7 @@ class Fileset(DbDict):
         and a file with the same content.
 
         '''
+        self._cache_invalidate()
         new_entry = list(self.bc.value_ensure(FILESET_FILES, NAME, entry)[0])
         if not new_entry[2] == option:
             new_entry[2] = option
@@ -85,6 +100,7 @@ class Fileset(DbDict):
                 continue
             self.bc.do_sql('DELETE FROM fileset_link WHERE fileset_id = %s AND file_id = %s and exclude = %s',
                            (self[ID], row[0], row[3]))
+            self._cache_invalidate()
             self.entries.remove(row)
             return
         print('I cannot delete entries that do not exist!')
@@ -46,6 +46,7 @@ class Job(bacula_tools.DbDict):
     SPECIAL_KEYS = [bacula_tools.JOB_ID, ]
     table = bacula_tools.JOBS
     retlabel = 'Job'
+    CACHED_ATTRIBUTES = ['scripts']
 
     def __init__(self, row={}, string=None):
         '''Need to have a nice, clean scripts member'''
@@ -78,23 +79,15 @@ class Job(bacula_tools.DbDict):
             self.output.insert(-1, str(x))
         return '\n'.join(self.output)
 
-    def _fk_reference(self, fk, string=None):
-        '''This overrides the normal _fk_reference function becase we actually have
+    @classmethod
+    def _fk_class(kls, fk):
+        '''This overrides the normal _fk_class function becase we actually have
         four different keys that all point to Pools.
         '''
         key = fk.replace('_id', '')
         if 'pool' in key:
             key = 'pool'
-        obj = bacula_tools._DISPATCHER[key]()
-        if string:
-            obj.search(string.strip())
-            if not obj[bacula_tools.ID]:
-                obj.set_name(string.strip())
-            if not self[fk] == obj[bacula_tools.ID]:
-                self.set(fk, obj[bacula_tools.ID])
-        else:
-            obj.search(self[fk])
-        return obj
+        return bacula_tools._DISPATCHER[key]
 
     def _load_scripts(self):
         '''Job scripts are stored separately as Script objects.  This loads them in. '''
@@ -108,6 +101,22 @@ class Job(bacula_tools.DbDict):
                 self.scripts.append(s)
         return
 
+    @classmethod
+    def _bulk_load_scripts(kls, jobs):
+        '''Bulk version of _load_scripts(): loads the scripts for a whole list
+        of jobs with a single join.  Used by Find().'''
+        by_id = dict((job[bacula_tools.ID], job) for job in jobs)
+        sql = '''SELECT js.job_id AS link_job_id, s.* FROM job_scripts js, scripts s
+                 WHERE js.script_id = s.id AND js.job_id IN (%s)
+                 ORDER BY js.id''' % bacula_tools.placeholders(len(by_id))
+        for row in kls.bc.do_sql(sql, tuple(by_id), asdict=True):
+            job = by_id[row.pop('link_job_id')]
+            s = bacula_tools.Script(row)
+            job.scripts = [
+                x for x in job.scripts if not x[bacula_tools.ID] == s[bacula_tools.ID]]
+            job.scripts.append(s)
+        return
+
     def _parse_script(self, **kwargs):
         '''Helper function for parsing configuration strings.'''
         def doit(a, b, c):
@@ -119,6 +128,7 @@ class Job(bacula_tools.DbDict):
 
     def _add_script(self, s):
         '''Add a script to the Job.'''
+        self._cache_invalidate()
         self.scripts = [x for x in self.scripts if not x[bacula_tools.ID]
                         == s[bacula_tools.ID]]
         self.scripts.append(s)
@@ -132,6 +142,7 @@ class Job(bacula_tools.DbDict):
     def _delete_script(self, s):
         '''Remove a Script from the Job.  This does not actually delete the Script,
         just the linkage to this job.'''
+        self._cache_invalidate()
         self.bc.do_sql(
             'DELETE FROM job_scripts WHERE id = %s', (s[bacula_tools.ID]))
         self.scripts = [
@@ -282,7 +293,8 @@ class JobDef(Job):
 
     def _save(self):
         '''JobDefs force the JOBDEF key to 1 upon saving.'''
-        self[bacula_tools.JOBDEF] = 1
+        if not self[bacula_tools.JOBDEF] == 1:
+            self[bacula_tools.JOBDEF] = 1
         return Job._save(self)
 
 
@@ -1,8 +1,14 @@
 # -*- coding: utf-8 -*-
 from __future__ import print_function, absolute_import
+import os
 import re
+import glob
+import hashlib
 import bacula_tools
 import traceback
+import functools
+import threading
+from contextlib import contextmanager
 
 # Mostly I try to import specific things, but there's something like 200
 # constants to be imported here.
@@ -25,22 +31,383 @@ changes to the various resources.
 '''
 
 
+@contextmanager
+def _no_transaction():
+    '''Stand-in for Bacula_Config.transaction() when not in bulk mode.'''
+    yield
+
+
+# Outside of quotes, these are the only characters the tokenizer cares about.
+_special_re = re.compile(r'[{}"#;]')
+# Inside of quotes, only the closing quote matters (but watch out for \").
+_quoted_re = re.compile(r'\\.|"')
+
+
+class IncludeResolver(object):
+
+    '''Handles @include lines for tokenize().  Each file is only read once,
+    no matter how many times it is included, as its lines are cached by
+    (real) path.  Shell-style wildcards are expanded, with the matching files
+    included in sorted order, and a file that (eventually) includes itself
+    raises a ValueError rather than recursing forever.  An instance can be
+    shared between several imports, so that common files are only read once.
+
+    '''
+
+    def __init__(self):
+        object.__init__(self)
+        self.cache = {}
+        self.active = []        # The stack of files currently being included
+        return
+
+    def __call__(self, filename):
+        '''Yield the lines of filename (or of each file matching it).  This
+        is a generator, so nothing is read until tokenize() gets to it.'''
+        if glob.has_magic(filename):
+            paths = sorted(glob.glob(filename))
+        else:
+            paths = [filename]
+        for path in paths:
+            path = os.path.realpath(path)
+            if path in self.active:
+                raise ValueError('Include loop: %s' %
+                                 ' -> '.join(self.active + [path]))
+            self.active.append(path)
+            try:
+                for line in self.read(path):
+                    yield line
+            finally:
+                self.active.pop()
+        return
+
+    def read(self, path):
+        '''Return the lines of path, reading it only the first time.'''
+        if not path in self.cache:
+            with open(path) as f:
+                self.cache[path] = f.readlines()
+        return self.cache[path]
+
+
+def tokenize(lines, include=None):
+    '''Split configuration text into resources, yielding a (resource type,
+    body, line number) tuple for each one as soon as its closing brace is
+    seen.  lines may be anything that produces lines of text (an open file,
+    for instance) or a string.
+
+    This is done in a single pass, so braces, semicolons and hashes inside
+    quoted strings are left alone.  Outside of quotes, # starts a comment,
+    ; separates directives (and becomes a newline), and a line ending with a
+    backslash is continued on the next one.  A line starting with @ is
+    replaced with the lines produced by include(filename), which defaults to
+    a new IncludeResolver.
+
+    The line number is that of the resource's opening brace, in whichever
+    file it appears.
+    '''
+    if isinstance(lines, basestring):
+        lines = lines.splitlines(True)
+    if include == None:
+        include = IncludeResolver()
+    sources = [[iter(lines), 0]]  # [iterator, current line number]
+    depth = 0
+    quoted = False
+    current = []
+    name = start = None
+    while sources:
+        source = sources[-1]
+        line = next(source[0], None)
+        if line == None:
+            sources.pop()
+            continue
+        source[1] += 1
+        while line.rstrip('\r\n').endswith('\\'):
+            line = line.rstrip('\r\n')[:-1] + next(source[0], '')
+            source[1] += 1
+        if not quoted and line.lstrip().startswith('@'):
+            sources.append(
+                [iter(include(line.strip()[1:].strip().strip('"'))), 0])
+            continue
+        pos = 0
+        while pos < len(line):
+            if quoted:
+                match = _quoted_re.search(line, pos)
+                if not match:   # The string goes on to the next line
+                    current.append(line[pos:])
+                    break
+                current.append(line[pos:match.end()])
+                pos = match.end()
+                quoted = match.group() != '"'
+                continue
+            match = _special_re.search(line, pos)
+            if not match:
+                current.append(line[pos:])
+                break
+            current.append(line[pos:match.start()])
+            pos = match.end()
+            char = match.group()
+            if char == '"':
+                quoted = True
+                current.append(char)
+            elif char == '#':
+                current.append('\n')
+                break
+            elif char == ';':
+                current.append('\n')
+            elif char == '{':
+                depth += 1
+                if depth > 1:
+                    current.append(char)
+                    continue
+                name, start, current = ''.join(current), source[1], []
+            else:
+                depth -= 1
+                if depth > 0:
+                    current.append(char)
+                    continue
+                if depth < 0:
+                    raise ValueError('Unbalanced } at line %d' % source[1])
+                body = '\n'.join(
+                    [x for x in ''.join(current).split('\n') if x.strip()])
+                yield name.strip().lower(), body.strip(), start
+                current = []
+    if depth or quoted:
+        raise ValueError(
+            'Unexpected end of input in the resource at line %d' % start)
+    if ''.join(current).strip():
+        raise ValueError('Unexpected text after the last resource: %s' %
+                         ''.join(current).strip())
+    return
+
+
+# Enough to pick the name out of a stanza without parsing it.
+_name_re = re.compile(r'^\s*name\s*=\s*"?([^"\n]*?)"?\s*$', re.MULTILINE | re.I)
+# What counts for a fingerprint: quoted strings and runs of anything else.
+_fingerprint_re = re.compile(r'"(?:[^"\\]|\\.)*"|[^\s"]+')
+# Special case the Console here because the client config is stupid
+_monitor_re = re.compile(
+    r'^\s*m\s*o\s*n\s*i\s*t\s*o\s*r\s*=\s*yes\s*$', re.MULTILINE | re.I)
+
+
+class StanzaRecord(object):
+
+    '''One resource from a configuration file: its type, its body and where
+    it came from.  preparse() runs the relevant grammar over the body without
+    touching the database, recording the parse actions in calls, so that the
+    expensive part of parsing can be done in another process.  When the
+    record is finally parsed into a resource (see
+    StringParseSupport.parse_records), the recorded actions are replayed
+    rather than running the grammar again.
+
+    '''
+
+    def __init__(self, name, body, line=None, calls=None):
+        object.__init__(self)
+        self.name = name
+        self.body = body
+        self.line = line
+        self.calls = calls
+        self.error = None
+        return
+
+    def preparse(self):
+        '''Record the parse actions for this resource, if it has a grammar and
+        the body parses.  Anything else is left for the usual parse to deal
+        with (and report).  Returns self.'''
+        grammar = grammar_for(self.name)
+        if grammar == None:
+            return self
+        try:
+            with recording() as calls:
+                parse_with(grammar(), None, self.body)
+            self.calls = calls
+        except ParseBaseException as e:
+            self.error = str(e)
+        return self
+
+    def resource_name(self):
+        '''The Name of the resource, without parsing the whole thing.'''
+        match = _name_re.search(self.body)
+        return match and match.group(1).strip()
+
+    def identity(self):
+        '''The type and (lower-case) name of this resource.'''
+        return '%s %s' % (self.name, (self.resource_name() or '').lower())
+
+    def fingerprint(self, parent=None):
+        '''A hash of the type and tokens of this resource.  Whitespace doesn't
+        count, and neither do comments (tokenize() drops them).  If given, the
+        identity() of the resource's parent counts too, so that renaming the
+        parent changes the fingerprints of everything that hangs off it.'''
+        tokens = [self.name] + _fingerprint_re.findall(self.body)
+        if parent:
+            tokens.append(parent)
+        return hashlib.sha1('\0'.join(tokens)).hexdigest()
+
+
+class FingerprintStore(object):
+
+    '''The fingerprints (see StanzaRecord.fingerprint) of the resources last
+    imported from one configuration file.  Given one of these,
+    StringParseSupport skips any resource that hasn't changed since then, and
+    notes down the new fingerprints of the ones it does import.  With prune,
+    any resource that was imported from the file last time, but is no longer
+    in it, is deleted.
+
+    '''
+    table = 'stanza_fingerprints'
+    CHUNK = 500                 # Rows per multi-row statement
+    # Jobs go first, as nearly everything else is referred to by them.
+    PRUNE_ORDER = [JOB, JOBDEF, JOBDEFS]
+
+    def __init__(self, source, prune=False):
+        object.__init__(self)
+        self.source = os.path.realpath(source)
+        self.prune = prune
+        self.bc = bacula_tools.Bacula_Factory()
+        self.stored = None      # {(resource, lower-case name): fingerprint}
+        self.seen = set()
+        self.pending = {}
+        self.parent = None      # identity() of the first resource in the file
+        return
+
+    def load(self):
+        '''Fetch the fingerprints from the last import of this file.'''
+        self.stored = {}
+        for resource, name, fingerprint in self.bc.do_sql(
+                'SELECT resource, name, fingerprint FROM %s WHERE source = %%s' % self.table,
+                self.source):
+            self.stored[(resource, name.lower())] = fingerprint
+        return self
+
+    def _key(self, record):
+        return (record.name, (record.resource_name() or '').lower())
+
+    def fingerprint(self, record):
+        '''The fingerprint of record, including its parent: the first resource
+        in the file (the Director, Client or Storage) is the parent of the
+        ones that need one.'''
+        if self.parent == None:
+            self.parent = record.identity()
+        return record.fingerprint(self.parent)
+
+    def unchanged(self, record):
+        '''Is record just the same as last time?'''
+        if self.stored == None:
+            self.load()
+        key = self._key(record)
+        self.seen.add(key)
+        return self.stored.get(key) == self.fingerprint(record)
+
+    def update(self, record):
+        '''Note down the fingerprint of a resource that has been imported.'''
+        name = record.resource_name()
+        if name:
+            self.pending[self._key(record)] = (
+                record.name, name, self.fingerprint(record))
+        return
+
+    def stale(self):
+        '''The (resource, name) of everything imported last time, but not seen
+        this time.'''
+        order = self.PRUNE_ORDER
+        return sorted(set(self.stored or {}) - self.seen,
+                      key=lambda x: (order.index(x[0]) if x[0] in order else len(order), x))
+
+    def finish(self, output):
+        '''Prune (if asked to), and then write out the new fingerprints.'''
+        if self.stored == None:
+            self.load()
+        if self.prune:
+            self.forget([x for x in self.stale() if self._delete(x, output)])
+        rows = sorted(self.pending.values())
+        for chunk in _chunks(rows, self.CHUNK):
+            self.bc.do_sql(
+                'INSERT INTO %s (source, resource, name, fingerprint) VALUES %s '
+                'ON DUPLICATE KEY UPDATE name = VALUES(name), fingerprint = VALUES(fingerprint)' % (
+                    self.table, ','.join(['(%s,%s,%s,%s)'] * len(chunk))),
+                sum([(self.source,) + x for x in chunk], ()))
+        self.stored.update((x, self.pending[x][2]) for x in self.pending)
+        self.pending = {}
+        return
+
+    def _delete(self, key, output):
+        '''Delete a resource that is no longer in the file.  Returns True if it's
+        gone.'''
+        resource, name = key
+        try:
+            obj = bacula_tools._DISPATCHER[resource]()
+            obj.search(name)
+            if obj[ID]:
+                obj.delete()
+            output('%s: %s deleted' % (resource.capitalize(), name))
+            return True
+        except Exception as e:
+            output('%s: Unable to delete %s at this time: %s' % (
+                resource.capitalize(), name, e))
+        return False
+
+    def forget(self, keys):
+        '''Drop the fingerprints for some (resource, name) pairs.'''
+        for chunk in _chunks(sorted(keys), self.CHUNK):
+            self.bc.do_sql(
+                'DELETE FROM %s WHERE source = %%s AND (resource, name) IN (%s)' % (
+                    self.table, ','.join(['(%s,%s)'] * len(chunk))),
+                (self.source,) + sum([tuple(x) for x in chunk], ()))
+        for resource, name in keys:
+            self.stored.pop((resource, name.lower()), None)
+        return
+
+
+def stanzas(lines, include=None):
+    '''Generate a StanzaRecord for each resource in lines (see tokenize()).'''
+    for name, body, line in tokenize(lines, include):
+        if _monitor_re.search(body):
+            name = CONSOLE
+        yield StanzaRecord(name, body, line)
+    return
+
+
+def preparse_file(filename, includes=None):
+    '''Tokenize a configuration file and preparse all of its resources,
+    without touching the database.  This is the CPU-bound part of an import,
+    and is meant to be farmed out to other processes: the resulting list of
+    StanzaRecords can be pickled and handed to parse_records().'''
+    with open(filename) as f:
+        return [record.preparse() for record in stanzas(f, includes)]
+
+
 class StringParseSupport:
 
     '''Parse a string out into top-level resource items and pass them off to the relevant classes.'''
     RB = '}'
     LB = '{'
-    file_re = re.compile(r'\s@(.*)\s+', re.MULTILINE)
-    comment_re = re.compile(r'#.*', re.MULTILINE)
-    semicolon_re = re.compile(r';', re.MULTILINE)
-    blankline_re = re.compile(r'^\s+$', re.MULTILINE)
-    monitor_re = re.compile(
-        r'^\s*m\s*o\s*n\s*i\s*t\s*o\s*r\s*=\s*yes\s*$', re.MULTILINE | re.I)
-
-    def __init__(self, output):
+
+    def __init__(self, output, bulk=False, commit_every=None, includes=None,
+                 fingerprints=None):
         '''Initialize the instance variables, and set the output device.  There
-        should probably be a default set here.'''
+        should probably be a default set here.
+
+        If bulk is True, the whole import is done in one transaction, with
+        each stanza in a savepoint of its own: a stanza that fails to parse
+        is rolled back, and anything worse rolls back the whole import.  If
+        commit_every is also set, the work done so far is committed every
+        commit_every stanzas (at the cost of no longer being all-or-nothing).
+
+        includes is the IncludeResolver to use for @include lines.  Pass the
+        same one to several parsers to avoid re-reading common files.
+
+        fingerprints is a FingerprintStore for the file being imported.  If
+        given, only new and changed resources are imported.
+        '''
+        if includes == None:
+            includes = IncludeResolver()
         self.output = output
+        self.includes = includes
+        self.fingerprints = fingerprints
+        self.bulk = bulk
+        self.commit_every = commit_every
+        self.stanza_count = 0
+        self.bc = bacula_tools.Bacula_Factory()
         self.parse_queue = {}
         self.parsed = []
         self.director_config = False
@@ -48,54 +415,11 @@ class StringParseSupport:
         self.fd_config = False
         return
 
-    def file_replacement(self, string):
-        ''' Do a quick pass through the string looking for file imports.  If/When
-        you find any, replace the file import statement with the contents of
-        the file to be imported.  Repeat until there are no more file import statements.'''
-
-        # Strip the comments and blank lines out
-        string = self.blankline_re.sub('', self.comment_re.sub('', string))
-
-        # Search for any file import statements
-        groups = self.file_re.search(string)
-
-        while groups:           # Iterate through the file imports
-            filename = groups.group(1)
-            string_without_comments = self.comment_re.sub(
-                '', open(filename).read())
-            string = string.replace(groups.group(), string_without_comments)
-            # re-strip blank lines *after* doing the insert.
-            string = self.blankline_re.sub('', string)
-            # Look again for import statements
-            groups = self.file_re.search(string)
-        return string
-
-    def break_into_stanzas(self, string):
-        '''Split up the input string into resources, and drop each resource into a
-        queue to be individually parsed.  The complication is that there
-        are nested {} groups, so we have to do some counting and
-        re-assembly so we don't break things up in too fine-grained a manner.
-
-        '''
-        parts = string.split(self.RB)
-
-        # Split it up into parts, stored in self.parse_queue
-        while parts:
-            current = parts.pop(0)
-            while current.count(self.RB) < (current.count(self.LB) - 1):
-                current += self.RB + parts.pop(0)
-            try:
-                name, body = current.split(self.LB, 1)
-            except:
-                self.output(current)
-                raise
-            name = name.strip().lower()
-            # special case the Console here because the client config is stupid
-            if self.monitor_re.search(body):
-                name = CONSOLE
-            self.parse_queue.setdefault(name, []).append(body.strip())
-            while parts and parts[0] == '\n':
-                del parts[0]
+    def queue_records(self, records):
+        '''Drop each StanzaRecord into a queue (by resource type) to be
+        individually parsed.'''
+        for record in records:
+            self.parse_queue.setdefault(record.name, []).append(record)
         return
 
     def analyze_queue(self):
@@ -114,43 +438,96 @@ class StringParseSupport:
         if not key in self.parse_queue:
             return
         # Actually parse something
-        for body in self.parse_queue[key]:
+        for record in self.parse_queue[key]:
+            if self.unchanged(record, not self.parsed):
+                continue
+            body = record.body
             try:
                 obj = bacula_tools._DISPATCHER[key]()
                 self.parsed.append(obj)
-                if key == DIRECTOR:
-                    result = obj.parse_string(
-                        body, self.director_config, self.parsed[0])
-                elif key == CONSOLE:
-                    result = obj.parse_string(
-                        body, self.director_config, self.parsed[0])
-                elif key in [CATALOG.lower(), MESSAGES, DEVICE]:
-                    result = obj.parse_string(body, self.parsed[0])
-                else:
-                    result = obj.parse_string(body)
+                with self.stanza_transaction(), replaying(record.calls):
+                    result = self.parse_one_stanza(key, obj, body)
                 self.output(result)
+                self.imported(record)
             except Exception as e:
-                msg = '%s: Unable to handle %s at this time:\n%s' % (
-                    key.capitalize(), e, body.strip())
-                self.output(msg)
+                self.failure(key, e, body)
+            self.stanza_count += 1
+            if self.bulk and self.commit_every and not self.stanza_count % self.commit_every:
+                self.bc.checkpoint()
         del self.parse_queue[key]
         return
 
-    def parse_it_all(self, string):
-        '''Takes a string resulting from reading in a file, and parse it out.
-        Think of this as the driver routing for the entire parsing
-        process.
+    def unchanged(self, record, first=False):
+        '''With fingerprints, is record the same as the last time this file was
+        imported?  The first resource is always imported, as the ones after it
+        may need it as their parent (e.g. the Director).'''
+        if self.fingerprints == None:
+            return False
+        if not self.fingerprints.unchanged(record) or first:
+            return False
+        self.output('%s: %s unchanged' %
+                    (record.name.capitalize(), record.resource_name()))
+        return True
+
+    def imported(self, record):
+        '''Note down that record made it into the database.'''
+        if self.fingerprints != None:
+            self.fingerprints.update(record)
+        return
 
-        '''
-        string = self.file_replacement(string)
+    def failure(self, key, e, body):
+        '''Report a stanza that couldn't be handled.'''
+        self.output('%s: Unable to handle %s at this time:\n%s' % (
+            key.capitalize(), e, body.strip()))
+        return
 
-        # It should be observed that this statement causes scripts with
-        # embedded semi-colons to break parsing.
-        string = self.semicolon_re.sub('\n',  string).replace(
-            '\\\n', '').replace('\n\n', '\n')
+    def parse_one_stanza(self, key, obj, body):
+        '''Parse one stanza into obj, writing all of its directives with a
+        single UPDATE.  Returns the result message.'''
+        with obj.batch():
+            if key == DIRECTOR:
+                return obj.parse_string(
+                    body, self.director_config, self.parsed[0])
+            elif key == CONSOLE:
+                return obj.parse_string(
+                    body, self.director_config, self.parsed[0])
+            elif key in [CATALOG.lower(), MESSAGES, DEVICE]:
+                return obj.parse_string(body, self.parsed[0])
+            return obj.parse_string(body)
+
+    def stanza_transaction(self):
+        '''In bulk mode, a savepoint for a single stanza.  Otherwise, nothing.'''
+        if self.bulk:
+            return self.bc.transaction()
+        return _no_transaction()
+
+    def parse_it_all(self, lines):
+        '''Takes a string resulting from reading in a file (or the open file
+        itself), and parse it out.  Think of this as the driver routing for
+        the entire parsing process.
 
+        '''
+        return self.parse_records(stanzas(lines, self.includes))
+
+    def parse_records(self, records):
+        '''Parse a sequence of StanzaRecords (e.g. from preparse_file()) that
+        make up a configuration file.'''
+        with self.import_transaction():
+            result = self._parse_records(records)
+            if self.fingerprints != None:
+                self.fingerprints.finish(self.output)
+            return result
+
+    def import_transaction(self):
+        '''In bulk mode, a transaction for the whole import.  Otherwise, nothing.'''
+        if self.bulk:
+            return self.bc.transaction()
+        return _no_transaction()
+
+    def _parse_records(self, records):
+        '''Does the actual work for parse_records().'''
         # Fills in self.parse_queue
-        self.break_into_stanzas(string)
+        self.queue_records(records)
         self.analyze_queue()
 
         # Actually parse the various parts
@@ -169,6 +546,234 @@ class StringParseSupport:
         return self.parsed
 
 
+def _chunks(items, size):
+    '''Split a list up into lists of no more than size items.'''
+    return [items[i:i + size] for i in xrange(0, len(items), size)]
+
+
+class ResourceNode(object):
+
+    '''One resource in a ResourceGraph.  values holds plain column values and
+    refs the foreign keys, still as (class, name) pairs.  deferred holds the
+    recorded parse actions (see _perform) that need a real object, and the
+    database, to be run: scripts, fileset entries, passwords and the like.
+
+    '''
+    __slots__ = ('kind', 'kls', 'record', 'name',
+                 'values', 'refs', 'deferred', 'id')
+
+    def __init__(self, kind, record):
+        object.__init__(self)
+        self.kind = kind
+        self.kls = bacula_tools._DISPATCHER[kind]
+        self.record = record
+        self.name = None
+        self.values = {}
+        self.refs = {}
+        self.deferred = []
+        self.id = None
+        return
+
+    def apply(self, action, args, director_config=False):
+        '''Apply one recorded parse action in memory, if possible, or save it
+        for later.  This mirrors what _ACTIONS would do to a real object.'''
+        if action == 'director_password' and director_config:
+            action, args = 'setter', (PASSWORD, False, False, args[0])
+        if action == 'set_name':
+            self.name = args[0].strip()
+        elif action == 'set':
+            self.values[args[0]] = args[1]
+        elif action == 'setter':
+            key, c_int, dereference, tokens = args
+            value = tokens[2].strip()
+            if c_int:
+                value = int(value)
+            if not dereference:
+                self.values[key] = value
+            elif value:
+                self.refs[key] = (self.kls._fk_class(key), value)
+        else:
+            self.deferred.append((action, args))
+        return
+
+    def label(self):
+        '''What the parse_string functions would have returned.'''
+        return '%s: %s' % (getattr(self.kls, 'retlabel', self.kls.__name__), self.name)
+
+
+class ResourceGraph(StringParseSupport):
+
+    '''Two-phase import.  Parsing builds a ResourceNode for each resource
+    without touching the database, with foreign keys left as names.  Then
+    persist() finds or creates every name involved, resolves the foreign
+    keys in memory and writes the values back with a handful of multi-row
+    statements per table.  Only the actions that need a real object are then
+    run one resource at a time, along with any resources that couldn't be
+    parsed in memory (see StanzaRecord).
+
+    With dry_run, the second phase is skipped and the database is never
+    touched: each resource is reported, along with any references that
+    would have to be looked up in (or added to) the database.
+
+    '''
+    CHUNK = 500                 # Rows per multi-row statement
+
+    def __init__(self, output, bulk=False, commit_every=None, includes=None,
+                 fingerprints=None, dry_run=False):
+        StringParseSupport.__init__(self, output, bulk and not dry_run,
+                                    commit_every, includes, fingerprints)
+        self.dry_run = dry_run
+        self.nodes = []
+        return
+
+    def parse_one_stanza_type(self, key):
+        '''Build the nodes for all of the stanzas of one type.'''
+        for record in self.parse_queue.pop(key, []):
+            if self.unchanged(record, not self.nodes):
+                continue
+            if record.calls == None:
+                record.preparse()
+            node = ResourceNode(key, record)
+            for action, args in record.calls or []:
+                node.apply(action, args, self.director_config)
+            self.nodes.append(node)
+        return
+
+    def _parse_records(self, records):
+        '''Phase one (see StringParseSupport), then phase two.'''
+        StringParseSupport._parse_records(self, records)
+        if not self.dry_run:
+            return self.persist()
+        for node in self.nodes:
+            if node.name:
+                self.output(node.label())
+            elif node.record.error:
+                self.failure(node.kind, node.record.error, node.record.body)
+            else:
+                self.output('%s: not checked, will be parsed during the import' %
+                            node.kind.capitalize())
+        for kls, name in self.external_references():
+            self.output('Reference: %s "%s" must be found in (or added to) the database' %
+                        (kls.__name__, name))
+        return self.nodes
+
+    def external_references(self):
+        '''The (class, name) references that aren't to a resource in the graph.'''
+        known = set((x.kls.table, x.name.lower())
+                    for x in self.nodes if x.name)
+        wanted = set()
+        for node in self.nodes:
+            for kls, name in node.refs.values():
+                if not (kls.table, name.lower()) in known:
+                    wanted.add((kls, name))
+        return sorted(wanted, key=lambda x: (x[0].__name__, x[1]))
+
+    def persist(self):
+        '''Phase two: write the whole graph out.  Returns the resulting
+        resources, like parse_it_all().'''
+        nodes = [x for x in self.nodes if x.name]
+        ids = self._ensure_names(nodes)
+        self._store_values(nodes, ids)
+        identity_map = self.bc.identity_map
+        if identity_map != None:
+            for table in set(x.kls.table for x in nodes):
+                identity_map.invalidate(table)
+        for node in self.nodes:
+            self._finish(node)
+        return self.parsed
+
+    def _find_names(self, table, names):
+        '''Look up the ids for a bunch of names, returning {lower-case name: id}.
+        MySQL's comparisons are case-insensitive, so ours are too.'''
+        found = {}
+        for chunk in _chunks(sorted(names), self.CHUNK):
+            sql = 'SELECT id, name FROM %s WHERE name IN (%s)' % (
+                table, bacula_tools.placeholders(len(chunk)))
+            for id, name in self.bc.do_sql(sql, chunk):
+                found.setdefault(name.lower(), id)
+        return found
+
+    def _ensure_names(self, nodes):
+        '''Find (or create) the row for every name the nodes have or refer to,
+        returning {(table, lower-case name): id}.'''
+        wanted = {}
+        for node in nodes:
+            wanted.setdefault(node.kls.table, {})[node.name.lower()] = node.name
+            for kls, name in node.refs.values():
+                wanted.setdefault(kls.table, {})[name.lower()] = name
+        ids = {}
+        for table, names in wanted.items():
+            found = self._find_names(table, names.values())
+            missing = sorted(names[x] for x in names if not x in found)
+            for chunk in _chunks(missing, self.CHUNK):
+                self.bc.do_sql('INSERT INTO %s (name) VALUES %s' % (
+                    table, ','.join(['(%s)'] * len(chunk))), chunk)
+            if missing:
+                found.update(self._find_names(table, missing))
+            ids.update(((table, x), found[x]) for x in found)
+        return ids
+
+    def _store_values(self, nodes, ids):
+        '''Write the values, and now-resolved foreign keys, of every node with
+        one multi-row upsert per table (and set of columns).'''
+        groups = {}
+        for node in nodes:
+            node.id = ids[(node.kls.table, node.name.lower())]
+            row = dict(node.values)
+            for key, (kls, name) in node.refs.items():
+                row[key] = ids[(kls.table, name.lower())]
+            if row.get(PASSWORD) == GENERATE:
+                row[PASSWORD] = bacula_tools.generate_password()
+            if issubclass(node.kls, bacula_tools.JobDef):
+                row[JOBDEF] = 1  # See JobDef._save
+            if not row:
+                continue
+            keys = tuple(sorted(row))
+            groups.setdefault((node.kls.table, keys), []).append(
+                (node.id, node.name) + tuple(row[x] for x in keys))
+        for (table, keys), rows in groups.items():
+            columns = (ID, NAME) + keys
+            for chunk in _chunks(rows, self.CHUNK):
+                sql = 'INSERT INTO %s (`%s`) VALUES %s ON DUPLICATE KEY UPDATE %s' % (
+                    table, '`,`'.join(columns),
+                    ','.join(['(%s)' % bacula_tools.placeholders(len(columns))] * len(chunk)),
+                    ', '.join(['`%s` = VALUES(`%s`)' % (x, x) for x in keys]))
+                self.bc.do_sql(sql, sum(chunk, ()))
+        return
+
+    def _finish(self, node):
+        '''Run whatever couldn't be done in bulk for a node, and report on it.'''
+        try:
+            if not node.name:
+                # Not parsed in memory, so do it the usual way
+                obj = node.kls()
+                self.parsed.append(obj)
+                with self.stanza_transaction():
+                    result = self.parse_one_stanza(
+                        node.kind, obj, node.record.body)
+            else:
+                obj = node.kls({ID: node.id, NAME: node.name})
+                self.parsed.append(obj)
+                parent = self.parsed[0]
+                with self.stanza_transaction(), obj.batch(), replaying(node.deferred):
+                    parse_with(None, obj, node.record.body,
+                               self.director_config, parent)
+                    # The rest of what the *_parse_string functions do
+                    if node.kind == CATALOG.lower():
+                        obj.set(DIRECTOR_ID, parent[ID])
+                    elif node.kind == DEVICE:
+                        obj.link(parent)
+                result = node.label()
+            self.output(result)
+            self.imported(node.record)
+        except Exception as e:
+            self.failure(node.kind, e, node.record.body)
+        self.stanza_count += 1
+        if self.bulk and self.commit_every and not self.stanza_count % self.commit_every:
+            self.bc.checkpoint()
+        return
+
+
 gr_eq = Literal('=')
 gr_stripped_string = quotedString.copy().setParseAction(removeQuotes)
 gr_opt_quoted_string = gr_stripped_string | restOfLine
@@ -208,297 +813,463 @@ def handle_monitor(*x):
     '''
     pass
 
+# The grammars are built once per process and shared, so the parse actions
+# can't close over the object being parsed into.  Instead, they find it (and
+# whatever else they need to know) in the parse context.
+
+
+class _ParseContext(threading.local):
+
+    '''What the shared grammars are currently parsing into.'''
+    target = None
+    director_config = False
+    parent = None
+    record = None               # See _perform()
+    replay = None               # See parse_with()
+
+_context = _ParseContext()
+
+# pyparsing keeps global state (the packrat cache, if it's enabled), so only
+# one thread parses at a time.
+_PARSE_LOCK = threading.RLock()
+_GRAMMAR_LOCK = threading.RLock()
+
+
+def enable_packrat(cache_size_limit=None):
+    '''Turn on pyparsing's packrat caching.  It's off by default: these grammars
+    hardly ever backtrack, so the cache costs more than it saves (see
+    tests/benchmark_parser).  pyparsing has no way of turning it back off.'''
+    ParserElement.enablePackrat(cache_size_limit)
+
+
+def parse_with(grammar, target, string, director_config=False, parent=None):
+    '''Run one of the shared grammars over string, with the parse actions
+    directed at target.  Inside replaying(), the recorded actions are run
+    instead, and the grammar is skipped.'''
+    with _PARSE_LOCK:
+        saved = (_context.target, _context.director_config, _context.parent)
+        _context.target = target
+        _context.director_config = director_config
+        _context.parent = parent
+        try:
+            if _context.replay != None:
+                for name, args in _context.replay:
+                    _ACTIONS[name](*args)
+                return
+            return grammar.parseString(string, parseAll=True)
+        finally:
+            (_context.target, _context.director_config,
+             _context.parent) = saved
+
+
+@contextmanager
+def recording():
+    '''Note down the parse actions of any grammars run inside this, instead of
+    running them.  Yields the list they are noted in.'''
+    _context.record = []
+    try:
+        yield _context.record
+    finally:
+        _context.record = None
+
+
+@contextmanager
+def replaying(calls):
+    '''Have parse_with() run calls (from recording()) instead of its grammar.
+    Nothing changes if calls is None.'''
+    _context.replay = calls
+    try:
+        yield
+    finally:
+        _context.replay = None
+
+
+def _grammar(builder):
+    '''Decorator for the functions that build grammars: the first call builds
+    it, and every later call gets the same one back.  The original function
+    is still available as .build, mostly for benchmarking.'''
+    built = []
+
+    @functools.wraps(builder)
+    def get():
+        with _GRAMMAR_LOCK:
+            if not built:
+                built.append(builder())
+        return built[0]
+    get.build = builder
+    return get
+
+
+def _perform(name, *args):
+    '''Every parse action ends up here, with plain (picklable) arguments.
+    Normally the named action is run straight away against the object being
+    parsed, but when recording it's just noted down, to be replayed later
+    (see StanzaRecord).'''
+    if _context.record != None:
+        _context.record.append((name, args))
+        return
+    _ACTIONS[name](*args)
+    return
+
+
+def _set_name(s, loc, tokens):
+    '''Parse action for the Name directive.'''
+    return _perform('set_name', tokens[2])
+
+
+def _setter(key, c_int=False, dereference=False):
+    '''Parse action that sets key on the object being parsed.'''
+    def action(s, loc, tokens):
+        return _perform('setter', key, c_int, dereference, tokens.asList())
+    return action
+
+
+def _method(name):
+    '''Parse action that hands the tokens to a method of the object being
+    parsed.'''
+    def action(s, loc, tokens):
+        return _perform('method', name, tokens.asList())
+    return action
+
+
+def _script(**kwargs):
+    '''Parse action for the various Run*Job shortcuts.'''
+    def action(s, loc, tokens):
+        return _perform('script', kwargs, tokens.asList())
+    return action
+
+
+def _addresses(key):
+    '''Parse action for the {fd,sd,dir} addresses blocks.'''
+    def action(s, loc, tokens):
+        a, b, c = tokens
+        return _perform('set', key, '  %s' % '\n  '.join(c))
+    return action
+
+
+def _store_password(s, loc, tokens):
+    '''Passwords get stuffed into a password store.  I'm not sure how to pull this out.
+    '''
+    return _perform('password', tokens[2])
+
+
+def _director_password(s, loc, tokens):
+    '''If this isn't a director, then we ignore the password (but keep it for
+    the parent object).'''
+    return _perform('director_password', tokens.asList())
+
+
+def _do_password(password):
+    '''Store the password shared by the parent and the object being parsed.'''
+    p = PasswordStore(_context.parent, _context.target)
+    p.password = password
+    p.store()
+    return
+
+
+def _do_director_password(tokens):
+    '''A Director's own password, or one it shares with the parent.'''
+    if _context.director_config:
+        return _context.target._parse_setter(PASSWORD)(tokens)
+    return _do_password(tokens[2])
+
+# What each parse action actually does to the object being parsed.
+_ACTIONS = {
+    'set_name': lambda name: _context.target.set_name(name),
+    'set': lambda key, value: _context.target.set(key, value),
+    'setter': lambda key, c_int, dereference, tokens:
+        _context.target._parse_setter(key, c_int, dereference)(tokens),
+    'method': lambda name, tokens:
+        getattr(_context.target, name)(None, None, tokens),
+    'script': lambda kwargs, tokens:
+        _context.target._parse_script(**kwargs)(None, None, tokens),
+    'password': _do_password,
+    'director_password': _do_director_password,
+}
+
+
+def _ip_addresses(words, key):
+    '''This is a complicated one: the {fd,sd,dir} addresses blocks.'''
+    da_addr = np(
+        ('Addr', 'Port'), Word(printables), lambda x, y, z: ' '.join(z))
+    da_ip = np(('IPv4', 'IPv6', 'IP'), nestedExpr('{', '}', OneOrMore(
+        da_addr).setParseAction(lambda x, y, z: ' ; '.join(z)))).setParseAction(handle_ip)
+    return np(words, nestedExpr('{', '}', OneOrMore(da_ip)), _addresses(key))
+
 # Class-specific parsers.  There are a couple classes that use the default
 # parser, or even have an in-class declaration.  Those classes are so
 # because their parsing requirements are very lightweight.
 
 
-def catalog_parse_string(self, string, director):
-    '''Parsing for the Catalog resource.
+@_grammar
+def catalog_grammar():
+    '''Grammar for the Catalog resource.
     '''
-    gr_line = np((NAME,), action=lambda x: self.set_name(x[2]))
+    gr_line = np((NAME,), action=_set_name)
     gr_line = gr_line | np(
-        (USER, 'dbuser', 'db user'), action=self._parse_setter(USER))
+        (USER, 'dbuser', 'db user'), action=_setter(USER))
     gr_line = gr_line | np(
-        (PASSWORD, 'dbpassword', 'db password'), action=self._parse_setter(PASSWORD))
+        (PASSWORD, 'dbpassword', 'db password'), action=_setter(PASSWORD))
     gr_line = gr_line | np(
-        PList(DBSOCKET), action=self._parse_setter(DBSOCKET))
+        PList(DBSOCKET), action=_setter(DBSOCKET))
     gr_line = gr_line | np(
-        PList(DBPORT), gr_number, action=self._parse_setter(DBPORT))
-    gr_line = gr_line | np(PList('db name'), action=self._parse_setter(DBNAME))
+        PList(DBPORT), gr_number, action=_setter(DBPORT))
+    gr_line = gr_line | np(PList('db name'), action=_setter(DBNAME))
     gr_line = gr_line | np(
-        PList('db address'), action=self._parse_setter(DBADDRESS))
-    gr_res = OneOrMore(gr_line)
-    result = gr_res.parseString(string, parseAll=True)
+        PList('db address'), action=_setter(DBADDRESS))
+    return OneOrMore(gr_line)
+
+
+def catalog_parse_string(self, string, director):
+    '''Parsing for the Catalog resource.
+    '''
+    result = parse_with(catalog_grammar(), self, string)
     self.set(DIRECTOR_ID, director[ID])
     return 'Catalog: ' + self[NAME]
 
 
-def client_parse_string(self, string):
-    '''Parser for the Client resource.
+@_grammar
+def client_grammar():
+    '''Grammar for the Client resource.
     '''
-    def handle_fdaddr(*x):
-        '''Docment this.
-        '''
-        a, b, c = x[2]
-        self.set(FDADDRESSES, '  %s' % '\n  '.join(c))
-        return
-
-    gr_line = np((NAME,), action=lambda x: self.set_name(x[2]))
-    gr_line = gr_line | np((ADDRESS,), action=self._parse_setter(ADDRESS))
+    gr_line = np((NAME,), action=_set_name)
+    gr_line = gr_line | np((ADDRESS,), action=_setter(ADDRESS))
     gr_line = gr_line | np(
-        (CATALOG,), action=self._parse_setter(CATALOG_ID, dereference=True))
+        (CATALOG,), action=_setter(CATALOG_ID, dereference=True))
     # Discard the password here!
     gr_line = gr_line | np((PASSWORD,), action=lambda x: x)
     gr_line = gr_line | np(
-        PList('file retention'), action=self._parse_setter(FILERETENTION))
+        PList('file retention'), action=_setter(FILERETENTION))
     gr_line = gr_line | np(
-        PList('job retention'), action=self._parse_setter(JOBRETENTION))
+        PList('job retention'), action=_setter(JOBRETENTION))
     gr_line = gr_line | np(
-        (PRIORITY,), gr_number, action=self._parse_setter(PRIORITY))
+        (PRIORITY,), gr_number, action=_setter(PRIORITY))
     gr_line = gr_line | np(
-        PList('working directory'), action=self._parse_setter(WORKINGDIRECTORY))
+        PList('working directory'), action=_setter(WORKINGDIRECTORY))
     gr_line = gr_line | np(
-        PList('pid directory'), action=self._parse_setter(PIDDIRECTORY))
+        PList('pid directory'), action=_setter(PIDDIRECTORY))
     gr_line = gr_line | np(
-        PList('heart beat interval'), action=self._parse_setter(HEARTBEATINTERVAL))
+        PList('heart beat interval'), action=_setter(HEARTBEATINTERVAL))
     gr_line = gr_line | np(
-        PList('fd address'), action=self._parse_setter(FDADDRESS))
+        PList('fd address'), action=_setter(FDADDRESS))
     gr_line = gr_line | np(
-        PList('fd source address'), action=self._parse_setter(FDSOURCEADDRESS))
+        PList('fd source address'), action=_setter(FDSOURCEADDRESS))
     gr_line = gr_line | np(
-        PList('pki key pair'), action=self._parse_setter(PKIKEYPAIR))
+        PList('pki key pair'), action=_setter(PKIKEYPAIR))
     gr_line = gr_line | np(
-        PList('pki master key'), action=self._parse_setter(PKIMASTERKEY))
+        PList('pki master key'), action=_setter(PKIMASTERKEY))
     gr_line = gr_line | np(
-        PList('fd port'), gr_number, action=self._parse_setter(FDPORT))
+        PList('fd port'), gr_number, action=_setter(FDPORT))
     gr_line = gr_line | np(
-        PList('auto prune'), gr_yn, action=self._parse_setter(AUTOPRUNE))
+        PList('auto prune'), gr_yn, action=_setter(AUTOPRUNE))
     gr_line = gr_line | np(PList('maximum concurrent jobs'),
-                           gr_number, action=self._parse_setter(MAXIMUMCONCURRENTJOBS))
+                           gr_number, action=_setter(MAXIMUMCONCURRENTJOBS))
     gr_line = gr_line | np(
-        PList('pki encryption'), gr_yn, action=self._parse_setter(PKIENCRYPTION))
+        PList('pki encryption'), gr_yn, action=_setter(PKIENCRYPTION))
     gr_line = gr_line | np(
-        PList('pki signatures'), gr_yn, action=self._parse_setter(PKISIGNATURES))
+        PList('pki signatures'), gr_yn, action=_setter(PKISIGNATURES))
 
-    # This is a complicated one
-    da_addr = np(
-        ('Addr', 'Port'), Word(printables), lambda x, y, z: ' '.join(z))
-    da_ip = np(('IPv4', 'IPv6', 'IP'), nestedExpr('{', '}', OneOrMore(
-        da_addr).setParseAction(lambda x, y, z: ' ; '.join(z)))).setParseAction(handle_ip)
-    da_addresses = np(('fd addresses', FDADDRESSES), nestedExpr(
-        '{', '}', OneOrMore(da_ip)), handle_fdaddr)
+    da_addresses = _ip_addresses(('fd addresses', FDADDRESSES), FDADDRESSES)
 
-    gr_res = OneOrMore(gr_line | da_addresses)
-    result = gr_res.parseString(string, parseAll=True)
-    return 'Client: ' + self[NAME]
+    return OneOrMore(gr_line | da_addresses)
 
 
-def console_parse_string(self, string, director_config, obj):
-    '''Parser for the Console resource.
+def client_parse_string(self, string):
+    '''Parser for the Client resource.
     '''
+    result = parse_with(client_grammar(), self, string)
+    return 'Client: ' + self[NAME]
 
-    def handle_password(*x):
-        '''Passwords get stuffed into a password store.  I'm not sure how to pull this out.
-        '''
-        a, b, c = x[2]
-        p = PasswordStore(obj, self)
-        p.password = c
-        p.store()
-        return
 
-    gr_line = np((NAME,), action=lambda x: self.set_name(x[2]))
-    for key in self.SETUP_KEYS:
+@_grammar
+def console_grammar():
+    '''Grammar for the Console resource.
+    '''
+    gr_line = np((NAME,), action=_set_name)
+    for key in bacula_tools.Console.SETUP_KEYS:
         if key == PASSWORD:
             continue
-        gr_line = gr_line | np((key,), action=self._parse_setter(key))
+        gr_line = gr_line | np((key,), action=_setter(key))
     gr_monitor = np((MONITOR,), gr_yn, action=handle_monitor)
-    gr_pass = np((PASSWORD,), action=handle_password)
+    gr_pass = np((PASSWORD,), action=_store_password)
+
+    return OneOrMore(gr_line | gr_monitor | gr_pass)
 
-    gr_res = OneOrMore(gr_line | gr_monitor | gr_pass)
-    result = gr_res.parseString(string, parseAll=True)
+
+def console_parse_string(self, string, director_config, obj):
+    '''Parser for the Console resource.
+    '''
+    result = parse_with(console_grammar(), self, string, parent=obj)
     return 'Console: ' + self[NAME]
 
 
-def device_parse_string(self, string, obj=None):
-    '''Parser for the Device resource.
+@_grammar
+def device_grammar():
+    '''Grammar for the Device resource.
     '''
-    gr_line = np(PList(NAME), action=lambda x: self.set_name(x[2]))
+    gr_line = np(PList(NAME), action=_set_name)
     gr_line = gr_line | np(
-        PList('alert command'), action=self._parse_setter(ALERTCOMMAND))
+        PList('alert command'), action=_setter(ALERTCOMMAND))
     gr_line = gr_line | np(
-        PList('archive device'), action=self._parse_setter(ARCHIVEDEVICE))
+        PList('archive device'), action=_setter(ARCHIVEDEVICE))
     gr_line = gr_line | np(
-        PList('changer command'), action=self._parse_setter(CHANGERCOMMAND))
+        PList('changer command'), action=_setter(CHANGERCOMMAND))
     gr_line = gr_line | np(
-        PList('changer device'), action=self._parse_setter(CHANGERDEVICE))
+        PList('changer device'), action=_setter(CHANGERDEVICE))
     gr_line = gr_line | np(
-        PList('client connect wait'), action=self._parse_setter(CLIENTCONNECTWAIT))
+        PList('client connect wait'), action=_setter(CLIENTCONNECTWAIT))
     gr_line = gr_line | np(
-        PList('device type'), action=self._parse_setter(DEVICETYPE))
+        PList('device type'), action=_setter(DEVICETYPE))
     gr_line = gr_line | np(PList(
-        'drive index'), gr_number, action=self._parse_setter(DRIVEINDEX, c_int=True))
+        'drive index'), gr_number, action=_setter(DRIVEINDEX, c_int=True))
     gr_line = gr_line | np(
-        PList('maximum block size'), action=self._parse_setter(MAXIMUMBLOCKSIZE))
+        PList('maximum block size'), action=_setter(MAXIMUMBLOCKSIZE))
     gr_line = gr_line | np(
-        PList('maximum changer wait'), action=self._parse_setter(MAXIMUMCHANGERWAIT))
+        PList('maximum changer wait'), action=_setter(MAXIMUMCHANGERWAIT))
     gr_line = gr_line | np(PList('maximum concurrent jobs'), gr_number,
-                           action=self._parse_setter(MAXIMUMCONCURRENTJOBS, c_int=True))
+                           action=_setter(MAXIMUMCONCURRENTJOBS, c_int=True))
     gr_line = gr_line | np(
-        PList('maximum file size'), action=self._parse_setter(MAXIMUMFILESIZE))
+        PList('maximum file size'), action=_setter(MAXIMUMFILESIZE))
     gr_line = gr_line | np(
-        PList('maximum job spool size'), action=self._parse_setter(MAXIMUMJOBSPOOLSIZE))
+        PList('maximum job spool size'), action=_setter(MAXIMUMJOBSPOOLSIZE))
     gr_line = gr_line | np(PList(
-        'maximum network buffer size'), action=self._parse_setter(MAXIMUMNETWORKBUFFERSIZE))
+        'maximum network buffer size'), action=_setter(MAXIMUMNETWORKBUFFERSIZE))
     gr_line = gr_line | np(
-        PList('maximum open wait'), action=self._parse_setter(MAXIMUMOPENWAIT))
+        PList('maximum open wait'), action=_setter(MAXIMUMOPENWAIT))
     gr_line = gr_line | np(
-        PList('maximum part size'), action=self._parse_setter(MAXIMUMPARTSIZE))
+        PList('maximum part size'), action=_setter(MAXIMUMPARTSIZE))
     gr_line = gr_line | np(
-        PList('maximum rewind wait'), action=self._parse_setter(MAXIMUMREWINDWAIT))
+        PList('maximum rewind wait'), action=_setter(MAXIMUMREWINDWAIT))
     gr_line = gr_line | np(
-        PList('maximum spool size'), action=self._parse_setter(MAXIMUMSPOOLSIZE))
+        PList('maximum spool size'), action=_setter(MAXIMUMSPOOLSIZE))
     gr_line = gr_line | np(
-        PList('maximum volume size'), action=self._parse_setter(MAXIMUMVOLUMESIZE))
+        PList('maximum volume size'), action=_setter(MAXIMUMVOLUMESIZE))
     gr_line = gr_line | np(
-        PList('media type'), action=self._parse_setter(MEDIATYPE))
+        PList('media type'), action=_setter(MEDIATYPE))
     gr_line = gr_line | np(
-        PList('minimum block size'), action=self._parse_setter(MINIMUMBLOCKSIZE))
+        PList('minimum block size'), action=_setter(MINIMUMBLOCKSIZE))
     gr_line = gr_line | np(
-        PList('mount command'), action=self._parse_setter(MOUNTCOMMAND))
+        PList('mount command'), action=_setter(MOUNTCOMMAND))
     gr_line = gr_line | np(
-        PList('mount point'), action=self._parse_setter(MOUNTPOINT))
+        PList('mount point'), action=_setter(MOUNTPOINT))
     gr_line = gr_line | np(
-        PList('spool directory'), action=self._parse_setter(SPOOLDIRECTORY))
+        PList('spool directory'), action=_setter(SPOOLDIRECTORY))
     gr_line = gr_line | np(
-        PList('unmount command'), action=self._parse_setter(UNMOUNTCOMMAND))
+        PList('unmount command'), action=_setter(UNMOUNTCOMMAND))
     gr_line = gr_line | np(
-        PList('volume poll interval'), action=self._parse_setter(VOLUMEPOLLINTERVAL))
+        PList('volume poll interval'), action=_setter(VOLUMEPOLLINTERVAL))
 
     gr_line = gr_line | np(
-        PList('always open'), gr_yn, action=self._parse_setter(ALWAYSOPEN))
+        PList('always open'), gr_yn, action=_setter(ALWAYSOPEN))
     gr_line = gr_line | np(
-        PList('auto changer'), gr_yn, action=self._parse_setter(AUTOCHANGER))
+        PList('auto changer'), gr_yn, action=_setter(AUTOCHANGER))
     gr_line = gr_line | np(
-        PList('auto select'), gr_yn, action=self._parse_setter(AUTOSELECT))
+        PList('auto select'), gr_yn, action=_setter(AUTOSELECT))
     gr_line = gr_line | np(
-        PList('automatic mount'), gr_yn, action=self._parse_setter(AUTOMATICMOUNT))
+        PList('automatic mount'), gr_yn, action=_setter(AUTOMATICMOUNT))
     gr_line = gr_line | np(PList('backward space file'),
-                           gr_yn, action=self._parse_setter(BACKWARDSPACEFILE))
+                           gr_yn, action=_setter(BACKWARDSPACEFILE))
     gr_line = gr_line | np(PList('backward space record'),
-                           gr_yn, action=self._parse_setter(BACKWARDSPACERECORD))
+                           gr_yn, action=_setter(BACKWARDSPACERECORD))
     gr_line = gr_line | np(
-        PList('block check sum'), gr_yn, action=self._parse_setter(BLOCKCHECKSUM))
+        PList('block check sum'), gr_yn, action=_setter(BLOCKCHECKSUM))
     gr_line = gr_line | np(
-        PList('block positioning'), gr_yn, action=self._parse_setter(BLOCKPOSITIONING))
+        PList('block positioning'), gr_yn, action=_setter(BLOCKPOSITIONING))
     gr_line = gr_line | np(
-        PList('bsf at eom'), gr_yn, action=self._parse_setter(BSFATEOM))
+        PList('bsf at eom'), gr_yn, action=_setter(BSFATEOM))
     gr_line = gr_line | np(
-        PList('close on poll'), gr_yn, action=self._parse_setter(CLOSEONPOLL))
+        PList('close on poll'), gr_yn, action=_setter(CLOSEONPOLL))
     gr_line = gr_line | np(PList('fast forward space file'),
-                           gr_yn, action=self._parse_setter(FASTFORWARDSPACEFILE))
+                           gr_yn, action=_setter(FASTFORWARDSPACEFILE))
     gr_line = gr_line | np(
-        PList('forward space file'), gr_yn, action=self._parse_setter(FORWARDSPACEFILE))
+        PList('forward space file'), gr_yn, action=_setter(FORWARDSPACEFILE))
     gr_line = gr_line | np(PList(
-        'forward space record'), gr_yn, action=self._parse_setter(FORWARDSPACERECORD))
+        'forward space record'), gr_yn, action=_setter(FORWARDSPACERECORD))
     gr_line = gr_line | np(PList('hardware end of medium'),
-                           gr_yn, action=self._parse_setter(HARDWAREENDOFMEDIUM))
+                           gr_yn, action=_setter(HARDWAREENDOFMEDIUM))
     gr_line = gr_line | np(
-        PList('label media'), gr_yn, action=self._parse_setter(LABELMEDIA))
+        PList('label media'), gr_yn, action=_setter(LABELMEDIA))
     gr_line = gr_line | np(
-        PList('offline on unmount'), gr_yn, action=self._parse_setter(OFFLINEONUNMOUNT))
+        PList('offline on unmount'), gr_yn, action=_setter(OFFLINEONUNMOUNT))
     gr_line = gr_line | np(
-        PList('random access'), gr_yn, action=self._parse_setter(RANDOMACCESS))
+        PList('random access'), gr_yn, action=_setter(RANDOMACCESS))
     gr_line = gr_line | np(
-        PList('removable media'), gr_yn, action=self._parse_setter(REMOVABLEMEDIA))
+        PList('removable media'), gr_yn, action=_setter(REMOVABLEMEDIA))
     gr_line = gr_line | np(
-        PList('two eof'), gr_yn, action=self._parse_setter(TWOEOF))
+        PList('two eof'), gr_yn, action=_setter(TWOEOF))
     gr_line = gr_line | np(
-        PList('use mtiocget'), gr_yn, action=self._parse_setter(USEMTIOCGET))
+        PList('use mtiocget'), gr_yn, action=_setter(USEMTIOCGET))
+
+    return OneOrMore(gr_line)
 
-    gr_res = OneOrMore(gr_line)
 
-    result = gr_res.parseString(string, parseAll=True)
+def device_parse_string(self, string, obj=None):
+    '''Parser for the Device resource.
+    '''
+    result = parse_with(device_grammar(), self, string)
     if obj:
         self.link(obj)
     return 'Device: ' + self[NAME]
 
 
-def director_parse_string(self, string, director_config, obj):
-    '''Parser for the Director resource.
+@_grammar
+def director_grammar():
+    '''Grammar for the Director resource.
     FTR: this is hideous.
     '''
-
-    def _handle_password(*x):
-        a, b, c = x[2]
-        a = PasswordStore(obj, self)
-        a.password = c
-        a.store()
-        return
-
-    def _handle_diraddr(*x):
-        a, b, c = x[2]
-        self.set(DIRADDRESSES, '  %s' % '\n  '.join(c))
-        return
-
-    gr_name = np((NAME,), action=lambda x: self.set_name(x[2]))
-    gr_address = np((ADDRESS,), action=self._parse_setter(ADDRESS))
+    gr_name = np((NAME,), action=_set_name)
+    gr_address = np((ADDRESS,), action=_setter(ADDRESS))
     gr_fd_conn = np(PList('fd connect timeout'), gr_number,
-                    self._parse_setter(FD_CONNECT_TIMEOUT, True))
+                    _setter(FD_CONNECT_TIMEOUT, True))
     gr_heart = np(PList('heartbeat interval'), gr_number,
-                  self._parse_setter(HEARTBEATINTERVAL, True))
+                  _setter(HEARTBEATINTERVAL, True))
     gr_max_con = np(PList('maximum console connections'),
-                    gr_number, self._parse_setter(MAXIMUMCONSOLECONNECTIONS, True))
+                    gr_number, _setter(MAXIMUMCONSOLECONNECTIONS, True))
     gr_max_jobs = np(PList('maximum concurrent jobs'), gr_number,
-                     action=self._parse_setter(MAXIMUMCONCURRENTJOBS, True))
+                     action=_setter(MAXIMUMCONCURRENTJOBS, True))
     gr_pid = np(
-        PList('pid directory'), action=self._parse_setter(PIDDIRECTORY))
-    gr_query = np(PList('query file'), action=self._parse_setter(QUERYFILE))
+        PList('pid directory'), action=_setter(PIDDIRECTORY))
+    gr_query = np(PList('query file'), action=_setter(QUERYFILE))
     gr_scripts = np(
-        PList('scripts directory'), action=self._parse_setter(SCRIPTS_DIRECTORY))
+        PList('scripts directory'), action=_setter(SCRIPTS_DIRECTORY))
     gr_sd_conn = np(PList('sd connect timeout'), gr_number,
-                    self._parse_setter(SD_CONNECT_TIMEOUT, True))
+                    _setter(SD_CONNECT_TIMEOUT, True))
     gr_source = np(
-        PList('source address'), action=self._parse_setter(SOURCEADDRESS))
+        PList('source address'), action=_setter(SOURCEADDRESS))
     gr_stats = np(
-        PList('statistics retention'), action=self._parse_setter(STATISTICS_RETENTION))
+        PList('statistics retention'), action=_setter(STATISTICS_RETENTION))
     gr_messages = np(
-        (MESSAGES,), action=self._parse_setter(MESSAGES_ID, dereference=True))
+        (MESSAGES,), action=_setter(MESSAGES_ID, dereference=True))
     gr_work_dir = np(
-        PList('working directory'), action=self._parse_setter(WORKINGDIRECTORY))
+        PList('working directory'), action=_setter(WORKINGDIRECTORY))
     gr_port = np(
-        PList('dir port'), gr_number, self._parse_setter(DIRPORT, True))
+        PList('dir port'), gr_number, _setter(DIRPORT, True))
 
-    # This is a complicated one
-    da_addr = np(
-        ('Addr', 'Port'), Word(printables), lambda x, y, z: ' '.join(z))
-    da_ip = np(('IPv4', 'IPv6', 'IP'), nestedExpr('{', '}', OneOrMore(
-        da_addr).setParseAction(lambda x, y, z: ' ; '.join(z)))).setParseAction(handle_ip)
-    da_addresses = np(PList('dir addresses'), nestedExpr(
-        '{', '}', OneOrMore(da_ip)), _handle_diraddr)
+    da_addresses = _ip_addresses(PList('dir addresses'), DIRADDRESSES)
+
+    gr_pass = np((PASSWORD,), action=_director_password)
 
-    # if this isn't a director, then we ignore the password
-    if director_config:
-        gr_pass = np((PASSWORD,), action=self._parse_setter(PASSWORD))
-    else:
-        gr_pass = np((PASSWORD,), action=_handle_password)
+    return OneOrMore(gr_name | gr_address | gr_fd_conn | gr_heart | gr_max_con | gr_max_jobs | gr_pass | gr_pid |
+                     gr_query | gr_scripts | gr_sd_conn | gr_source | gr_stats | gr_messages | gr_work_dir | gr_port | da_addresses)
 
-    gr_res = OneOrMore(gr_name | gr_address | gr_fd_conn | gr_heart | gr_max_con | gr_max_jobs | gr_pass | gr_pid |
-                       gr_query | gr_scripts | gr_sd_conn | gr_source | gr_stats | gr_messages | gr_work_dir | gr_port | da_addresses)
 
-    result = gr_res.parseString(string, parseAll=True)
+def director_parse_string(self, string, director_config, obj):
+    '''Parser for the Director resource.
+    '''
+    result = parse_with(director_grammar(), self, string,
+                        director_config=director_config, parent=obj)
     return 'Director: ' + self[NAME]
 
 
-def fileset_parse_string(self, string):
-    '''Parser for the Fileset resource.
+@_grammar
+def fileset_grammar():
+    '''Grammar for the Fileset resource.
     '''
-    # why dos this one use lambda x,y, and other parsers only use lambda x?
-    gr_name = np((NAME,), action=lambda x, y=self: y.set_name(x[2]))
+    gr_name = np((NAME,), action=_set_name)
     gr_ifsc = np(PList('Ignore File Set Changes'), gr_yn,
-                 action=self._parse_setter(IGNOREFILESETCHANGES))
+                 action=_setter(IGNOREFILESETCHANGES))
     gr_evss = np(
-        PList('Enable VSS'), gr_yn, action=self._parse_setter(ENABLEVSS))
+        PList('Enable VSS'), gr_yn, action=_setter(ENABLEVSS))
 
     gr_i_option = Group(Keyword(OPTIONS, caseless=True) +
                         nestedExpr('{', '}', Regex('[^\}]+', re.MULTILINE)))
@@ -508,148 +1279,154 @@ def fileset_parse_string(self, string):
 
     gr_inc = Keyword('include', caseless=True) + \
         nestedExpr('{', '}', OneOrMore(gr_i_option | gr_i_file))
-    gr_inc.addParseAction(self._parse_add_entry)
+    gr_inc.addParseAction(_method('_parse_add_entry'))
     gr_exc = Keyword('exclude', caseless=True) + \
         nestedExpr('{', '}', OneOrMore(gr_e_option | gr_e_file))
-    gr_exc.addParseAction(self._parse_add_entry)
+    gr_exc.addParseAction(_method('_parse_add_entry'))
+
+    return OneOrMore(gr_name | gr_inc | gr_exc | gr_ifsc | gr_evss)
+
 
-    gr_res = OneOrMore(gr_name | gr_inc | gr_exc | gr_ifsc | gr_evss)
-    result = gr_res.parseString(string, parseAll=True)
+def fileset_parse_string(self, string):
+    '''Parser for the Fileset resource.
+    '''
+    result = parse_with(fileset_grammar(), self, string)
     return 'Fileset: ' + self[NAME]
 
 
-def job_parse_string(self, string):
-    '''Parser for the Job resource.
+@_grammar
+def job_grammar():
+    '''Grammar for the Job resource.
     '''
 
     # Easy ones that go don't take embedded spaces because I say so.
-    gr_line = np((NAME,), action=lambda x: self.set_name(x[2]))
+    gr_line = np((NAME,), action=_set_name)
     for key in [TYPE, LEVEL, REPLACE, BASE, RUN, WHERE]:
-        gr_line = gr_line | np((key,), action=self._parse_setter(key))
+        gr_line = gr_line | np((key,), action=_setter(key))
 
     # Group of _id variables
 
     gr_line = gr_line | np(
-        PList('differential pool'), action=self._parse_setter(DIFFERENTIALPOOL_ID))
+        PList('differential pool'), action=_setter(DIFFERENTIALPOOL_ID))
     gr_line = gr_line | np(
-        PList('file set'), action=self._parse_setter(FILESET_ID, dereference=True))
+        PList('file set'), action=_setter(FILESET_ID, dereference=True))
     gr_line = gr_line | np(
-        PList('full pool'), action=self._parse_setter(FULLPOOL_ID))
+        PList('full pool'), action=_setter(FULLPOOL_ID))
     gr_line = gr_line | np(
-        (CLIENT,), action=self._parse_setter(CLIENT_ID, dereference=True))
+        (CLIENT,), action=_setter(CLIENT_ID, dereference=True))
     gr_line = gr_line | np(
-        PList('incremental pool'), action=self._parse_setter(INCREMENTALPOOL_ID))
+        PList('incremental pool'), action=_setter(INCREMENTALPOOL_ID))
     gr_line = gr_line | np(
-        (MESSAGES,), action=self._parse_setter(MESSAGES_ID, dereference=True))
+        (MESSAGES,), action=_setter(MESSAGES_ID, dereference=True))
     gr_line = gr_line | np(
-        (POOL,), action=self._parse_setter(POOL_ID, dereference=True))
+        (POOL,), action=_setter(POOL_ID, dereference=True))
     gr_line = gr_line | np(
-        (SCHEDULE,), action=self._parse_setter(SCHEDULE_ID, dereference=True))
+        (SCHEDULE,), action=_setter(SCHEDULE_ID, dereference=True))
     gr_line = gr_line | np(
-        (STORAGE,), action=self._parse_setter(STORAGE_ID, dereference=True))
+        (STORAGE,), action=_setter(STORAGE_ID, dereference=True))
     gr_line = gr_line | np(
-        PList('job defs'), action=self._parse_setter(JOB_ID, dereference=True))
+        PList('job defs'), action=_setter(JOB_ID, dereference=True))
 
     # INTs
 
     gr_line = gr_line | np(PList('maximum concurrent jobs'),
-                           gr_number, action=self._parse_setter(MAXIMUMCONCURRENTJOBS))
+                           gr_number, action=_setter(MAXIMUMCONCURRENTJOBS))
     gr_line = gr_line | np(
-        PList('re schedule times'), gr_number, action=self._parse_setter(RESCHEDULETIMES))
+        PList('re schedule times'), gr_number, action=_setter(RESCHEDULETIMES))
     gr_line = gr_line | np(
-        (PRIORITY,), gr_number, action=self._parse_setter(PRIORITY))
+        (PRIORITY,), gr_number, action=_setter(PRIORITY))
 
     # True/False
 
     gr_line = gr_line | np(
-        (ACCURATE,), gr_yn, action=self._parse_setter(ACCURATE))
+        (ACCURATE,), gr_yn, action=_setter(ACCURATE))
     gr_line = gr_line | np(PList(
-        'allow duplicate jobs'), gr_yn, action=self._parse_setter(ALLOWDUPLICATEJOBS))
+        'allow duplicate jobs'), gr_yn, action=_setter(ALLOWDUPLICATEJOBS))
     gr_line = gr_line | np(PList(
-        'allow mixed priority'), gr_yn, action=self._parse_setter(ALLOWMIXEDPRIORITY))
+        'allow mixed priority'), gr_yn, action=_setter(ALLOWMIXEDPRIORITY))
     gr_line = gr_line | np(PList('cancel lower level duplicates'),
-                           gr_yn, action=self._parse_setter(CANCELLOWERLEVELDUPLICATES))
+                           gr_yn, action=_setter(CANCELLOWERLEVELDUPLICATES))
     gr_line = gr_line | np(PList('cancel queued duplicates'),
-                           gr_yn, action=self._parse_setter(CANCELQUEUEDDUPLICATES))
+                           gr_yn, action=_setter(CANCELQUEUEDDUPLICATES))
     gr_line = gr_line | np(PList('cancel running duplicates'),
-                           gr_yn, action=self._parse_setter(CANCELRUNNINGDUPLICATES))
+                           gr_yn, action=_setter(CANCELRUNNINGDUPLICATES))
     gr_line = gr_line | np(
-        (ENABLED,), gr_yn, action=self._parse_setter(ENABLED))
+        (ENABLED,), gr_yn, action=_setter(ENABLED))
     gr_line = gr_line | np(PList('prefer mounted volumes'),
-                           gr_yn, action=self._parse_setter(PREFERMOUNTEDVOLUMES))
+                           gr_yn, action=_setter(PREFERMOUNTEDVOLUMES))
     gr_line = gr_line | np(
-        PList('prefix links'), gr_yn, action=self._parse_setter(PREFIXLINKS))
+        PList('prefix links'), gr_yn, action=_setter(PREFIXLINKS))
     gr_line = gr_line | np(
-        PList('prune files'), gr_yn, action=self._parse_setter(PRUNEFILES))
+        PList('prune files'), gr_yn, action=_setter(PRUNEFILES))
     gr_line = gr_line | np(
-        PList('prune jobs'), gr_yn, action=self._parse_setter(PRUNEJOBS))
+        PList('prune jobs'), gr_yn, action=_setter(PRUNEJOBS))
     gr_line = gr_line | np(
-        PList('prune volumes'), gr_yn, action=self._parse_setter(PRUNEVOLUMES))
+        PList('prune volumes'), gr_yn, action=_setter(PRUNEVOLUMES))
     gr_line = gr_line | np(PList(
-        're run failed levels'), gr_yn, action=self._parse_setter(RERUNFAILEDLEVELS))
+        're run failed levels'), gr_yn, action=_setter(RERUNFAILEDLEVELS))
     gr_line = gr_line | np(PList(
-        're schedule on error'), gr_yn, action=self._parse_setter(RESCHEDULEONERROR))
+        're schedule on error'), gr_yn, action=_setter(RESCHEDULEONERROR))
     gr_line = gr_line | np(
-        PList('spool attributes'), gr_yn, action=self._parse_setter(SPOOLATTRIBUTES))
+        PList('spool attributes'), gr_yn, action=_setter(SPOOLATTRIBUTES))
     gr_line = gr_line | np(
-        PList('spool data'), gr_yn, action=self._parse_setter(SPOOLDATA))
+        PList('spool data'), gr_yn, action=_setter(SPOOLDATA))
     gr_line = gr_line | np(
-        PList('write boot strap'), gr_yn, action=self._parse_setter(WRITEPARTAFTERJOB))
+        PList('write boot strap'), gr_yn, action=_setter(WRITEPARTAFTERJOB))
 
     # plain strings
 
-    gr_line = gr_line | np((NOTES,), action=self._parse_setter(NOTES))
+    gr_line = gr_line | np((NOTES,), action=_setter(NOTES))
     gr_line = gr_line | np(
-        (ADDPREFIX, 'add prefix'), action=self._parse_setter(ADDPREFIX))
+        (ADDPREFIX, 'add prefix'), action=_setter(ADDPREFIX))
     gr_line = gr_line | np(
-        (ADDSUFFIX, 'add suffix'), action=self._parse_setter(ADDSUFFIX))
-    gr_line = gr_line | np((BASE,), action=self._parse_setter(BASE))
+        (ADDSUFFIX, 'add suffix'), action=_setter(ADDSUFFIX))
+    gr_line = gr_line | np((BASE,), action=_setter(BASE))
     gr_line = gr_line | np(
-        (BOOTSTRAP, 'boot strap'), action=self._parse_setter(BOOTSTRAP))
+        (BOOTSTRAP, 'boot strap'), action=_setter(BOOTSTRAP))
     gr_line = gr_line | np((DIFFERENTIALMAXWAITTIME, 'differential max wait time', 'differentialmaxwait time', 'differentialmax waittime', 'differential maxwaittime',
-                            'differentialmax wait time', 'differential maxwait time', 'differential max waittime'), action=self._parse_setter(DIFFERENTIALMAXWAITTIME))
+                            'differentialmax wait time', 'differential maxwait time', 'differential max waittime'), action=_setter(DIFFERENTIALMAXWAITTIME))
     gr_line = gr_line | np(('incremental-differentialmaxwaittime', 'incremental-differential maxwaittime', 'incremental-differentialmax waittime', 'incremental-differentialmaxwait time',
-                            'incremental-differential max waittime', 'incremental-differential maxwait time', 'incremental-differentialmax wait time', 'incremental-differential max wait time',), action=self._parse_setter(IDMAXWAITTIME))
+                            'incremental-differential max waittime', 'incremental-differential maxwait time', 'incremental-differentialmax wait time', 'incremental-differential max wait time',), action=_setter(IDMAXWAITTIME))
     gr_line = gr_line | np((INCREMENTALMAXRUNTIME, 'incremental max run time', 'incrementalmaxrun time', 'incrementalmax runtime', 'incremental maxruntime',
-                            'incrementalmax run time', 'incremental maxrun time', 'incremental max runtime'), action=self._parse_setter(INCREMENTALMAXRUNTIME))
+                            'incrementalmax run time', 'incremental maxrun time', 'incremental max runtime'), action=_setter(INCREMENTALMAXRUNTIME))
     gr_line = gr_line | np((MAXFULLINTERVAL, 'max full interval', 'max fullinterval',
-                            'maxfull interval'), action=self._parse_setter(MAXFULLINTERVAL))
+                            'maxfull interval'), action=_setter(MAXFULLINTERVAL))
     gr_line = gr_line | np((MAXIMUMBANDWIDTH, 'maximum band width', 'maximum bandwidth',
-                            'maximumband width'), action=self._parse_setter(MAXIMUMBANDWIDTH))
+                            'maximumband width'), action=_setter(MAXIMUMBANDWIDTH))
     gr_line = gr_line | np((MAXRUNSCHEDTIME, 'max run sched time', 'maxrunsched time', 'maxrun schedtime', 'max runschedtime',
-                            'maxrun sched time', 'max runsched time', 'max run schedtime'), action=self._parse_setter(MAXRUNSCHEDTIME))
+                            'maxrun sched time', 'max runsched time', 'max run schedtime'), action=_setter(MAXRUNSCHEDTIME))
     gr_line = gr_line | np(
-        (MAXRUNTIME, 'max run time', 'maxrun time', 'max runtime'), action=self._parse_setter(MAXRUNTIME))
+        (MAXRUNTIME, 'max run time', 'maxrun time', 'max runtime'), action=_setter(MAXRUNTIME))
     gr_line = gr_line | np((MAXSTARTDELAY, 'max start delay', 'max startdelay',
-                            'maxstart delay'), action=self._parse_setter(MAXSTARTDELAY))
+                            'maxstart delay'), action=_setter(MAXSTARTDELAY))
     gr_line = gr_line | np((MAXWAITTIME, 'max wait time', 'max waittime',
-                            'maxwait time'), action=self._parse_setter(MAXWAITTIME))
+                            'maxwait time'), action=_setter(MAXWAITTIME))
     gr_line = gr_line | np(
-        (REGEXWHERE, 'regex where'), action=self._parse_setter(REGEXWHERE))
+        (REGEXWHERE, 'regex where'), action=_setter(REGEXWHERE))
     gr_line = gr_line | np((RESCHEDULEINTERVAL, 're schedule interval', 're scheduleinterval',
-                            'reschedule interval'), action=self._parse_setter(RESCHEDULEINTERVAL))
-    gr_line = gr_line | np((RUN,), action=self._parse_setter(RUN))
+                            'reschedule interval'), action=_setter(RESCHEDULEINTERVAL))
+    gr_line = gr_line | np((RUN,), action=_setter(RUN))
     gr_line = gr_line | np(
-        (SPOOLSIZE, 'spool size'), action=self._parse_setter(SPOOLSIZE))
+        (SPOOLSIZE, 'spool size'), action=_setter(SPOOLSIZE))
     gr_line = gr_line | np(
-        (STRIPPREFIX, 'strip prefix'), action=self._parse_setter(STRIPPREFIX))
+        (STRIPPREFIX, 'strip prefix'), action=_setter(STRIPPREFIX))
     gr_line = gr_line | np(
-        (VERIFYJOB, 'verify job'), action=self._parse_setter(VERIFYJOB))
-    gr_line = gr_line | np((WHERE,), action=self._parse_setter(WHERE))
+        (VERIFYJOB, 'verify job'), action=_setter(VERIFYJOB))
+    gr_line = gr_line | np((WHERE,), action=_setter(WHERE))
     gr_line = gr_line | np((WRITEBOOTSTRAP, 'write boot strap', 'write bootstrap',
-                            'writeboot strap'), action=self._parse_setter(WRITEBOOTSTRAP))
+                            'writeboot strap'), action=_setter(WRITEBOOTSTRAP))
 
     # The ugliness that is run scripts
     gr_line = gr_line | np(PList('Run Before Job'), gr_stripped_string,
-                           action=self._parse_script(runsonclient=0, runswhen='Before'))
+                           action=_script(runsonclient=0, runswhen='Before'))
     gr_line = gr_line | np(PList('Run After Job'), gr_stripped_string,
-                           action=self._parse_script(runsonclient=0, runswhen='After'))
-    gr_line = gr_line | np(PList('Run After Failed Job'), gr_stripped_string, action=self._parse_script(runsonsuccess=0, runsonfailure=1,
-                                                                                                        runsonclient=0, runswhen='After'))
+                           action=_script(runsonclient=0, runswhen='After'))
+    gr_line = gr_line | np(PList('Run After Failed Job'), gr_stripped_string, action=_script(runsonsuccess=0, runsonfailure=1,
+                                                                                               runsonclient=0, runswhen='After'))
     gr_line = gr_line | np(PList('Client Run Before Job'),
-                           gr_stripped_string, action=self._parse_script(runswhen='Before'))
+                           gr_stripped_string, action=_script(runswhen='Before'))
     gr_line = gr_line | np(PList(
-        'Client Run After Job'), gr_stripped_string, action=self._parse_script(runswhen='After'))
+        'Client Run After Job'), gr_stripped_string, action=_script(runswhen='After'))
 
     # This is a complicated one
     gr_script_parts = np(
@@ -667,11 +1444,16 @@ def job_parse_string(self, string):
     gr_script_parts = gr_script_parts | np(
         PList('Fail Job On Error'), gr_yn, action=nullDebugAction)
     gr_script = ((Keyword('Run Script', caseless=True) | Keyword('RunScript', caseless=True)) +
-                 nestedExpr('{', '}', OneOrMore(gr_script_parts))).setParseAction(self._parse_script_full)
+                 nestedExpr('{', '}', OneOrMore(gr_script_parts))).setParseAction(_method('_parse_script_full'))
+
+    return OneOrMore(gr_line | gr_script)
 
-    gr_res = OneOrMore(gr_line | gr_script)
+
+def job_parse_string(self, string):
+    '''Parser for the Job resource.
+    '''
     try:
-        result = gr_res.parseString(string, parseAll=True)
+        result = parse_with(job_grammar(), self, string)
     except Exception as e:
         print(e)
         raise
@@ -689,58 +1471,63 @@ def messages_parse_string(self, string, obj=None):
     return retval
 
 
-def pool_parse_string(self, string):
-    '''Parse a tring into a Pool object.
+@_grammar
+def pool_grammar():
+    '''Grammar for the Pool resource.
     '''
-
-    gr_line = np((NAME,), action=lambda x: self.set_name(x[2]))
+    gr_line = np((NAME,), action=_set_name)
     gr_line = gr_line | np(
-        PList('pool type'), action=self._parse_setter(POOLTYPE))
+        PList('pool type'), action=_setter(POOLTYPE))
     gr_line = gr_line | np(
-        PList('maximum volumes'), action=self._parse_setter(MAXIMUMVOLUMES))
+        PList('maximum volumes'), action=_setter(MAXIMUMVOLUMES))
     gr_line = gr_line | np(
-        (STORAGE,), action=self._parse_setter(STORAGE_ID, dereference=True))
+        (STORAGE,), action=_setter(STORAGE_ID, dereference=True))
     gr_line = gr_line | np(
-        PList('use volume once'), gr_yn, action=self._parse_setter(USEVOLUMEONCE))
+        PList('use volume once'), gr_yn, action=_setter(USEVOLUMEONCE))
     gr_line = gr_line | np(
-        PList('catalog files'), gr_yn, action=self._parse_setter(CATALOGFILES))
+        PList('catalog files'), gr_yn, action=_setter(CATALOGFILES))
     gr_line = gr_line | np(
-        PList('auto prune'), gr_yn, action=self._parse_setter(AUTOPRUNE))
+        PList('auto prune'), gr_yn, action=_setter(AUTOPRUNE))
     gr_line = gr_line | np(
-        (RECYCLE,), gr_yn, action=self._parse_setter(RECYCLE))
+        (RECYCLE,), gr_yn, action=_setter(RECYCLE))
     gr_line = gr_line | np(PList('recycle oldest volume'),
-                           gr_yn, action=self._parse_setter(RECYCLEOLDESTVOLUME))
+                           gr_yn, action=_setter(RECYCLEOLDESTVOLUME))
     gr_line = gr_line | np(PList('recycle current volume'),
-                           gr_yn, action=self._parse_setter(RECYCLECURRENTVOLUME))
+                           gr_yn, action=_setter(RECYCLECURRENTVOLUME))
     gr_line = gr_line | np(PList('purge oldest volume'),
-                           gr_yn, action=self._parse_setter(PURGEOLDESTVOLUME))
+                           gr_yn, action=_setter(PURGEOLDESTVOLUME))
     gr_line = gr_line | np(PList(
-        'maximum volume jobs'), gr_number, action=self._parse_setter(MAXIMUMVOLUMEJOBS))
+        'maximum volume jobs'), gr_number, action=_setter(MAXIMUMVOLUMEJOBS))
     gr_line = gr_line | np(PList(
-        'maximum volume files'), gr_number, action=self._parse_setter(MAXIMUMVOLUMEFILES))
+        'maximum volume files'), gr_number, action=_setter(MAXIMUMVOLUMEFILES))
     gr_line = gr_line | np(
-        PList('maximum volume bytes'), action=self._parse_setter(MAXIMUMVOLUMEBYTES))
+        PList('maximum volume bytes'), action=_setter(MAXIMUMVOLUMEBYTES))
     gr_line = gr_line | np(
-        PList('volume use duration'), action=self._parse_setter(VOLUMEUSEDURATION))
+        PList('volume use duration'), action=_setter(VOLUMEUSEDURATION))
     gr_line = gr_line | np(
-        PList('volume retention'), action=self._parse_setter(VOLUMERETENTION))
+        PList('volume retention'), action=_setter(VOLUMERETENTION))
     gr_line = gr_line | np(
-        PList('action on purge'), action=self._parse_setter(ACTIONONPURGE))
+        PList('action on purge'), action=_setter(ACTIONONPURGE))
     gr_line = gr_line | np(
-        PList('scratch pool'), action=self._parse_setter(SCRATCHPOOL))
+        PList('scratch pool'), action=_setter(SCRATCHPOOL))
     gr_line = gr_line | np(
-        PList('recycle pool'), action=self._parse_setter(RECYCLEPOOL))
+        PList('recycle pool'), action=_setter(RECYCLEPOOL))
     gr_line = gr_line | np(
-        PList('file retention'), action=self._parse_setter(FILERETENTION))
+        PList('file retention'), action=_setter(FILERETENTION))
     gr_line = gr_line | np(
-        PList('job retention'), action=self._parse_setter(JOBRETENTION))
+        PList('job retention'), action=_setter(JOBRETENTION))
     gr_line = gr_line | np(
-        PList('cleaning prefix'), action=self._parse_setter(CLEANINGPREFIX))
+        PList('cleaning prefix'), action=_setter(CLEANINGPREFIX))
     gr_line = gr_line | np(
-        PList('label format'), action=self._parse_setter(LABELFORMAT))
+        PList('label format'), action=_setter(LABELFORMAT))
+
+    return OneOrMore(gr_line)
+
 
-    gr_res = OneOrMore(gr_line)
-    result = gr_res.parseString(string, parseAll=True)
+def pool_parse_string(self, string):
+    '''Parse a tring into a Pool object.
+    '''
+    result = parse_with(pool_grammar(), self, string)
     return 'Pool: ' + self[NAME]
 
 
@@ -775,65 +1562,65 @@ def schedule_parse_string(self, string):
     return "Schedule: " + self[NAME]
 
 
-def storage_parse_string(self, string):
-    '''Populate a new Storage from a string.
+@_grammar
+def storage_grammar():
+    '''Grammar for the Storage resource.
     '''
-
-    def _handle_addr(*x):
-        a, b, c = x[2]
-        self.set(SDADDRESSES, '  %s' % '\n  '.join(c))
-        return
-
-    gr_line = np((NAME,), action=lambda x: self.set_name(x[2]))
+    gr_line = np((NAME,), action=_set_name)
     gr_line = gr_line | np(
-        PList('sd port'), gr_number, action=self._parse_setter(SDPORT))
+        PList('sd port'), gr_number, action=_setter(SDPORT))
     gr_line = gr_line | np(
-        (ADDRESS, 'sd address', SDADDRESS), action=self._parse_setter(ADDRESS))
+        (ADDRESS, 'sd address', SDADDRESS), action=_setter(ADDRESS))
     gr_line = gr_line | np((PASSWORD,), action=lambda x: x)
-    gr_line = gr_line | np((DEVICE,), action=self._parse_setter(DEVICE))
+    gr_line = gr_line | np((DEVICE,), action=_setter(DEVICE))
     gr_line = gr_line | np(
-        PList('media type'), action=self._parse_setter(MEDIATYPE))
+        PList('media type'), action=_setter(MEDIATYPE))
     gr_line = gr_line | np(
-        PList('auto changer'), gr_yn, action=self._parse_setter(AUTOCHANGER))
+        PList('auto changer'), gr_yn, action=_setter(AUTOCHANGER))
     gr_line = gr_line | np(PList('maximum concurrent jobs'),
-                           gr_number, action=self._parse_setter(MAXIMUMCONCURRENTJOBS))
+                           gr_number, action=_setter(MAXIMUMCONCURRENTJOBS))
     gr_line = gr_line | np(
-        PList('allow compression'), gr_yn, action=self._parse_setter(ALLOWCOMPRESSION))
+        PList('allow compression'), gr_yn, action=_setter(ALLOWCOMPRESSION))
     gr_line = gr_line | np(
-        PList('heartbeat interval'), action=self._parse_setter(HEARTBEATINTERVAL))
+        PList('heartbeat interval'), action=_setter(HEARTBEATINTERVAL))
 
     gr_line = gr_line | np(
-        PList('working directory'), action=self._parse_setter(WORKINGDIRECTORY))
+        PList('working directory'), action=_setter(WORKINGDIRECTORY))
     gr_line = gr_line | np(
-        PList('pid directory'), action=self._parse_setter(PIDDIRECTORY))
+        PList('pid directory'), action=_setter(PIDDIRECTORY))
     gr_line = gr_line | np(
-        PList('client connect wait'), action=self._parse_setter(CLIENTCONNECTWAIT))
+        PList('client connect wait'), action=_setter(CLIENTCONNECTWAIT))
 
-    # This is a complicated one
-    da_addr = np(
-        ('Addr', 'Port'), Word(printables), lambda x, y, z: ' '.join(z))
-    da_ip = np(('IPv4', 'IPv6', 'IP'), nestedExpr('{', '}', OneOrMore(
-        da_addr).setParseAction(lambda x, y, z: ' ; '.join(z)))).setParseAction(handle_ip)
-    da_addresses = np(PList('sd addresses'), nestedExpr(
-        '{', '}', OneOrMore(da_ip)), _handle_addr)
+    da_addresses = _ip_addresses(PList('sd addresses'), SDADDRESSES)
 
-    gr_res = OneOrMore(gr_line)
-    result = gr_res.parseString(string, parseAll=True)
+    return OneOrMore(gr_line)
+
+
+def storage_parse_string(self, string):
+    '''Populate a new Storage from a string.
+    '''
+    result = parse_with(storage_grammar(), self, string)
     return 'Storage: ' + self[NAME]
 
 
-def counter_parse_string(self, string):
-    '''Parser for the Counter resource.
+@_grammar
+def counter_grammar():
+    '''Grammar for the Counter resource.
     '''
-    gr_line = np((NAME,), action=lambda x: self.set_name(x[2]))
-    gr_line = gr_line | np((MINIMUM,), action=self._parse_setter(MINIMUM))
-    gr_line = gr_line | np((MAXIMUM,), action=self._parse_setter(MAXIMUM))
+    gr_line = np((NAME,), action=_set_name)
+    gr_line = gr_line | np((MINIMUM,), action=_setter(MINIMUM))
+    gr_line = gr_line | np((MAXIMUM,), action=_setter(MAXIMUM))
     gr_line = gr_line | np(
-        PList('wrap counter'), action=self._parse_setter(COUNTER_ID, dereference=True))
+        PList('wrap counter'), action=_setter(COUNTER_ID, dereference=True))
     gr_line = gr_line | np(
-        (CATALOG,), action=self._parse_setter(CATALOG_ID, dereference=True))
-    gr_res = OneOrMore(gr_line)
-    result = gr_res.parseString(string, parseAll=True)
+        (CATALOG,), action=_setter(CATALOG_ID, dereference=True))
+    return OneOrMore(gr_line)
+
+
+def counter_parse_string(self, string):
+    '''Parser for the Counter resource.
+    '''
+    result = parse_with(counter_grammar(), self, string)
     return 'Counter: ' + self[NAME]
 
 
@@ -866,9 +1653,44 @@ def setup_for_parsing():
     pass
 
 
-def parser(string, output=print):
+# The resources parsed with a grammar (see StanzaRecord.preparse)
+GRAMMARS = {
+    bacula_tools.Catalog: catalog_grammar,
+    bacula_tools.Client: client_grammar,
+    bacula_tools.Console: console_grammar,
+    bacula_tools.Device: device_grammar,
+    bacula_tools.Director: director_grammar,
+    bacula_tools.Fileset: fileset_grammar,
+    bacula_tools.Job: job_grammar,
+    bacula_tools.Pool: pool_grammar,
+    bacula_tools.Storage: storage_grammar,
+    bacula_tools.Counter: counter_grammar,
+}
+
+
+def grammar_for(name):
+    '''Find the grammar function for a resource type, or None if it doesn't
+    have one.'''
+    kls = bacula_tools._DISPATCHER.get(name)
+    for kls in getattr(kls, '__mro__', ()):
+        if kls in GRAMMARS:
+            return GRAMMARS[kls]
+    return None
+
+
+def parser(string, output=print, bulk=False, commit_every=None, includes=None,
+           fingerprints=None):
     '''This is the primary entry point for the parser.  Call it with a string
-    and a function to be called for ouput.'''
+    (or an open file) and a function to be called for ouput.  See
+    StringParseSupport for bulk, commit_every, includes and fingerprints.'''
     setup_for_parsing()
-    p = StringParseSupport(output)
+    p = StringParseSupport(output, bulk, commit_every, includes, fingerprints)
     return p.parse_it_all(string)
+
+
+def parse_records(records, output=print, bulk=False, commit_every=None,
+                  fingerprints=None):
+    '''Like parser(), but for the StanzaRecords produced by preparse_file().'''
+    setup_for_parsing()
+    p = StringParseSupport(output, bulk, commit_every, fingerprints=fingerprints)
+    return p.parse_records(records)
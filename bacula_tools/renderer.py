@@ -0,0 +1,344 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+'''Single-pass generation of a Director's configuration.
+
+The naive way of writing out bacula-dir.conf is to look up the id of every
+resource and then instantiate (and search for) each one in turn, with each
+__str__ then looking up its foreign keys and passwords.  That adds up to
+several queries per Job, which gets painful with thousands of them.
+
+DirectorRenderer instead loads every table it needs with a handful of bulk
+queries, primes the identity map with the results (see
+Bacula_Config.resource_cache), loads all of the director's passwords in one
+go (see PasswordStore.Matrix), and then emits the configuration from memory.
+
+Given a FragmentCache, it also keeps the text of each resource from one run
+to the next, and only renders the resources whose rows, or any of the rows
+they refer to, have changed.
+'''
+from __future__ import print_function, absolute_import
+import os
+import hashlib
+import pickle
+import bacula_tools
+import logging
+logger = logging.getLogger(__name__)
+
+# The tables that each kind of configuration is generated from (see
+# Bacula_Config.config_stamp).
+_MESSAGES_TABLES = ['messages', 'messages_link']
+_PASSWORD_TABLES = ['pwords', 'directors', 'consoles']
+CONFIG_TABLES = {
+    bacula_tools.DIRECTOR: ['catalogs', 'clients', 'counters', 'device', 'device_link',
+                            'fileset_files', 'fileset_link', 'filesets', 'job_scripts',
+                            'jobs', 'pools', 'schedule_link', 'schedule_time',
+                            'schedules', 'scripts', 'storage'] + _MESSAGES_TABLES + _PASSWORD_TABLES,
+    bacula_tools.FD: ['clients'] + _MESSAGES_TABLES + _PASSWORD_TABLES,
+    bacula_tools.SD: ['storage', 'device', 'device_link'] + _MESSAGES_TABLES + _PASSWORD_TABLES,
+    bacula_tools.BCONSOLE: _PASSWORD_TABLES,
+}
+
+
+def _canonical(value):
+    '''value with every dict turned into a sorted list of items, so that its
+    repr() can be fingerprinted.'''
+    if isinstance(value, dict):
+        return sorted((x, _canonical(value[x])) for x in value)
+    if isinstance(value, (list, tuple)):
+        return [_canonical(x) for x in value]
+    return value
+
+
+class FragmentCache(object):
+
+    '''The rendered text of individual resources, saved (as a pickle) between
+    runs.  Each is keyed by (table, id) and stored along with a fingerprint of
+    everything that went into rendering it; if the fingerprint has changed
+    by the next run, the resource is rendered again.
+
+    save() only keeps the fragments that were used since the cache was
+    loaded, so deleted resources don't pile up.
+
+    '''
+    VERSION = 1                 # Bump this if the rendering code changes
+
+    def __init__(self, filename=None, fresh=False):
+        '''If fresh is True, whatever was saved last time is ignored (and then
+        replaced by save()).'''
+        object.__init__(self)
+        self.filename = filename
+        self.fragments = {}
+        self.used = set()
+        self.hits = 0
+        self.misses = 0
+        if not fresh:
+            self.load()
+        return
+
+    def load(self):
+        '''Read the fragments saved by the last run, if there are any.'''
+        if not self.filename:
+            return self
+        try:
+            with open(self.filename, 'rb') as f:
+                version, fragments = pickle.load(f)
+        except Exception as e:
+            logger.debug('FragmentCache: not using %s: %s', self.filename, e)
+            return self
+        if version == self.VERSION:
+            self.fragments = fragments
+        return self
+
+    def get(self, key, fingerprint, render):
+        '''The text for key if it was rendered from the same fingerprint,
+        otherwise whatever render() returns (which is then cached).'''
+        self.used.add(key)
+        found = self.fragments.get(key)
+        if found and found[0] == fingerprint:
+            self.hits += 1
+            return found[1]
+        self.misses += 1
+        text = render()
+        self.fragments[key] = (fingerprint, text)
+        return text
+
+    def save(self):
+        '''Write out the fragments used since the cache was loaded.'''
+        if not self.filename:
+            return
+        fragments = dict((x, self.fragments[x]) for x in self.used)
+        with open(self.filename + '.new', 'wb') as f:
+            pickle.dump((self.VERSION, fragments), f, pickle.HIGHEST_PROTOCOL)
+        os.rename(self.filename + '.new', self.filename)
+        logger.debug('FragmentCache: %d hits, %d misses', self.hits, self.misses)
+        return
+
+
+class DirectorRenderer(object):
+
+    '''Render the configuration for a single Director.  Instantiate with the name
+    or ID of the Director, then call write() with something that behaves like
+    a ConfigFile, or render() to get the whole thing as a string.
+
+    This must be used inside Bacula_Config.resource_cache(), otherwise the
+    foreign key lookups done by the resources themselves will all go to the
+    database.
+
+    '''
+    bc = bacula_tools.Bacula_Factory()
+
+    def __init__(self, director, cache=None):
+        '''cache is an optional FragmentCache.'''
+        object.__init__(self)
+        self.director = bacula_tools.Director().search(director)
+        self.cache = cache
+        self.sections = None
+        self.rows = {}
+        return
+
+    def load(self):
+        '''Fetch everything that goes into the configuration.  The number of
+        queries is fixed, regardless of the number of resources.'''
+        director_id = self.director[bacula_tools.ID]
+        if not director_id:
+            return bacula_tools.die('No such director: %s' % self.director[bacula_tools.NAME])
+        catalogs = bacula_tools.Catalog.Find(director_id=director_id)
+        messages = bacula_tools.Messages.Find(
+            order_by=bacula_tools.NAME,
+            explicit_where='id IN (SELECT messages_id FROM messages_link'
+            ' WHERE ref_id = %d AND link_type = %d)' % (director_id, self.director.IDTAG))
+        filesets = bacula_tools.Fileset.Find(order_by=bacula_tools.NAME)
+        schedules = bacula_tools.Schedule.Find(order_by=bacula_tools.NAME)
+        clients = bacula_tools.Client.Find(order_by=bacula_tools.NAME)
+        jobdefs = bacula_tools.JobDef.Find(order_by=bacula_tools.NAME, jobdef=1)
+        jobs = bacula_tools.Job.Find(
+            order_by=bacula_tools.NAME, explicit_where='NOT jobdef=1 OR jobdef IS NULL')
+        storage = bacula_tools.Storage.Find(order_by=bacula_tools.NAME)
+        pools = bacula_tools.Pool.Find(order_by=bacula_tools.NAME)
+        consoles = bacula_tools.Console.Find(order_by=bacula_tools.NAME)
+        counters = bacula_tools.Counter.Find(order_by=bacula_tools.NAME)
+        # Clients, Storage and Consoles need to know which Director they are
+        # being written out for, so they can include the right password.
+        passwords = bacula_tools.PasswordStore.Matrix(directors=[self.director])
+        for obj in clients + storage + consoles:
+            obj.director_id = director_id
+            obj.passwords = passwords
+        # Any other Messages referenced by name (e.g. by Jobs) will be looked
+        # up, once, as needed.
+        self.sections = [[self.director], catalogs, messages, filesets,
+                         schedules, clients, jobdefs, jobs, storage, pools,
+                         consoles, counters]
+        if self.cache != None:
+            self.load_references()
+        return self
+
+    def references(self, obj):
+        '''The (table, id) of every row that obj refers to.'''
+        for key in sorted(obj):
+            if not key.endswith('_id') or not obj[key]:
+                continue
+            try:
+                yield obj._fk_class(key).table, obj[key]
+            except KeyError:
+                pass            # Not a reference to another resource
+        return
+
+    def load_references(self):
+        '''Index every row we have by (table, id), then fetch any referred-to
+        rows that we don't have (e.g. Messages used by Jobs) with one query
+        per table.  They go into the fragment fingerprints.'''
+        for section in self.sections:
+            for obj in section:
+                self.rows[(obj.table, obj[bacula_tools.ID])] = obj
+        missing = {}
+        for section in self.sections:
+            for obj in section:
+                for table, id in self.references(obj):
+                    if not (table, id) in self.rows:
+                        missing.setdefault(table, set()).add(id)
+        for table, ids in missing.items():
+            sql = 'SELECT * FROM %s WHERE id IN (%s)' % (
+                table, bacula_tools.placeholders(len(ids)))
+            for row in self.bc.do_sql(sql, tuple(sorted(ids)), asdict=True):
+                self.rows[(table, row[bacula_tools.ID])] = row
+        return
+
+    def fingerprint(self, obj):
+        '''A hash of everything that goes into rendering obj: its row, anything
+        loaded by its _load_ hooks, the rows it refers to and its password.'''
+        parts = [obj.__class__.__name__, self.director[bacula_tools.ID],
+                 _canonical(obj),
+                 [_canonical(getattr(obj, x)) for x in obj.CACHED_ATTRIBUTES],
+                 [_canonical(self.rows.get(x)) for x in self.references(obj)]]
+        if getattr(obj, 'passwords', None) != None:
+            parts.append(obj.passwords.password(obj, self.director))
+        return hashlib.sha1(repr(parts)).hexdigest()
+
+    def fragment(self, obj):
+        '''The text for one resource, from the cache if possible.  The Director
+        itself is always rendered, as it's only the one resource.'''
+        if self.cache == None or obj is self.director:
+            return str(obj)
+        return self.cache.get((obj.table, obj[bacula_tools.ID]),
+                              self.fingerprint(obj), lambda: str(obj))
+
+    def write(self, output):
+        '''Write each resource to output, which should have the same interface
+        as ConfigFile.  The output is the same as render().'''
+        if self.sections == None:
+            self.load()
+        for section in self.sections:
+            for obj in section:
+                output.write(self.fragment(obj), '\n')
+        return
+
+    def render(self):
+        '''Return the entire configuration as a string.'''
+        if self.sections == None:
+            self.load()
+        result = []
+        for section in self.sections:
+            result.extend([self.fragment(obj) + '\n\n\n' for obj in section])
+        return ''.join(result)
+
+
+class DaemonRenderer(object):
+
+    '''Render the configuration for every File Daemon (kind is FD) or Storage
+    Daemon (kind is SD) in one go.  Everything is loaded with a fixed number
+    of bulk queries: the Clients/Storage, every shared password, the
+    Directors and Consoles, the Messages links (and for SD, the Devices).
+
+    Iterate over it to get a (Client/Storage, [fragment, ...]) pair for each
+    daemon.  The fragments are in the same order as generate_configuration
+    writes them for a single host.  Like DirectorRenderer, this must be
+    used inside Bacula_Config.resource_cache().
+
+    '''
+    bc = bacula_tools.Bacula_Factory()
+
+    def __init__(self, kind, daemons=None):
+        '''daemons limits the rendering to a list of Clients/Storage.'''
+        object.__init__(self)
+        self.kind = kind
+        if kind == bacula_tools.FD:
+            self.daemon_class, self.link_key = bacula_tools.Client, bacula_tools.CLIENT_ID
+        else:
+            self.daemon_class, self.link_key = bacula_tools.Storage, bacula_tools.STORAGE_ID
+        self.daemons = daemons
+        self.loaded = False
+        return
+
+    def load(self):
+        '''Fetch everything that goes into the configurations.'''
+        # Only fetch the links for the daemons we were given, if any
+        messages_where = devices_where = ''
+        if self.daemons == None:
+            self.daemons = self.daemon_class.Find(order_by=bacula_tools.NAME)
+        elif self.daemons:
+            ids = ','.join(str(int(x[bacula_tools.ID])) for x in self.daemons)
+            messages_where = ' AND ref_id IN (%s)' % ids
+            devices_where = ' WHERE storage_id IN (%s)' % ids
+        self.loaded = True
+        self.passwords = bacula_tools.PasswordStore.Matrix(objects=self.daemons)
+        # Who shares a password with each daemon, without scanning the whole
+        # matrix for every one of them.
+        self.holders = {}
+        for key in sorted(self.passwords):
+            self.holders.setdefault(key[:2], []).append(key[2:])
+        self.directors = {}
+        for kind in [bacula_tools.Director, bacula_tools.Console]:
+            for obj in kind.Find(order_by=bacula_tools.ID):
+                obj.passwords = self.passwords
+                self.directors[(obj[bacula_tools.ID], kind.IDTAG)] = obj
+        self.messages = self._linked(
+            bacula_tools.Messages,
+            'SELECT ref_id, messages_id FROM messages_link'
+            '  WHERE link_type = %s' + messages_where + ' ORDER BY id',
+            self.daemon_class.IDTAG)
+        self.devices = {}
+        if self.kind == bacula_tools.SD:
+            self.devices = self._linked(
+                bacula_tools.Device,
+                'SELECT storage_id, device_id FROM device_link' + devices_where +
+                ' ORDER BY id')
+        return self
+
+    def _linked(self, kls, sql, *args):
+        '''Load every kls that sql links to a daemon, returning
+        {daemon id: [kls, ...]}.'''
+        links = self.bc.do_sql(sql, args or None)
+        ids = sorted(set(x[1] for x in links))
+        if not ids:
+            return {}
+        found = dict((x[bacula_tools.ID], x) for x in kls.Find(
+            explicit_where='id IN (%s)' % ','.join(str(int(x)) for x in ids)))
+        result = {}
+        for daemon_id, other_id in links:
+            if other_id in found:
+                result.setdefault(daemon_id, []).append(found[other_id])
+        return result
+
+    def render(self, daemon):
+        '''The fragments that make up one daemon's configuration.'''
+        method = self.kind.lower()
+        daemon_id = daemon[bacula_tools.ID]
+        result = [getattr(daemon, method)()]
+        holders = self.holders.get(bacula_tools.PasswordStore.key(daemon), [])
+        for kind in [bacula_tools.Director, bacula_tools.Console]:
+            for key in holders:
+                if key[1] != kind.IDTAG or not key in self.directors:
+                    continue
+                obj = self.directors[key]
+                setattr(obj, self.link_key, daemon_id)
+                result.append(getattr(obj, method)())
+        result.extend(str(x) for x in self.devices.get(daemon_id, []))
+        result.extend(str(x) for x in self.messages.get(daemon_id, []))
+        return result
+
+    def __iter__(self):
+        if not self.loaded:
+            self.load()
+        for daemon in self.daemons:
+            yield daemon, self.render(daemon)
+        return
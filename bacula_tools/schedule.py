@@ -1,12 +1,14 @@
 #! /usr/bin/env python
 # -*- coding: utf-8 -*-
 from __future__ import print_function, absolute_import
-from bacula_tools import (DATA, DbDict, ID, SCHEDULE, SCHEDULE_TIME, SCHEDULES)
+from bacula_tools import (DATA, DbDict, ID, SCHEDULE, SCHEDULE_TIME, SCHEDULES,
+                          placeholders)
 import optparse
 
 
 class Schedule(DbDict):
     table = SCHEDULES
+    CACHED_ATTRIBUTES = ['entries']
 
     def __init__(self, row={}, string=None):
         '''Overrides DbDice.__init__ to ensure each instance has a clean entries member.'''
@@ -17,6 +19,7 @@ class Schedule(DbDict):
     def _add_run(self, run):
         '''Add a schedule line for when jobs should run.'''
         new_run = self.bc.value_ensure(SCHEDULE_TIME, DATA, run)[0]
+        self._cache_invalidate()
         self.entries.append(new_run)
         row = self.bc.do_sql(
             'SELECT * FROM schedule_link WHERE scheduleid = %s AND timeid = %s', (self[ID], new_run[0]))
@@ -32,6 +35,7 @@ class Schedule(DbDict):
                 continue
             self.bc.do_sql(
                 'DELETE FROM schedule_link WHERE scheduleid = %s AND timeid = %s', (self[ID], row[0]))
+            self._cache_invalidate()
             self.entries.remove(row)
             return
         print('I cannot delete Run entries that do not exist!')
@@ -51,6 +55,18 @@ class Schedule(DbDict):
                                            WHERE a.scheduleid = %s AND a.timeid = b.id''', (self[ID],)))
         return self
 
+    @classmethod
+    def _bulk_load_runs(kls, schedules):
+        '''Bulk version of _load_runs(), used by Find().'''
+        by_id = dict((schedule[ID], schedule) for schedule in schedules)
+        for schedule in schedules:
+            schedule.entries = []
+        sql = '''SELECT a.scheduleid, b.id AS id, b.data AS data FROM schedule_link a, schedule_time b
+                 WHERE a.scheduleid IN (%s) AND a.timeid = b.id''' % placeholders(len(by_id))
+        for row in kls.bc.do_sql(sql, tuple(by_id)):
+            by_id[row[0]].entries.append(row[1:])
+        return
+
     def _cli_special_setup(self):
         '''Add CLI options for adding and removing run lines.'''
         group = optparse.OptionGroup(self.parser,
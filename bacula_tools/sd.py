@@ -6,9 +6,10 @@ class SDaemon(BSock):
     '''Client for communicating directly with a storage daemon.
     '''
 
-    def __init__(self, address, password, myname, port=BACULA_SD_PORT, timeout=5):
+    def __init__(self, address, password, myname, port=BACULA_SD_PORT, timeout=5,
+                 deadline=None):
         BSock.__init__(self, address, password, 'SD: Bacula Director ' + myname,
-                       port, timeout)
+                       port, timeout, deadline)
         return
 
     def version(self):
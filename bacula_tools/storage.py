@@ -26,7 +26,8 @@ class Storage(bacula_tools.DbDict):
         self.output = ['Storage {\n  Name = "%(name)s"' % self, '}']
         if getattr(self, bacula_tools.DIRECTOR_ID, None):
             a = bacula_tools.PasswordStore(
-                self, bacula_tools.Director().search(self.director_id))
+                self, bacula_tools.Director().search(self.director_id),
+                self.passwords)
             if getattr(a, bacula_tools.PASSWORD, None):
                 self.output.insert(-1, '  Password = "%s"' % a.password)
 
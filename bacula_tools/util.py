@@ -10,11 +10,13 @@ import logging
 
 # Extra stuff needed for the console/daemon tools
 import socket
+import asyncore
 import hmac
 import base64
 import hashlib
 import time
 from random import randint
+from contextlib import contextmanager
 from struct import pack, unpack
 
 os_bits = {
@@ -155,6 +157,12 @@ def find_client(bacula_config_object, guest, director='', **kwargs):
     return client
 
 
+def placeholders(count):
+    '''Returns a string of count comma-separated %s markers, suitable for
+    building an IN (...) clause.'''
+    return ','.join(['%s'] * count)
+
+
 class ConfigFile(object):
 
     '''Easy config file management wrapper.
@@ -166,13 +174,28 @@ class ConfigFile(object):
     you drive processes like "restart bacula-sd if the config file
     changes".
 
+    If given a stamp (see Bacula_Config.config_stamp), it is saved in
+    filename.stamp on close, and current() can then be used next time to
+    skip generating the file at all if the database hasn't changed.
+
     '''
     FILEHEADER = "# This config file generated by %s script.\n#\n#DO NOT EDIT THIS FILE BY HAND\n\n" % sys.argv[
         0]
 
-    def __init__(self, filename):
+    @staticmethod
+    def current(filename, stamp):
+        '''True if filename exists and was generated at stamp.'''
+        try:
+            with open(filename + '.stamp') as f:
+                recorded = f.read().strip()
+        except IOError:
+            return False
+        return recorded == str(stamp) and os.path.exists(filename)
+
+    def __init__(self, filename, stamp=None):
         object.__init__(self)
         self.filename = filename
+        self.stamp = stamp
         self.newfilename = filename + '.new'
         self.fh = open(self.newfilename, 'w')
         self.fh.write(self.FILEHEADER)
@@ -193,10 +216,13 @@ class ConfigFile(object):
         if test_value:
             os.unlink(self.newfilename)
             logging.debug("\t%s doesn't need to be updated", self.filename)
-            return False
-        logging.debug("\tupdating %s", self.filename)
-        os.rename(self.newfilename, self.filename)
-        return True
+        else:
+            logging.debug("\tupdating %s", self.filename)
+            os.rename(self.newfilename, self.filename)
+        if self.stamp != None:
+            with open(self.filename + '.stamp', 'w') as f:
+                f.write('%s\n' % self.stamp)
+        return not test_value
 
     def write(self, *data):
         '''Write data out, with newlines after each item.'''
@@ -206,44 +232,141 @@ class ConfigFile(object):
         return
 
 
+class PasswordMatrix(dict):
+
+    '''A lookup table of passwords, as returned by PasswordStore.Matrix().  Keys
+    are the same (obj_id, obj_type, director_id, director_type) tuples that
+    PasswordStore uses to identify a row, values are the passwords.'''
+
+    def password(self, obj1, obj2):
+        '''Returns the password shared by obj1 (a Client/Storage) and obj2 (a
+        Director/Console), or None.'''
+        return self.get(PasswordStore.key(obj1, obj2))
+
+    def directors(self, obj):
+        '''Returns a sorted list of (director_id, director_type, password) for
+        every Director/Console that shares a password with obj.'''
+        obj_key = PasswordStore.key(obj)
+        return sorted(x[2:] + (self[x],) for x in self if x[:2] == obj_key)
+
+    def objects(self, director):
+        '''Returns a sorted list of (obj_id, obj_type, password) for every
+        Client/Storage that shares a password with director.'''
+        director_key = PasswordStore.key(director)
+        return sorted(x[:2] + (self[x],) for x in self if x[2:] == director_key)
+
+
 class PasswordStore(object):
 
     '''Client resources have passwords associated.  This class helps manage
-    that.  Instantiate with two objects: a Client/Storage and a Director/Console.'''
+    that.  Instantiate with two objects: a Client/Storage and a Director/Console.
+
+    When dealing with more than a handful of objects, use Matrix() and
+    store_many() instead, which do all of their work in a single query.'''
     bc = bacula_tools.Bacula_Factory()
     table = 'pwords'
     _where = 'where obj_id = %s and obj_type = %s and director_id = %s and director_type = %s'
     _select = 'SELECT * FROM %s %s'
-    _insert = 'INSERT INTO %s (obj_id, obj_type, director_id, director_type, password) values (%%s, %%s, %%s, %%s, %%s)'
-    _update = 'UPDATE %s set password=%%s %s'
+    _columns = '(obj_id, obj_type, director_id, director_type)'
+    _upsert = '''INSERT INTO %s (obj_id, obj_type, director_id, director_type, password)
+                 VALUES %s ON DUPLICATE KEY UPDATE password = VALUES(password)'''
     _delete = 'DELETE FROM %s %s'
 
-    def __init__(self, obj1, obj2):
-        '''Store references to the two objects associated with this password'''
+    def __init__(self, obj1, obj2, matrix=None):
+        '''Store references to the two objects associated with this password.  If
+        a PasswordMatrix is given, the password is taken from it rather than
+        loaded from the database.'''
         object.__init__(self)
-        self.where_arguments = (
-            int(obj1[bacula_tools.ID]), obj1.IDTAG, int(obj2[bacula_tools.ID]), obj2.IDTAG)
-        self.load()
+        self.where_arguments = self.key(obj1, obj2)
+        if matrix == None:
+            self.load()
+        else:
+            self.password = matrix.get(self.where_arguments)
         return
 
+    @staticmethod
+    def key(*objects):
+        '''The (id, IDTAG) pairs of the given objects, as a single tuple.'''
+        result = ()
+        for obj in objects:
+            result += (int(obj[bacula_tools.ID]), int(obj.IDTAG))
+        return result
+
+    @classmethod
+    def Matrix(kls, objects=[], directors=[]):
+        '''Load every password shared between any of the objects
+        (Clients/Storage) and any of the directors (Directors/Consoles) with a
+        single query, returning a PasswordMatrix.  If either list is empty, it
+        is not used as a constraint, so Matrix(directors=[d]) returns all of
+        the passwords for d.'''
+        conditions = []
+        args = []
+        for columns, things in (('(obj_id, obj_type)', objects),
+                                ('(director_id, director_type)', directors)):
+            if not things:
+                continue
+            conditions.append('%s IN (%s)' % (
+                columns, ','.join(['(%s, %s)'] * len(things))))
+            args.extend(kls.key(*things))
+        sql = 'SELECT obj_id, obj_type, director_id, director_type, password FROM %s' % kls.table
+        if conditions:
+            sql += ' WHERE ' + ' AND '.join(conditions)
+        result = PasswordMatrix()
+        for row in kls.bc.do_sql(sql, tuple(args)):
+            result[tuple([int(x) for x in row[:4]])] = row[4]
+        return result
+
+    @classmethod
+    def store_many(kls, items):
+        '''Write a number of passwords at once.  items is a list of (obj1, obj2,
+        password) tuples, with the same meanings as for store(): a password
+        of GENERATE gets a new random password, and None removes the row.'''
+        return kls._store_rows([kls.key(x[0], x[1]) + (x[2],) for x in items])
+
+    @classmethod
+    def _store_rows(kls, rows):
+        '''Does the work for store() and store_many(): one multi-row upsert, and
+        one multi-row delete.  Returns the list of rows actually written.'''
+        upserts = []
+        deletes = []
+        for row in rows:
+            key, password = row[:4], row[4]
+            if password == bacula_tools.GENERATE:
+                password = generate_password()
+            if password:
+                upserts.append(key + (password,))
+            else:
+                deletes.append(key)
+        if upserts:
+            sql = kls._upsert % (
+                kls.table, ','.join(['(%s, %s, %s, %s, %s)'] * len(upserts)))
+            kls.bc.do_sql(sql, tuple(sum(upserts, ())))
+        if deletes:
+            where = 'WHERE %s IN (%s)' % (
+                kls._columns, ','.join(['(%s, %s, %s, %s)'] * len(deletes)))
+            kls.bc.do_sql(kls._delete % (kls.table, where), tuple(sum(deletes, ())))
+        return upserts
+
     @classmethod
     def Find(kls, obj, director_type=False):
         '''Find all of the password related to a particular object.'''
         if director_type:
-            sql = 'SELECT obj_id, obj_type from %s where director_id = %%s and director_type = %%s'
+            matrix = kls.Matrix(directors=[obj])
+            others = matrix.objects(obj)
         else:
-            sql = 'SELECT director_id, director_type from %s where obj_id = %%s and obj_type = %%s'
+            matrix = kls.Matrix(objects=[obj])
+            others = matrix.directors(obj)
         result = []
 
         class FauxDict(dict):
             IDTAG = 0
-        for row in kls.bc.do_sql(sql % kls.table, (obj[bacula_tools.ID], obj.IDTAG)):
+        for row in others:
             o = FauxDict()
-            o[bacula_tools.ID], o.IDTAG = row
+            o[bacula_tools.ID], o.IDTAG = row[:2]
             if director_type:
-                result.append(kls(o, obj))
+                result.append(kls(o, obj, matrix))
             else:
-                result.append(kls(obj, o))
+                result.append(kls(obj, o, matrix))
         return result
 
     def load(self):
@@ -258,20 +381,9 @@ class PasswordStore(object):
 
     def store(self):
         '''Write the data out to the database'''
-        if self.password == bacula_tools.GENERATE:
-            self.password = generate_password()
-        if not self.password:
-            sql = self._delete % (self.table, self._where)
-            self.bc.do_sql(sql, self.where_arguments)
-            return
-        values = (self.password,)
-        try:
-            sql = self._insert % self.table
-            self.bc.do_sql(sql, self.where_arguments + values)
-            # self.bc.do_sql('commit')
-        except Exception as e:
-            sql = self._update % (self.table, self._where)
-            self.bc.do_sql(sql, values + self.where_arguments)
+        written = self._store_rows([self.where_arguments + (self.password,)])
+        if written:
+            self.password = written[0][4]
         return
 
 
@@ -291,12 +403,20 @@ class DbDict(dict):
     # This needs to be overridden in every subclass, before calling __init__
     table = 'override me'
     IDTAG = 0                   # Only used for director/client/storage objects
+    # Attributes filled in by the _load_ hooks that the identity map should
+    # remember along with the row itself.
+    CACHED_ATTRIBUTES = []
+    # A PasswordMatrix that, if set, is used instead of querying for the
+    # passwords of Clients and Storage when generating configurations.
+    passwords = None
 
     def __init__(self, row={}, string=None, **kwargs):
         '''Sets up instance variables and initializes the key/value pairs.
         If a row is passed in, update they keystore with it.
         If a string is passed in, it will be parsed via pyparsing.
         kwargs is *also* used for updating key/value pairs.'''
+        self._dirty = set()             # keys changed since the last save
+        self._batch_depth = 0           # see batch()
         dict.__init__(self)
         self.parser = None
         self.special = None
@@ -323,24 +443,79 @@ class DbDict(dict):
         self.word = self.table
         if self.word[-1] == 's':
             self.word = self.word[:-1]
+        self._dirty.clear()
+        return
+
+    def __setitem__(self, key, value):
+        '''Keep track of which keys have been changed, so that _save() only has
+        to write those.  Note that dict.update() does *not* go through here,
+        which is what we want when loading rows from the database.'''
+        dict.__setitem__(self, key, value)
+        self._dirty.add(key)
+        return
+
+    def _apply_row(self, row):
+        '''Update ourself from a database row, without losing any changes that
+        have not yet been saved (e.g. inside a batch()).'''
+        pending = dict((x, self[x]) for x in self._dirty if x in self)
+        self.update(row)
+        self.update(pending)
         return
 
+    @contextmanager
+    def batch(self):
+        '''Defer saving until the end of a block, so that any number of set()
+        calls result in a single UPDATE of just the changed columns:
+
+            with job.batch():
+                job.set(...)
+                job.set(...)
+
+        Batches may be nested; the save happens when the outermost one exits,
+        even if it exits with an exception, just as if each set() had saved
+        immediately.'''
+        self._batch_depth += 1
+        try:
+            yield self
+        finally:
+            self._batch_depth -= 1
+            if not self._batch_depth and self._dirty:
+                self._save()
+
     @classmethod
     def Find(kls, order_by=None, explicit_where=None, **kwargs):
         '''This factory function should be available in all sub-classes as a
         relatively easy way to get a list of all instances which meet a simple
-        criteria.'''
-        sql = 'SELECT id from %s' % kls.table
-        args = []
+        criteria.
+
+        All of the matching rows are fetched with a single query and the
+        objects are built directly from them.  The _load_ hooks are then run
+        once for the whole result set (see _run_bulk_load_hooks), so the
+        number of queries depends on the number of hooks rather than on
+        the number of rows.'''
+        keys = sorted(kwargs)
+        args = [kwargs[key] for key in keys if not kwargs[key] == None]
+        sql = kls.bc.sql_cache.sql(
+            (kls.table, 'Find', order_by, explicit_where) +
+            tuple((key, kwargs[key] == None) for key in keys),
+            lambda: kls._find_sql(keys, kwargs, order_by, explicit_where))
+        result = [kls(row)
+                  for row in kls.bc.do_sql(sql, tuple(args), asdict=True)]
+        kls._run_bulk_load_hooks(result)
+        [x._cache_store() for x in result]
+        return result
+
+    @classmethod
+    def _find_sql(kls, keys, kwargs, order_by, explicit_where):
+        '''Builds the SQL used by Find().'''
+        sql = 'SELECT * from %s' % kls.table
         where = []
-        if kwargs:
-            for key in kwargs:
-                value = kwargs[key]
-                if value == None:
-                    where.append('`%s` is NULL' % key)
-                else:
-                    where.append('`%s` like %%s' % key)
-                    args.append(value)
+        for key in keys:
+            if kwargs[key] == None:
+                where.append('`%s` is NULL' % key)
+            else:
+                where.append('`%s` like %%s' % key)
+        if where:
             sql += ' WHERE ' + ' AND '.join(where)
         if explicit_where:
             if 'WHERE' in sql:
@@ -349,10 +524,68 @@ class DbDict(dict):
                 sql += ' WHERE ' + explicit_where
         if order_by:
             sql += ' ORDER BY %s' % order_by
-        result = []
-        for row in kls.bc.do_sql(sql, tuple(args)):
-            result.append(kls().search(row[0]))
-        return result
+        return sql
+
+    @classmethod
+    def _hook_names(kls):
+        '''Names of all of the _load_ hooks defined for this class.'''
+        return [x for x in dir(kls) if x.startswith('_load_')]
+
+    @classmethod
+    def _run_bulk_load_hooks(kls, objects):
+        '''Run the _load_ hooks for a list of objects.  If a class defines
+        _bulk_load_FOO(objects) as well as _load_FOO(), the bulk version is
+        called once for the entire list instead of calling _load_FOO() on
+        every object.'''
+        objects = [x for x in objects if x[bacula_tools.ID]]
+        if not objects:
+            return
+        for hook in kls._hook_names():
+            bulk = getattr(kls, '_bulk' + hook, None)
+            if bulk:
+                bulk(objects)
+            else:
+                for obj in objects:
+                    getattr(obj, hook)()
+        return
+
+    def _run_load_hooks(self):
+        '''Run all of the _load_ hooks for this object.'''
+        [getattr(self, x)() for x in self._hook_names()]
+        return
+
+    def _cache_store(self):
+        '''Remember ourself in the identity map, if one is active.'''
+        identity_map = self.bc.identity_map
+        if identity_map == None or not self[bacula_tools.ID] or self._dirty:
+            return
+        identity_map.put(self.table, self, dict(
+            (x, getattr(self, x)) for x in self.CACHED_ATTRIBUTES))
+        return
+
+    def _cache_restore(self, field, value):
+        '''Fill ourself in from the identity map, if one is active and has the
+        requested row.  Returns True on success.'''
+        identity_map = self.bc.identity_map
+        if identity_map == None:
+            return False
+        found = identity_map.get(self.table, field, value)
+        if not found:
+            return False
+        row, extras = found
+        self._apply_row(row)
+        for key in extras:
+            setattr(self, key, extras[key])
+        return True
+
+    def _cache_invalidate(self):
+        '''Drop ourself from the identity map, if one is active.  Must be called
+        whenever our row, or anything loaded by a _load_ hook, changes.'''
+        identity_map = self.bc.identity_map
+        if identity_map == None or not self[bacula_tools.ID]:
+            return
+        identity_map.invalidate(self.table, self[bacula_tools.ID])
+        return
 
     def search(self, key=None):
         '''Search for ourself using a number of different methods.  If no key is
@@ -362,42 +595,47 @@ class DbDict(dict):
         proper row found, return a suggestion as to something better to
         search for, if possible.
 
+        If an identity map is active (see Bacula_Config.resource_cache), it
+        is consulted first and updated afterwards.
+
         '''
         if not key:
-            logging.debug(
-                'DbDict.search: no key, checking for NAME and ID: table "%s", name "%s", id "%s"', self.table, self[bacula_tools.NAME], self[bacula_tools.ID])
             if self[bacula_tools.NAME]:
-                new_me = self.bc.value_check(
-                    self.table, bacula_tools.NAME, self[bacula_tools.NAME], asdict=True)
-            elif self[bacula_tools.ID]:
-                new_me = self.bc.value_check(
-                    self.table, bacula_tools.ID, self[bacula_tools.ID], asdict=True)
+                lookup = (bacula_tools.NAME, self[bacula_tools.NAME])
+            else:
+                lookup = (bacula_tools.ID, self[bacula_tools.ID])
         else:
             if type(key) == list or type(key) == tuple:
                 key = key[0]
             try:
-                new_me = self.bc.value_check(
-                    self.table, bacula_tools.ID, int(key), asdict=True)
+                lookup = (bacula_tools.ID, int(key))
             except:
-                new_me = self.bc.value_check(
-                    self.table, bacula_tools.NAME, key, asdict=True)
+                lookup = (bacula_tools.NAME, key)
+        if self._cache_restore(*lookup):
+            return self
+        logging.debug('DbDict.search: table "%s", %s "%s"', self.table, *lookup)
+        new_me = []
+        if lookup[1] != None:
+            new_me = self.bc.value_check(self.table, lookup[0], lookup[1], asdict=True)
         try:
-            self.update(new_me[0])
+            self._apply_row(new_me[0])
         except Exception as e:
             pass
         if self[bacula_tools.ID]:
-            [getattr(self, x)() for x in dir(self) if '_load_' in x]
+            self._run_load_hooks()
+            self._cache_store()
         return self
 
     def delete(self):
         '''Delete itself from the database.'''
         # first clean up passwords!
-        for pw in bacula_tools.PasswordStore.Find(self, self.IDTAG == bacula_tools.Director.IDTAG):
-            pw.password = None
-            pw.store()
+        bacula_tools.PasswordStore._store_rows(
+            [pw.where_arguments + (None,) for pw in bacula_tools.PasswordStore.Find(self, self.IDTAG == bacula_tools.Director.IDTAG)])
         # Now delete myself!
-        self.bc.do_sql('DELETE FROM %s WHERE id = %%s' %
-                       self.table, self[bacula_tools.ID])
+        self._cache_invalidate()
+        self.bc.do_sql(self.bc.sql_cache.sql((self.table, 'delete'),
+                                             lambda: 'DELETE FROM %s WHERE id = %%s' % self.table),
+                       self[bacula_tools.ID])
         return
 
     def set(self, field, value, boolean=False, dereference=False):
@@ -418,25 +656,40 @@ class DbDict(dict):
         if dereference:
             value = self._fk_reference(field, value)[bacula_tools.ID]
         self[field] = value
+        if self._batch_depth:
+            return self         # saved when the batch exits
         return self._save()
 
     def _save(self):
-        '''Update the database with our data.'''
+        '''Update the database with our data.  Existing rows only have the keys
+        that have changed since they were loaded (or last saved) written.'''
         if bacula_tools.PASSWORD in self.keys():
             if self[bacula_tools.PASSWORD] == bacula_tools.GENERATE:
                 self[bacula_tools.PASSWORD] = bacula_tools.generate_password()
+        self._cache_invalidate()
         if self[bacula_tools.ID]:
-            keys = [x for x in self.keys() if not x == bacula_tools.ID]
-            keys.sort()
-            sql = 'UPDATE %s SET %s WHERE id = %%s' % (self.table,
-                                                       ', '.join(['`%s` = %%s' % x for x in keys]))
+            keys = tuple(sorted(x for x in self._dirty
+                                if x in self and not x == bacula_tools.ID))
+            if not keys:
+                return ()
+            sql = self.bc.sql_cache.sql(
+                (self.table, 'UPDATE') + keys,
+                lambda: 'UPDATE %s SET %s WHERE id = %%s' % (self.table,
+                                                             ', '.join(['`%s` = %%s' % x for x in keys])))
             values = tuple([self[x] for x in keys] + [self[bacula_tools.ID], ])
-            return self.bc.do_sql(sql, values)
-        sql = 'INSERT INTO %s (`%s`) VALUES (%s)' % (
-            self.table, '`,`'.join(self.keys()), ','.join(['%s' for x in self.keys()]))
-        logging.debug('%s, %s', sql, self.values())
+            result = self.bc.do_sql(sql, values)
+            self._dirty.clear()
+            return result
+        keys = tuple(sorted(self.keys()))
+        sql = self.bc.sql_cache.sql(
+            (self.table, 'INSERT') + keys,
+            lambda: 'INSERT INTO %s (`%s`) VALUES (%s)' % (
+                self.table, '`,`'.join(keys), ','.join(['%s' for x in keys])))
+        values = tuple([self[x] for x in keys])
+        logging.debug('%s, %s', sql, values)
         try:
-            self.bc.do_sql(sql, tuple(self.values()))
+            self.bc.do_sql(sql, values)
+            self._dirty.clear()
             return self.search()
         except Exception as e:
             if e.args[0] == 1062:
@@ -452,8 +705,8 @@ class DbDict(dict):
         '''
         row = self.bc.value_ensure(
             self.table, bacula_tools.NAME, name.strip(), asdict=True)[0]
-        self.update(row)
-        [getattr(self, x)() for x in dir(self) if '_load_' in x]
+        self._apply_row(row)
+        self._run_load_hooks()
         return
 
     def parse_string(self, string):
@@ -521,10 +774,15 @@ class DbDict(dict):
         '''Stub'''
         return ''
 
+    @classmethod
+    def _fk_class(kls, fk):
+        '''The class that a foreign key refers to.'''
+        return bacula_tools._DISPATCHER[fk.replace('_id', '')]
+
     def _fk_reference(self, fk, string=None):
         '''Shortcut for vivifying objects related to foreign keys'''
         logging.debug('_fk_reference %s: %s, %s', fk, string, self[fk])
-        obj = bacula_tools._DISPATCHER[fk.replace('_id', '')]()
+        obj = self._fk_class(fk)()
         if string:
             obj.search(string.strip())
             if not obj[bacula_tools.ID]:
@@ -735,6 +993,51 @@ class PList(list):
         return results
 
 
+# Markers yielded by the dialogs below: wait for the next packet, or for
+# everything up to the end-of-data signal.
+_RECV = object()
+_RECV_ALL = object()
+
+
+def _auth_dialog(name, password):
+    '''The cram-md5 handshake, written so that both BSock and AsyncBSock can
+    use it.  Yields strings to be sent, or _RECV/_RECV_ALL to get whatever
+    comes back.'''
+    # this is effectively our username
+    yield "Hello %s calling\n" % (name,)
+    challenge = yield _RECV  # Receive the challenge response
+    # parse the challenge out of the returned string
+    m = re.search("auth cram-md5 (<.+?>)", challenge)
+    chal = m.group(1)
+    logging.debug('auth: challenge received: %s', chal)
+
+    pw = hashlib.md5(password).hexdigest()
+    # hmac and base64 encode the request
+    yield base64.b64encode(hmac.new(pw, chal).digest())[:-2]
+
+    result = yield _RECV  # receive response
+    if result != "1000 OK auth\n":
+        raise ValueError("Authentication Failed %s" % (result,))  # failed
+
+    # send our challenge response
+    yield "auth cram-md5 <%d.%d@%s> ssl=0\n" % (randint(1, 99999999), int(time.time()), name)
+    yield _RECV                 # get the response back
+    yield "1000 OK auth\n"  # Dont even check the response here!
+
+    # This is basically cheating the protocol spec! :-)
+    data = yield _RECV
+    if not re.match(".* OK.*", data):  # auth complete
+        raise ValueError("Unexpected packet received %s" % (data,))
+    return
+
+
+def _command_dialog(command):
+    '''Send a command and collect the entire response.'''
+    yield command
+    yield _RECV_ALL
+    return
+
+
 class BSock:
 
     '''Sometimes, you want to talk to various Bacula daemons without the
@@ -744,20 +1047,26 @@ class BSock:
     mangeable.
     '''
 
-    def __init__(self, address, password, myname, port, timeout=5):
+    def __init__(self, address, password, myname, port, timeout=5, deadline=None):
         '''Address, password, myname, and port are all mandatory.
 
         address = the destination with which you want to communicate. (None -> 127.0.0.1)
         myname = the "name" with which a password is associated.  This is not as obvious as you might hope.
+        timeout = how long any one network operation may take.
+        deadline = if given, a time.time() after which every network operation fails.
 
         '''
         self.password = password
         self.name = myname
+        self.timeout = timeout
+        self.deadline = deadline
+        self.buffer = bytearray(4096)
+        self.last_signal = None
         if not address:
             address = '127.0.0.1'
         self.connection = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
         # Don't take forever trying to do stuff
-        self.connection.settimeout(timeout)
+        self._settimeout()
         logging.debug(
             'connecting to: %s(%s):%s with password "%s"', myname, address, port, self.password)
         self.connection.connect((address, port))
@@ -769,66 +1078,98 @@ class BSock:
         I should note that, as written, the target service is *not* mutually authenticated.  
 
         The bulk of this was written by Matthew Ife, so thanks!'''
-
-        # this is effectively our username
-        self.send("Hello %s calling\n" % (self.name,))
-        challenge = self.recv()  # Receive the challenge response
-        # parse the challenge out of the returned string
-        m = re.search("auth cram-md5 (<.+?>)", challenge)
-        chal = m.group(1)
-        logging.debug('auth: challenge received: %s', chal)
-
-        pw = hashlib.md5(self.password).hexdigest()
-        # hmac and base64 encode the request
-        self.send(base64.b64encode(hmac.new(pw, chal).digest())[:-2])
-
-        result = self.recv()  # receive response
-        if result != "1000 OK auth\n":
-            raise ValueError("Authentication Failed %s" % (result,))  # failed
-
-        # send our challenge response
-        self.send("auth cram-md5 <%d.%d@%s> ssl=0\n" %
-                  (randint(1, 99999999), int(time.time()), self.name))
-        self.recv()                 # get the response back
-        self.send("1000 OK auth\n")  # Dont even check the response here!
-
-        # This is basically cheating the protocol spec! :-)
-        data = self.recv()
-        if not re.match(".* OK.*", data):  # auth complete
-            raise ValueError("Unexpected packet received %s" % (data,))
+        data = self._converse(_auth_dialog(self.name, self.password))
         self.auth = True
         return data
 
+    def _converse(self, dialog):
+        '''Run a dialog (see _auth_dialog) over the connection, returning the
+        last thing received.'''
+        reply = None
+        try:
+            step = next(dialog)
+            while True:
+                if step is _RECV:
+                    reply = self.recv()
+                elif step is _RECV_ALL:
+                    reply = self.recv_all()
+                else:
+                    self.send(step)
+                step = dialog.send(reply)
+        except StopIteration:
+            pass
+        return reply
+
+    def _settimeout(self):
+        '''Make sure the next network operation doesn't run past the deadline.'''
+        timeout = self.timeout
+        if self.deadline != None:
+            remaining = self.deadline - time.time()
+            if remaining <= 0:
+                raise socket.timeout('deadline passed')
+            timeout = min(timeout, remaining)
+        self.connection.settimeout(timeout)
+        return
+
+    def close(self):
+        '''Hang up.'''
+        self.connection.close()
+        return
+
     def send(self, message):
         '''Send a properly encoded messages to the connected service.'''
-        ldata = pack('!i', len(message))
-        self.connection.send(ldata)
+        self._settimeout()
         logging.debug('sending:  (%d) %s', len(message), message)
-        self.connection.send(message)
+        self.connection.sendall(pack('!i', len(message)) + message)
+        return
+
+    def signal(self, code):
+        '''Send a signal (one of the BNET_* codes) to the connected service.'''
+        self._settimeout()
+        self.connection.sendall(pack('!i', code))
         return
 
+    def _recv_exactly(self, count):
+        '''Read exactly count bytes, however many reads that takes.'''
+        if len(self.buffer) < count:
+            self.buffer = bytearray(count)
+        view = memoryview(self.buffer)
+        received = 0
+        while received < count:
+            # A peer that trickles data mustn't get a fresh timeout per read
+            self._settimeout()
+            got = self.connection.recv_into(view[received:], count - received)
+            if not got:
+                raise socket.error('connection closed by %s' % self.name)
+            received += got
+        return view[:count].tobytes()
+
     def recv(self):
-        '''Read a (theoretically) single-line response from the connected service.'''
-        msglen = unpack('!i', self.connection.recv(4))[0]
-        if msglen < 0:
-            return ''
-        response = self.connection.recv(msglen)
+        '''Read a (theoretically) single-line response from the connected
+        service.  Signals come back as an empty string, with the signal itself
+        stored in self.last_signal.  Heartbeats are answered and skipped.'''
+        while True:
+            msglen = unpack('!i', self._recv_exactly(4))[0]
+            if msglen >= 0:
+                break
+            if msglen != bacula_tools.BNET_HEARTBEAT:
+                logging.debug('received signal: %d', msglen)
+                self.last_signal = msglen
+                return ''
+            self.signal(bacula_tools.BNET_HB_RESPONSE)
+        self.last_signal = None
+        response = self._recv_exactly(msglen)
         logging.debug('received: %s' % response)
         return response
 
     def recv_all(self):
         """Gets all lines of a request"""
-        r = ""
+        chunks = []
         s = self.recv()
-        while s:
-            # This is stupid.  For Linux clients, if you don't have this
-            # microsleep here, even though it reads everything Python will
-            # tell you the connection timed out.  FreeBSD doesn't have this
-            # problem.
-            time.sleep(0.01)
-            r += s
+        while s or self.last_signal is None:
+            chunks.append(s)
             s = self.recv()
-        return r
+        return ''.join(chunks)
 
     def version(self):
         '''Request the version string from the connected services.'''
@@ -846,3 +1187,193 @@ class BSock:
     def _time(self):
         '''Format the time for uniqueifying various things'''
         return time.strftime('%F_%H.%M.%S_00')
+
+
+class AsyncBSock(asyncore.dispatcher):
+
+    '''BSock for asyncore, so that a single loop can talk to hundreds of
+    daemons at once.  Requests (auth, version, status, send_command) are
+    queued and run in order once the connection is up; each one hands its
+    reply to callback, or the exception to errback if anything goes wrong.
+    The connection is closed once the queue runs dry, so queue any follow-up
+    requests from the callback.  Use AsyncBSock.loop() rather than
+    asyncore.loop() to get the timeouts enforced.
+    '''
+
+    def __init__(self, address, password, myname, port, timeout=5, map=None):
+        '''Arguments are as for BSock; timeout is how long the daemon may sit
+        idle while we're waiting on it.'''
+        asyncore.dispatcher.__init__(self, map=map)
+        self.password = password
+        self.name = myname
+        self.timeout = timeout
+        self.incoming = bytearray()
+        self.outgoing = ''
+        self.requests = []
+        self.current = None
+        self.waiting = None
+        self.touch()
+        self.create_socket(socket.AF_INET, socket.SOCK_STREAM)
+        logging.debug('connecting to: %s(%s):%s', myname, address, port)
+        self.connect((address or '127.0.0.1', port))
+        return
+
+    def auth(self, callback=None, errback=None):
+        '''Authenticate with the target service.'''
+        self._request(_auth_dialog(self.name, self.password), callback, errback)
+        return
+
+    def version(self, callback=None, errback=None):
+        '''Request the version string from the connected service.'''
+        self.send_command('version', callback, errback)
+        return
+
+    def status(self, args='', callback=None, errback=None):
+        '''Ask the connected service for its status.'''
+        if args:
+            self.send_command('.status %s' % args, callback, errback)
+        else:
+            self.send_command('status', callback, errback)
+        return
+
+    def send_command(self, command, callback=None, errback=None):
+        '''Send an arbitrary command, collecting everything that comes back.'''
+        self._request(_command_dialog(command), callback, errback)
+        return
+
+    def _request(self, dialog, callback, errback):
+        '''Queue up a dialog, starting it if we're idle.'''
+        self.requests.append([dialog, callback, errback, None, []])
+        if self.connected and not self.current:
+            self._next()
+        return
+
+    def _next(self):
+        '''Start the next queued request, or hang up if there aren't any.'''
+        if not self.requests:
+            self.current = None
+            self.close()
+            return
+        self.current = self.requests.pop(0)
+        self._advance(None)
+        return
+
+    def _advance(self, reply):
+        '''Feed reply to the current dialog, running it until it wants input.'''
+        dialog, callback = self.current[:2]
+        try:
+            if reply is None:
+                step = next(dialog)
+            else:
+                self.current[3] = reply
+                step = dialog.send(reply)
+            while not (step is _RECV or step is _RECV_ALL):
+                logging.debug('sending:  (%d) %s', len(step), step)
+                self.outgoing += pack('!i', len(step)) + step
+                step = next(dialog)
+        except StopIteration:
+            if callback:
+                callback(self.current[3])
+            self._next()
+            return
+        self.waiting = step
+        return
+
+    def _received(self, data):
+        '''Split incoming data into packets and hand them to the current request.'''
+        self.incoming.extend(data)
+        while len(self.incoming) >= 4 and self.current:
+            msglen = unpack('!i', str(self.incoming[:4]))[0]
+            if msglen == bacula_tools.BNET_HEARTBEAT:
+                del self.incoming[:4]
+                self.outgoing += pack('!i', bacula_tools.BNET_HB_RESPONSE)
+                continue
+            elif msglen < 0:
+                # Any other signal, which for our purposes means end of data
+                packet = ''
+                msglen = 0
+            elif len(self.incoming) < msglen + 4:
+                break
+            else:
+                packet = str(self.incoming[4:msglen + 4])
+            del self.incoming[:msglen + 4]
+            logging.debug('received: %s', packet)
+            if self.waiting is _RECV:
+                self._advance(packet)
+            elif packet:
+                self.current[4].append(packet)
+            else:
+                self._advance(''.join(self.current[4]))
+        return
+
+    def _fail(self, exception):
+        '''Hang up, passing exception along to everything still outstanding.'''
+        self.close()
+        pending = self.requests
+        if self.current:
+            pending.insert(0, self.current)
+        self.current = None
+        self.requests = []
+        for dialog, callback, errback, reply, chunks in pending:
+            if errback:
+                errback(exception)
+            else:
+                logging.warning('%s: %s', self.name, exception)
+        return
+
+    def touch(self):
+        '''Note that the daemon has done something.'''
+        self.last_activity = time.time()
+        return
+
+    def check_timeout(self, now=None):
+        '''Give up if the daemon has kept us waiting too long.'''
+        if (now or time.time()) - self.last_activity > self.timeout:
+            self._fail(socket.timeout('timed out'))
+        return
+
+    def readable(self):
+        return True
+
+    def writable(self):
+        return not self.connected or bool(self.outgoing)
+
+    def handle_connect(self):
+        self.touch()
+        if not self.current:
+            self._next()
+        return
+
+    def handle_read(self):
+        data = self.recv(65536)
+        if data:
+            self.touch()
+            self._received(data)
+        return
+
+    def handle_write(self):
+        sent = self.send(self.outgoing)
+        self.outgoing = self.outgoing[sent:]
+        return
+
+    def handle_close(self):
+        self._fail(socket.error('connection closed by %s' % self.name))
+        return
+
+    def handle_error(self):
+        self._fail(sys.exc_info()[1])
+        return
+
+    @staticmethod
+    def loop(map=None, poll=0.1):
+        '''Run asyncore until every connection is finished, enforcing timeouts
+        as we go.'''
+        if map is None:
+            map = asyncore.socket_map
+        while map:
+            asyncore.loop(timeout=poll, map=map, count=1)
+            now = time.time()
+            for channel in map.values():
+                if isinstance(channel, AsyncBSock):
+                    channel.check_timeout(now)
+        return
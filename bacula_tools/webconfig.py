@@ -0,0 +1,209 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+'''A long-running replacement for the bacula_webconfig CGI.
+
+ConfigService is a WSGI application that answers the same requests as the
+CGI (and is what the CGI now runs, via wsgiref's CGIHandler).  Run as a
+service (see main()), it keeps its database connections open, and keeps the
+rendered configuration of every client in memory.  The cache is rebuilt in
+bulk (see DaemonRenderer) whenever the database changes, which is checked
+for (see Bacula_Config.config_stamp) at most every few seconds.
+
+The parameters are:
+        hostname: if passed, use this as the hostname to work with instead
+        of the address of the client making the request.
+
+        bconsole (in the path): return a bconsole.conf instead of a
+        bacula-fd.conf
+
+        hash: return the hash of the config rather than the config itself
+
+Every response carries the hash as its ETag.  The hash of each client's
+configuration is worked out when the configuration is rendered, so polling
+for changes (with hash=1, or with If-None-Match, which gets a 304 if nothing
+has changed) is just a dictionary lookup.
+'''
+from __future__ import print_function, absolute_import
+import os
+import re
+import sys
+import time
+import socket
+import hashlib
+import optparse
+import threading
+import urlparse
+import SocketServer
+from wsgiref.simple_server import make_server, WSGIServer
+import bacula_tools
+import logging
+logger = logging.getLogger(__name__)
+
+
+def fix_hostname(hostname):
+    '''Check for getting an IP address and, if so, turn it into a hostname'''
+    if re.match(r'\d+\.\d+\.\d+\.\d+', hostname):
+        try:
+            hostname = socket.gethostbyaddr(hostname)[0]
+        except socket.error:
+            pass
+    return hostname
+
+
+class ConfigService(object):
+
+    '''WSGI application serving bacula-fd.conf (and bconsole.conf) to clients.
+    Rendered configurations are kept until the database changes: interval is
+    how many seconds may pass between checks for that.
+
+    '''
+    bc = bacula_tools.Bacula_Factory()
+    HEADER = '''# Host Config file generated by %s on %s.
+#
+#DO NOT EDIT THIS FILE BY HAND
+''' % (sys.argv[0], os.uname()[1])
+
+    def __init__(self, interval=5):
+        object.__init__(self)
+        self.interval = interval
+        self.lock = threading.Lock()
+        self.stamp = None
+        self.checked = 0
+        self.configs = {}       # lower-case client name: (body, digest)
+        self.hostnames = {}     # See fix_hostname()
+        self.bconsole = None
+        return
+
+    def __call__(self, environ, start_response):
+        try:
+            query = urlparse.parse_qs(environ.get('QUERY_STRING', ''))
+            params = dict((x, query[x][-1]) for x in query)
+            if 'bconsole' in environ.get('PATH_INFO', ''):
+                body, digest = self.bconsole_config()
+            else:
+                # This chooses, in order, passed-in hostname, REMOTE_HOST,
+                # REMOTE_ADDR, localhost.localdomain
+                hostname = params.get('hostname', environ.get(
+                    'REMOTE_HOST', environ.get('REMOTE_ADDR', 'localhost.localdomain')))
+                body, digest = self.fd_config(hostname, params.get('director', ''),
+                                              params.get('os', bacula_tools.guess_os))
+        finally:
+            # Give this thread's connection back for the next request
+            self.bc.release()
+        headers = [('ETag', '"%s"' % digest)]
+        etags = self.etags(environ.get('HTTP_IF_NONE_MATCH', ''))
+        if digest in etags or '*' in etags:
+            start_response('304 Not Modified', headers)
+            return []
+        if params.get('hash'):
+            # Like the body, the CGI's hash came after a blank line
+            body = '\n%s\n' % digest
+        start_response('200 OK', headers + [('Content-Type', 'text/plain; charset=iso-8859-1'),
+                                            ('Content-Length', str(len(body)))])
+        return [body]
+
+    @staticmethod
+    def etags(header):
+        '''The digests listed in an If-None-Match header.'''
+        return [x.strip().replace('W/', '', 1).strip('"') for x in header.split(',')]
+
+    @staticmethod
+    def entry(text):
+        '''What gets cached for a configuration: the response body and its
+        digest.'''
+        # The CGI always had a blank line in front (and a newline after)
+        body = '\n%s\n' % text
+        return body, hashlib.md5(body).hexdigest()
+
+    def validate(self):
+        '''Throw away everything we have if the database has changed.  The first
+        thread to notice rebuilds the cache; the others carry on with the old
+        one until it is done.'''
+        if time.time() < self.checked + self.interval:
+            return
+        with self.lock:
+            if time.time() < self.checked + self.interval:
+                return
+            stamp = self.bc.config_stamp(bacula_tools.CONFIG_TABLES[bacula_tools.FD] +
+                                         bacula_tools.CONFIG_TABLES[bacula_tools.BCONSOLE])
+            self.checked = time.time()
+            # No stamp means we can't tell, so rebuild every time
+            if stamp != None and stamp == self.stamp:
+                return
+            logger.info('ConfigService: rebuilding cache (stamp %s)', stamp)
+            configs = {}
+            with self.bc.resource_cache():
+                for client, fragments in bacula_tools.DaemonRenderer(bacula_tools.FD):
+                    configs[client[bacula_tools.NAME].lower()] = self.entry(
+                        self.fd_text(fragments))
+            self.configs = configs
+            self.hostnames = {}
+            self.bconsole = None
+            self.stamp = stamp
+        return
+
+    def fd_text(self, fragments):
+        '''Assemble a bacula-fd.conf.'''
+        return '\n'.join([self.HEADER] + fragments)
+
+    def fd_config(self, hostname, director='', os=None):
+        '''The (body, digest) of the bacula-fd.conf for hostname, creating the
+        client if need be (see find_client).'''
+        self.validate()
+        guest = self.hostnames.get(hostname)
+        if guest == None:
+            guest = self.hostnames[hostname] = fix_hostname(hostname)
+        name = bacula_tools.hostname_mangler(guest).lower()
+        result = self.configs.get(name)
+        if result != None:
+            return result
+        with self.bc.resource_cache():
+            client = bacula_tools.find_client(self.bc, guest, director, os=os)
+            (_, fragments), = bacula_tools.DaemonRenderer(
+                bacula_tools.FD, [client])
+        result = self.configs[name] = self.entry(self.fd_text(fragments))
+        return result
+
+    def bconsole_config(self):
+        '''The (body, digest) of the bconsole configuration(s)'''
+        self.validate()
+        if self.bconsole == None:
+            result = [str(x) for x in bacula_tools.Console.Find(order_by='name')]
+            result.extend(x.bconsole()
+                          for x in bacula_tools.Director.Find(order_by='name'))
+            self.bconsole = self.entry('\n'.join(result))
+        return self.bconsole
+
+
+class ThreadedWSGIServer(SocketServer.ThreadingMixIn, WSGIServer):
+
+    '''Each request gets a thread of its own (and a pooled database connection).'''
+    daemon_threads = True
+
+
+def main():
+    '''Run ConfigService as a stand-alone HTTP service.'''
+    parser = optparse.OptionParser(
+        description='Serve Bacula client configurations over HTTP.')
+    parser.add_option('--address', default='',
+                      help='Address to listen on (default: all)')
+    parser.add_option('--port', type='int', default=8080,
+                      help='Port to listen on (default: %default)')
+    parser.add_option('--interval', type='int', default=5, metavar='SECONDS',
+                      help='How often to check the database for changes (default: %default)')
+    parser.add_option('-d', '--debug', action='store_true', default=False,
+                      help='Enable debugging output')
+    (args, _) = parser.parse_args()
+    if args.debug:
+        bacula_tools.set_debug()
+    else:
+        logging.basicConfig(level=logging.INFO)
+    service = ConfigService(args.interval)
+    service.validate()          # Warm the cache before taking requests
+    server = make_server(args.address, args.port, service,
+                         server_class=ThreadedWSGIServer)
+    logger.info('Listening on %s:%d', args.address, args.port)
+    server.serve_forever()
+
+if __name__ == "__main__":
+    main()
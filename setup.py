@@ -51,6 +51,7 @@ setup(name=NAME,
               'manage_jobs = bacula_tools.job:main',
               'manage_directors = bacula_tools.director:main',
               'manage_scripts = bacula_tools.scripts:main',
+              'bacula_configd = bacula_tools.webconfig:main',
           ]
       },
       )
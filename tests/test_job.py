@@ -133,3 +133,16 @@ class job_tests(unittest.TestCase):
             j.parse_string(self.full_case)
             print(s.called)
             self.assertEquals(m.do_sql.call_args_list, expected_call_list)
+
+    def test_find_bulk_load(self, m):
+        m.do_sql.side_effect = [
+            [{'id': 1, 'name': 'job1'}, {'id': 2, 'name': 'job2'}],
+            [{'link_job_id': 2, 'id': 7, 'command': 'foo'},
+             {'link_job_id': 2, 'id': 8, 'command': 'bar'}],
+        ]
+        jobs = bacula_tools.Job.Find(order_by='name')
+        self.assertEquals(m.do_sql.call_count, 2)
+        self.assertEquals([x[bacula_tools.NAME] for x in jobs],
+                          ['job1', 'job2'])
+        self.assertEquals(jobs[0].scripts, [])
+        self.assertEquals([x[bacula_tools.ID] for x in jobs[1].scripts], [7, 8])
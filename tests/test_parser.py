@@ -3,6 +3,7 @@ import os
 import sys
 import pprint
 import unittest
+import mock
 import pkg_resources
 sys.path.insert(0, '..')
 sys.path.insert(0, '.')
@@ -51,3 +52,271 @@ class overall_parser_tests(unittest.TestCase):
             open('/etc/bacula/bacula-dir.conf').read())
         self.assertIsInstance(retval, list)
         return
+
+
+class shared_grammar_tests(unittest.TestCase):
+
+    def test_built_once(self):
+        grammar = bacula_tools.parser_support.pool_grammar
+        self.assertTrue(grammar() is grammar())
+        return
+
+    def test_parse_with(self):
+        target = mock.MagicMock()
+        bacula_tools.parser_support.parse_with(
+            bacula_tools.parser_support.pool_grammar(), target,
+            'Name = "Default"\nPool Type = Backup\n')
+        target.set_name.assert_called_with('Default')
+        target._parse_setter.assert_called_with(
+            bacula_tools.POOLTYPE, False, False)
+        self.assertEquals(bacula_tools.parser_support._context.target, None)
+        return
+
+
+class tokenizer_tests(unittest.TestCase):
+
+    def tokenize(self, text, **kwargs):
+        return list(bacula_tools.parser_support.tokenize(text, **kwargs))
+
+    def test_simple(self):
+        self.assertEquals(self.tokenize('# comment\nPool {\n  Name = p  # me\n}\n'),
+                          [('pool', 'Name = p', 2)])
+        return
+
+    def test_quotes_and_semicolons(self):
+        self.assertEquals(self.tokenize('Job { Name = "a;b{#}" ; Type = Backup }'),
+                          [('job', 'Name = "a;b{#}" \n Type = Backup', 1)])
+        return
+
+    def test_nesting_and_continuation(self):
+        text = 'Job {\n  RunScript {\n    Command = "x \\" }"\n  }\n  Run = a \\\nb\n}\n'
+        self.assertEquals(self.tokenize(text),
+                          [('job', 'RunScript {\n    Command = "x \\" }"\n  }\n  Run = a b', 1)])
+        return
+
+    def test_include(self):
+        include = mock.Mock(return_value=['Client {\n', 'Name = c\n', '}\n'])
+        self.assertEquals(self.tokenize('Pool { Name = p }\n  @/etc/c.conf\n',
+                                        include=include),
+                          [('pool', 'Name = p', 1), ('client', 'Name = c', 1)])
+        include.assert_called_with('/etc/c.conf')
+        return
+
+    def test_errors(self):
+        for text in ['Job { Name = x', 'Job { Name = "x }', 'Job { }}', 'Job {} x']:
+            self.assertRaises(ValueError, self.tokenize, text)
+        return
+
+
+class include_resolver_tests(unittest.TestCase):
+
+    def setUp(self):
+        import tempfile
+        self.tmpdir = tempfile.mkdtemp()
+        self.resolver = bacula_tools.parser_support.IncludeResolver()
+        return
+
+    def tearDown(self):
+        import shutil
+        shutil.rmtree(self.tmpdir)
+        return
+
+    def write(self, name, contents):
+        filename = os.path.join(self.tmpdir, name)
+        open(filename, 'w').write(contents)
+        return filename
+
+    def test_cached(self):
+        filename = self.write('a.conf', 'Pool { Name = a }\n')
+        self.assertEquals(list(self.resolver(filename)), ['Pool { Name = a }\n'])
+        self.write('a.conf', 'Pool { Name = b }\n')
+        self.assertEquals(list(self.resolver(filename)), ['Pool { Name = a }\n'])
+        return
+
+    def test_glob(self):
+        self.write('b.conf', 'Client { Name = b }\n')
+        self.write('a.conf', 'Client { Name = a }\n')
+        result = bacula_tools.parser_support.tokenize(
+            '@%s/*.conf\n' % self.tmpdir, self.resolver)
+        self.assertEquals([x[1] for x in result], ['Name = a', 'Name = b'])
+        return
+
+    def test_loop(self):
+        self.write('a.conf', '@%s/b.conf\n' % self.tmpdir)
+        self.write('b.conf', '@%s/a.conf\n' % self.tmpdir)
+        result = bacula_tools.parser_support.tokenize(
+            '@%s/a.conf\n' % self.tmpdir, self.resolver)
+        self.assertRaises(ValueError, list, result)
+        self.assertEquals(self.resolver.active, [])
+        return
+
+
+class stanza_record_tests(unittest.TestCase):
+
+    body = 'Name = "j1"\nType = Backup\nRun After Job = "/bin/true"\n'
+
+    def test_replay(self):
+        import pickle
+        ps = bacula_tools.parser_support
+        record = pickle.loads(pickle.dumps(
+            ps.StanzaRecord(bacula_tools.JOB, self.body).preparse()))
+        live = mock.MagicMock()
+        ps.parse_with(ps.job_grammar(), live, self.body)
+        replayed = mock.MagicMock()
+        with ps.replaying(record.calls):
+            ps.parse_with(ps.job_grammar(), replayed, self.body)
+        self.assertEquals(live.mock_calls, replayed.mock_calls)
+        return
+
+    def test_left_for_later(self):
+        ps = bacula_tools.parser_support
+        self.assertEquals(ps.StanzaRecord(
+            bacula_tools.SCHEDULE, 'Name = s').preparse().calls, None)
+        self.assertEquals(ps.StanzaRecord(
+            bacula_tools.POOL, 'Bogus = 1').preparse().calls, None)
+        return
+
+
+class resource_graph_tests(unittest.TestCase):
+
+    conf = '''Director { Name = d1; Password = "pw"; Messages = Daemon }
+Catalog { Name = cat; dbname = bacula }
+Job { Name = "j1"; Client = c1; Pool = Default; Run After Job = "/bin/true" }
+Pool { Name = Default; Pool Type = Backup }
+'''
+
+    def graph(self, **kwargs):
+        self.output = []
+        return bacula_tools.parser_support.ResourceGraph(self.output.append, **kwargs)
+
+    def test_apply(self):
+        ps = bacula_tools.parser_support
+        record = ps.StanzaRecord(bacula_tools.JOB, 'Name = "j1"\nClient = c1\n'
+                                 'Priority = 5\nRun After Job = "/bin/true"\n').preparse()
+        node = ps.ResourceNode(bacula_tools.JOB, record)
+        for action, args in record.calls:
+            node.apply(action, args)
+        self.assertEquals(node.name, 'j1')
+        self.assertEquals(node.values, {bacula_tools.PRIORITY: '5'})
+        self.assertEquals(node.refs, {bacula_tools.CLIENT_ID: (bacula_tools.Client, 'c1')})
+        self.assertEquals([x[0] for x in node.deferred], ['script'])
+        return
+
+    def test_dry_run(self):
+        graph = self.graph(dry_run=True)
+        graph.bc = mock.MagicMock()
+        nodes = graph.parse_it_all(self.conf)
+        self.assertEquals(graph.bc.mock_calls, [])
+        self.assertEquals([x.name for x in nodes], ['d1', 'cat', 'j1', 'Default'])
+        self.assertEquals(nodes[0].values[bacula_tools.PASSWORD], 'pw')
+        self.assertEquals([x.split(':')[0] for x in self.output if x.startswith('Reference')],
+                          ['Reference'] * 2)
+        self.assertTrue('Reference: Client "c1" must be found in (or added to) the database'
+                        in self.output)
+        return
+
+    def test_persist(self):
+        known = {'Daemon': 1}
+
+        def do_sql(sql, args=None):
+            if sql.startswith('SELECT'):
+                return [(known[x], x) for x in args if x in known]
+            if sql.endswith('(name) VALUES (%s)' + ',(%s)' * (len(args) - 1)):
+                known.update((x, len(known) + 1) for x in args)
+            return []
+        graph = self.graph()
+        graph.bc = mock.MagicMock(identity_map=None)
+        graph.bc.do_sql.side_effect = do_sql
+        with mock.patch.object(graph, '_finish') as finish:
+            graph.parse_it_all(self.conf)
+        statements = [x[1] for x in graph.bc.do_sql.mock_calls]
+        # Every name is looked up, and the missing ones added, in one go
+        self.assertTrue(('INSERT INTO pools (name) VALUES (%s)', ['Default']) in statements)
+        self.assertFalse([x for x in statements if 'messages (name)' in x[0]])
+        sql, args = [x for x in statements if x[0].startswith('INSERT INTO jobs (`')][0]
+        self.assertTrue(sql.endswith('ON DUPLICATE KEY UPDATE `client_id` = VALUES(`client_id`), '
+                                     '`pool_id` = VALUES(`pool_id`)'))
+        self.assertEquals(args, (known['j1'], 'j1', known['c1'], known['Default']))
+        self.assertEquals(finish.call_count, 4)
+        return
+
+
+class fingerprint_tests(unittest.TestCase):
+
+    conf = '''Director { Name = d1; Password = "pw" }
+Job { Name = "j1"; Client = c1 }
+Job { Name = j2; Client = c2 }
+'''
+
+    def records(self, conf):
+        return list(bacula_tools.parser_support.stanzas(conf))
+
+    def test_fingerprint(self):
+        a, b, c = [x.fingerprint() for x in self.records(
+            'Job { Name = j1\nClient = "c 1" }\n'
+            'Job {\n  Name = j1   # comment\n  Client =   "c 1"\n}\n'
+            'Job { Name = j1\nClient = "c  1" }\n')]
+        self.assertEquals(a, b)
+        self.assertNotEquals(a, c)
+        self.assertEquals(self.records(self.conf)[1].resource_name(), 'j1')
+        return
+
+    def test_incremental(self):
+        ps = bacula_tools.parser_support
+        fingerprints = ps.FingerprintStore('/etc/bacula/bacula-dir.conf', prune=True)
+        fingerprints.bc = mock.MagicMock()
+        records = self.records(self.conf)
+        fingerprints.stored = dict(((x.name, x.resource_name().lower()),
+                                    x.fingerprint(records[0].identity())) for x in records)
+        fingerprints.stored[(bacula_tools.JOB, 'gone')] = 'x'
+        output = []
+        parser = ps.StringParseSupport(output.append, fingerprints=fingerprints)
+        parser.bc = mock.MagicMock()
+        with mock.patch.object(parser, 'parse_one_stanza') as parse, \
+                mock.patch.object(fingerprints, '_delete') as delete:
+            parse.return_value = 'Job: j2'
+            parser.parse_it_all(self.conf.replace('c2', 'c3'))
+        # The Director is always parsed, as it's the parent of the rest
+        self.assertEquals([x[1][0] for x in parse.mock_calls],
+                          [bacula_tools.DIRECTOR, bacula_tools.JOB])
+        self.assertTrue('Job: j1 unchanged' in output)
+        delete.assert_called_once_with((bacula_tools.JOB, 'gone'), output.append)
+        sql, args = fingerprints.bc.do_sql.mock_calls[-1][1]
+        self.assertTrue(sql.startswith('INSERT INTO stanza_fingerprints'))
+        self.assertEquals(args[:3], ('/etc/bacula/bacula-dir.conf', bacula_tools.DIRECTOR, 'd1'))
+        self.assertEquals(args[6], 'j2')
+        self.assertFalse((bacula_tools.JOB, 'gone') in fingerprints.stored)
+        return
+
+    def test_forget(self):
+        fingerprints = bacula_tools.parser_support.FingerprintStore('/etc/bacula/bacula-dir.conf')
+        fingerprints.bc = mock.MagicMock()
+        fingerprints.CHUNK = 2
+        fingerprints.stored = {(bacula_tools.JOB, 'a'): 'x', (bacula_tools.JOB, 'b'): 'x',
+                               (bacula_tools.JOB, 'c'): 'x', (bacula_tools.POOL, 'p'): 'x'}
+        fingerprints.forget([(bacula_tools.JOB, 'a'), (bacula_tools.JOB, 'b'),
+                             (bacula_tools.JOB, 'c')])
+        calls = fingerprints.bc.do_sql.mock_calls
+        self.assertEquals(len(calls), 2)
+        self.assertEquals(calls[0][1], (
+            'DELETE FROM stanza_fingerprints WHERE source = %s AND (resource, name) IN ((%s,%s),(%s,%s))',
+            ('/etc/bacula/bacula-dir.conf', bacula_tools.JOB, 'a', bacula_tools.JOB, 'b')))
+        self.assertEquals(fingerprints.stored, {(bacula_tools.POOL, 'p'): 'x'})
+        return
+
+    def test_parent_renamed(self):
+        ps = bacula_tools.parser_support
+        records = self.records(self.conf)
+        fingerprints = ps.FingerprintStore('/etc/bacula/bacula-dir.conf')
+        fingerprints.stored = dict(((x.name, x.resource_name().lower()),
+                                    x.fingerprint(records[0].identity())) for x in records)
+        renamed = self.records(self.conf.replace('d1', 'd2'))
+        # The Jobs themselves haven't changed, but their Director has
+        self.assertEquals([fingerprints.unchanged(x) for x in renamed],
+                          [False, False, False])
+        fingerprints = ps.FingerprintStore('/etc/bacula/bacula-dir.conf')
+        fingerprints.stored = dict(((x.name, x.resource_name().lower()),
+                                    x.fingerprint(records[0].identity())) for x in records)
+        self.assertEquals([fingerprints.unchanged(x) for x in records],
+                          [True, True, True])
+        return
@@ -0,0 +1,144 @@
+#! /usr/bin/env python
+
+from __future__ import print_function
+import os
+import sys
+import imp
+import unittest
+import threading
+import mock
+from struct import pack, unpack
+sys.path.insert(0, '..')
+sys.path.insert(0, '.')
+import bacula_tools
+
+SCRIPT = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                      '..', 'bin', 'prune_volumes')
+
+# What the director says in reply to each command: a list of packets, where
+# an int is a signal.  Each .sql row comes in a packet of its own, with a
+# tab after every field and no newline.
+TRANSCRIPT = [
+    ('Hello *UserAgent* calling\n', ['auth cram-md5 <1234.5678@bacula-dir> ssl=0\n']),
+    ('<cram response>', ['1000 OK auth\n']),
+    ('auth cram-md5 ', ['1000 OK auth\n']),
+    ('1000 OK auth\n', ['1000 OK: bacula-dir Version: 5.2.6 (21 February 2012)\n']),
+    ('.sql query="SELECT PoolId, Name FROM Pool',
+     ['1\tDefault\t', '2\tFull-Pool\t', '3\tInc-Pool\t', bacula_tools.BNET_EOD]),
+    ('.sql query="SELECT VolumeName FROM Media WHERE PoolId = 2 ',
+     ['Full-0001\t', 'Full-0002\t', bacula_tools.BNET_EOD]),
+    ('.sql query="SELECT VolumeName FROM Media WHERE PoolId = 3 ',
+     ['Inc-0001\t', bacula_tools.BNET_EOD]),
+    ('prune volume=',
+     [bacula_tools.BNET_MSGS_PENDING,
+      'The current Volume retention period is: 1 year \n',
+      'Volume "%s" has Volume Retention of 31536000 sec. and has 0 jobs that will be pruned\n',
+      bacula_tools.BNET_EOD]),
+]
+
+
+class FakeDirector(object):
+
+    '''Stands in for the socket to a director, replaying TRANSCRIPT.'''
+
+    def __init__(self, *args):
+        self.incoming = ''
+        self.outgoing = ''
+        self.commands = []
+        self.handshake = 0
+        return
+
+    def settimeout(self, timeout):
+        return
+
+    def connect(self, address):
+        return
+
+    def close(self):
+        return
+
+    def sendall(self, data):
+        self.incoming += data
+        while len(self.incoming) >= 4:
+            msglen = unpack('!i', self.incoming[:4])[0]
+            if msglen < 0:
+                self.incoming = self.incoming[4:]
+                continue
+            message = self.incoming[4:msglen + 4]
+            self.incoming = self.incoming[msglen + 4:]
+            self.reply(message)
+        return
+
+    def reply(self, message):
+        self.commands.append(message)
+        if self.handshake < 4:
+            # The handshake goes in order, whatever is said
+            packets = TRANSCRIPT[self.handshake][1]
+            self.handshake += 1
+        else:
+            packets = [x[1] for x in TRANSCRIPT[4:] if message.startswith(x[0])][0]
+        for packet in packets:
+            if type(packet) == int:
+                self.outgoing += pack('!i', packet)
+            else:
+                if '%s' in packet:
+                    packet = packet % message.split('"')[1]
+                self.outgoing += pack('!i', len(packet)) + packet
+        return
+
+    def recv_into(self, view, count):
+        chunk, self.outgoing = self.outgoing[:count], self.outgoing[count:]
+        view[:len(chunk)] = chunk
+        return len(chunk)
+
+
+class pruner_tests(unittest.TestCase):
+
+    def setUp(self):
+        # Don't leave a prune_volumesc lying around in bin
+        dont_write_bytecode, sys.dont_write_bytecode = sys.dont_write_bytecode, True
+        try:
+            self.prune_volumes = imp.load_source('prune_volumes', SCRIPT)
+        finally:
+            sys.dont_write_bytecode = dont_write_bytecode
+        self.directors = []
+        self.lock = threading.Lock()
+        return
+
+    def connection(self, *args):
+        director = FakeDirector()
+        with self.lock:
+            self.directors.append(director)
+        return director
+
+    def test_prune(self):
+        options = mock.Mock(director=None, catalog=None, window=2, jobs=2,
+                            report_every=1)
+        director = {bacula_tools.ADDRESS: 'dir', bacula_tools.PASSWORD: 'secret',
+                    bacula_tools.DIRPORT: 9101}
+        with mock.patch('bacula_tools.Director.Find', return_value=[director]), \
+                mock.patch('socket.socket', side_effect=self.connection), \
+                mock.patch('sys.stdout'):
+            pruner = self.prune_volumes.Pruner(options)
+            pruner.run(['-Pool'])
+        self.assertEquals(pruner.pruned, 3)
+        commands = sorted(x for y in self.directors for x in y.commands
+                          if x.startswith('prune'))
+        self.assertEquals(commands, ['prune volume="Full-0001" yes',
+                                     'prune volume="Full-0002" yes',
+                                     'prune volume="Inc-0001" yes'])
+        # .sql doesn't need API mode, which changes how replies end
+        self.assertFalse([x for y in self.directors for x in y.commands
+                          if x.startswith('.api')])
+        return
+
+    def test_sql(self):
+        session = mock.Mock()
+        session.command_packets.return_value = [
+            '1\tDefault\t', '2\tFull\t', 'Some message\n', '3\tInc\n4\tDiff\n']
+        self.assertEquals(self.prune_volumes.sql(session, 'SELECT', 2),
+                          [['1', 'Default'], ['2', 'Full'], ['3', 'Inc'], ['4', 'Diff']])
+        return
+
+if __name__ == '__main__':
+    unittest.main()
@@ -3,12 +3,16 @@ import os
 import sys
 import pprint
 import unittest
+import shutil
+import tempfile
 import pkg_resources
 sys.path.insert(0, '..')
 sys.path.insert(0, '.')
 import bacula_tools
 import mock
 import socket
+import time
+from struct import pack
 
 
 class generate_password_tests(unittest.TestCase):
@@ -94,6 +98,405 @@ class plist_tests(unittest.TestCase):
         return
 
 
+class identity_map_tests(unittest.TestCase):
+
+    def setUp(self):
+        self.im = bacula_tools.IdentityMap(capacity=2)
+        return
+
+    def test_get_by_id_and_name(self):
+        self.im.put('pools', {'id': 1, 'name': 'Default'})
+        self.assertEquals(
+            self.im.get('pools', 'id', 1), ({'id': 1, 'name': 'Default'}, {}))
+        self.assertEquals(
+            self.im.get('pools', 'name', 'Default')[0]['id'], 1)
+        self.assertEquals(self.im.get('pools', 'name', 'Other'), None)
+        self.assertEquals((self.im.hits, self.im.misses), (2, 1))
+        return
+
+    def test_extras_are_copies(self):
+        self.im.put('jobs', {'id': 1, 'name': 'job'}, {'scripts': [1, 2]})
+        row, extras = self.im.get('jobs', 'id', 1)
+        extras['scripts'].append(3)
+        self.assertEquals(self.im.get('jobs', 'id', 1)[1], {'scripts': [1, 2]})
+        return
+
+    def test_lru_eviction(self):
+        self.im.put('pools', {'id': 1, 'name': 'one'})
+        self.im.put('pools', {'id': 2, 'name': 'two'})
+        self.im.get('pools', 'id', 1)
+        self.im.put('pools', {'id': 3, 'name': 'three'})
+        self.assertEquals(self.im.get('pools', 'name', 'two'), None)
+        self.assertTrue(self.im.get('pools', 'id', 1))
+        self.assertTrue(self.im.get('pools', 'id', 3))
+        return
+
+    def test_invalidate(self):
+        self.im.put('pools', {'id': 1, 'name': 'one'})
+        self.im.put('jobs', {'id': 1, 'name': 'one'})
+        self.im.invalidate('pools', 1)
+        self.assertEquals(self.im.get('pools', 'name', 'one'), None)
+        self.assertTrue(self.im.get('jobs', 'name', 'one'))
+        self.im.invalidate('jobs')
+        self.assertEquals(self.im.get('jobs', 'id', 1), None)
+        return
+
+    def test_resource_cache_scope(self):
+        bc = bacula_tools.Bacula_Factory()
+        self.assertEquals(bc.identity_map, None)
+        with bc.resource_cache() as outer:
+            with bc.resource_cache() as inner:
+                self.assertTrue(outer is inner)
+        self.assertEquals(bc.identity_map, None)
+        return
+
+
+@mock.patch('bacula_tools.bacula_config.db.connect')
+class connection_pool_tests(unittest.TestCase):
+
+    def test_reuse(self, connect):
+        pool = bacula_tools.ConnectionPool(2)
+        first = pool.get()
+        pool.put(first)
+        self.assertTrue(pool.get() is first)
+        self.assertEquals(connect.call_count, 1)
+        first.autocommit.assert_called_with(True)
+        return
+
+    def test_bounded(self, connect):
+        pool = bacula_tools.ConnectionPool(1, timeout=0.01)
+        pool.get()
+        self.assertRaises(bacula_tools.bacula_config.db.OperationalError, pool.get)
+        return
+
+    def test_dead_connection_replaced(self, connect):
+        connect.side_effect = lambda **kwargs: mock.MagicMock()
+        pool = bacula_tools.ConnectionPool(1)
+        dead = pool.get()
+        dead.ping.side_effect = bacula_tools.bacula_config.db.OperationalError(
+            2006, 'MySQL server has gone away')
+        pool.put(dead)
+        self.assertFalse(pool.get() is dead)
+        self.assertEquals(connect.call_count, 2)
+        dead.close.assert_called_with()
+        return
+
+    def test_do_sql_reconnects(self, connect):
+        bc = bacula_tools.Bacula_Config()
+        bc.connect('pooltest', 'user', 'pass', 'host')
+        cursor = connect.return_value.cursor.return_value
+        cursor.execute.side_effect = [bacula_tools.bacula_config.db.OperationalError(
+            2006, 'MySQL server has gone away'), None]
+        cursor.fetchall.return_value = [(1,)]
+        self.assertEquals(bc.do_sql('SELECT 1'), [(1,)])
+        self.assertEquals(cursor.execute.call_count, 2)
+        bc.release()
+        return
+
+    def test_stream_sql(self, connect):
+        bc = bacula_tools.Bacula_Config()
+        bc.connect('streamtest', 'user', 'pass', 'host')
+        cursor = connect.return_value.cursor.return_value
+        cursor.fetchmany.side_effect = [[(1,), (2,)], [(3,)], []]
+        self.assertEquals(list(bc.stream_sql('SELECT 1', batch_size=2)),
+                          [(1,), (2,), (3,)])
+        connect.return_value.cursor.assert_called_with(
+            cursorclass=bacula_tools.bacula_config.db.cursors.SSCursor)
+        cursor.fetchmany.assert_called_with(2)
+        cursor.close.assert_called_with()
+        self.assertEquals(bc.pool.idle.qsize(), 1)
+        return
+
+
+@mock.patch('bacula_tools.bacula_config.db.connect')
+class transaction_tests(unittest.TestCase):
+
+    def setUp(self):
+        self.bc = bacula_tools.Bacula_Config()
+        return
+
+    def executed(self, connect):
+        cursor = connect.return_value.cursor.return_value
+        return [x[0][0] for x in cursor.execute.call_args_list]
+
+    def test_commit(self, connect):
+        self.bc.connect(self._testMethodName, 'user', 'pass', 'host')
+        connection = connect.return_value
+        with self.bc.transaction():
+            self.assertTrue(self.bc.in_transaction())
+            connection.autocommit.assert_called_with(False)
+        self.assertFalse(self.bc.in_transaction())
+        connection.commit.assert_called_with()
+        connection.autocommit.assert_called_with(True)
+        self.assertFalse(connection.rollback.called)
+        self.bc.release()
+        return
+
+    def test_rollback(self, connect):
+        self.bc.connect(self._testMethodName, 'user', 'pass', 'host')
+        connection = connect.return_value
+        with self.bc.resource_cache() as identity_map:
+            identity_map.put('clients', {'id': 1, 'name': 'a'})
+            def fail():
+                with self.bc.transaction():
+                    raise ValueError
+            self.assertRaises(ValueError, fail)
+            self.assertEquals(identity_map.get('clients', 'id', 1), None)
+        connection.rollback.assert_called_with()
+        self.assertFalse(connection.commit.called)
+        self.assertFalse(self.bc.in_transaction())
+        self.bc.release()
+        return
+
+    def test_savepoints(self, connect):
+        self.bc.connect(self._testMethodName, 'user', 'pass', 'host')
+        with self.bc.transaction():
+            with self.bc.transaction():
+                pass
+            try:
+                with self.bc.transaction():
+                    raise ValueError
+            except ValueError:
+                pass
+        self.assertEquals(self.executed(connect),
+                          ['SAVEPOINT bacula_1', 'RELEASE SAVEPOINT bacula_1',
+                           'SAVEPOINT bacula_1', 'ROLLBACK TO SAVEPOINT bacula_1'])
+        connect.return_value.commit.assert_called_once_with()
+        self.bc.release()
+        return
+
+    def test_checkpoint(self, connect):
+        self.bc.connect(self._testMethodName, 'user', 'pass', 'host')
+        connection = connect.return_value
+        self.bc.checkpoint()
+        self.assertFalse(connection.commit.called)
+        with self.bc.transaction():
+            self.bc.checkpoint()
+            self.assertEquals(connection.commit.call_count, 1)
+            with self.bc.transaction():
+                self.assertRaises(bacula_tools.bacula_config.db.ProgrammingError,
+                                  self.bc.checkpoint)
+        self.assertEquals(connection.commit.call_count, 2)
+        self.bc.release()
+        return
+
+    def test_versions(self, connect):
+        self.bc.connect(self._testMethodName, 'user', 'pass', 'host')
+        bump = ('INSERT INTO config_versions (tablename, version) VALUES %s'
+                ' ON DUPLICATE KEY UPDATE version = version + 1')
+        self.bc.do_sql('SELECT * FROM clients')
+        self.bc.do_sql('UPDATE clients SET name = %s WHERE id = %s', ('a', 1))
+        with self.bc.transaction():
+            self.bc.do_sql('INSERT INTO pools (name) VALUES (%s)', 'p')
+            self.bc.do_sql('DELETE FROM `jobs` WHERE id = %s', 1)
+            self.bc.do_sql('UPDATE pools SET name = %s WHERE id = %s', ('q', 1))
+        self.bc.release()
+        self.assertEquals(self.executed(connect)[1:],
+                          ['UPDATE clients SET name = %s WHERE id = %s',
+                           'INSERT INTO pools (name) VALUES (%s)', 'DELETE FROM `jobs` WHERE id = %s',
+                           'UPDATE pools SET name = %s WHERE id = %s', bump % '(%s, 1),(%s, 1)',
+                           bump % '(%s, 1)'])
+        cursor = connect.return_value.cursor.return_value
+        self.assertEquals(cursor.execute.call_args_list[-2][0][1], ['jobs', 'pools'])
+        self.assertEquals(cursor.execute.call_args_list[-1][0][1], ['clients'])
+        return
+
+    def test_versions_batched(self, connect):
+        self.bc.connect(self._testMethodName, 'user', 'pass', 'host')
+        connection = connect.return_value
+        for i in range(3):
+            self.bc.do_sql('UPDATE clients SET name = %s WHERE id = %s', ('a', i))
+            self.bc.do_sql('UPDATE pools SET name = %s WHERE id = %s', ('a', i))
+        # No transactions, and nothing extra until the flush
+        self.assertEquals(len(self.executed(connect)), 6)
+        self.assertFalse(connection.commit.called)
+        self.assertFalse(mock.call(False) in connection.autocommit.call_args_list)
+        self.bc.config_stamp(['clients'])
+        cursor = connection.cursor.return_value
+        self.assertEquals(cursor.execute.call_args_list[6][0][1], ['clients', 'pools'])
+        self.bc.release()
+        self.assertEquals(len(self.executed(connect)), 8)
+        return
+
+    def test_missing_versions_table(self, connect):
+        self.bc.connect(self._testMethodName, 'user', 'pass', 'host')
+        cursor = connect.return_value.cursor.return_value
+        missing = bacula_tools.bacula_config.db.ProgrammingError(
+            1146, "Table 'baculacfg.config_versions' doesn't exist")
+
+        def execute(sql, args=None):
+            if 'config_versions' in sql:
+                raise missing
+        cursor.execute.side_effect = execute
+        try:
+            self.bc.do_sql('UPDATE clients SET name = %s WHERE id = %s', ('a', 1))
+            self.assertEquals(self.bc.config_stamp(['clients']), None)
+            self.assertFalse(self.bc.stamping)
+            # Other databases carry on as before
+            other = bacula_tools.Bacula_Config()
+            other.connect(self._testMethodName + '2', 'user', 'pass', 'host')
+            self.assertTrue(other.stamping)
+            # Nothing more is tried once we know the table isn't there
+            self.bc.do_sql('UPDATE clients SET name = %s WHERE id = %s', ('b', 1))
+            self.assertEquals(len(self.executed(connect)), 3)
+        finally:
+            self.bc.release()
+        return
+
+    def test_unversioned(self, connect):
+        self.bc.connect(self._testMethodName, 'user', 'pass', 'host', versioned=False)
+        self.bc.do_sql('UPDATE media SET volstatus = %s WHERE id = %s', ('Purged', 1))
+        self.bc.release()
+        self.assertEquals(self.executed(connect),
+                          ['UPDATE media SET volstatus = %s WHERE id = %s'])
+        self.assertEquals(self.bc.config_stamp(['media']), None)
+        return
+
+    def test_no_reconnect_in_transaction(self, connect):
+        self.bc.connect(self._testMethodName, 'user', 'pass', 'host')
+        cursor = connect.return_value.cursor.return_value
+        cursor.execute.side_effect = bacula_tools.bacula_config.db.OperationalError(
+            2006, 'MySQL server has gone away')
+        def run():
+            with self.bc.transaction():
+                self.bc.do_sql('SELECT 1')
+        self.assertRaises(bacula_tools.bacula_config.db.OperationalError, run)
+        self.assertEquals(cursor.execute.call_count, 1)
+        self.assertFalse(self.bc.in_transaction())
+        return
+
+
+class sql_cache_tests(unittest.TestCase):
+
+    def test_hits_and_misses(self):
+        cache = bacula_tools.SQLCache()
+        builder = mock.MagicMock(return_value='SELECT 1')
+        self.assertEquals(cache.sql(('t', 'op'), builder), 'SELECT 1')
+        self.assertEquals(cache.sql(('t', 'op'), builder), 'SELECT 1')
+        self.assertEquals(builder.call_count, 1)
+        self.assertEquals((cache.hits, cache.misses), (1, 1))
+        self.assertEquals(cache.hit_rate(), 50.0)
+        self.assertTrue('1 statements' in str(cache))
+        return
+
+    def test_save_uses_cache(self):
+        bc = bacula_tools.Bacula_Factory()
+        pool = bacula_tools.Pool({bacula_tools.ID: 1, bacula_tools.NAME: 'x'})
+        with mock.patch.object(bc, 'do_sql') as m, mock.patch.object(bc, 'sql_cache', bacula_tools.SQLCache()):
+            pool[bacula_tools.NAME] = 'y'
+            pool._save()
+            pool[bacula_tools.NAME] = 'x'
+            pool._save()
+            self.assertEquals((bc.sql_cache.hits, bc.sql_cache.misses), (1, 1))
+            self.assertTrue(m.call_args_list[0][0][0].startswith('UPDATE pools SET'))
+            self.assertEquals(m.call_args_list[0][0][0], m.call_args_list[1][0][0])
+        return
+
+    def test_value_ensure(self):
+        bc = bacula_tools.Bacula_Factory()
+        with mock.patch.object(bc, 'do_sql', return_value=[]) as m, \
+                mock.patch.object(bc, 'sql_cache', bacula_tools.SQLCache()):
+            bc.value_ensure('pools', 'name', 'x')
+        self.assertEquals([x[0] for x in m.call_args_list],
+                          [('SELECT * FROM `pools` where `name` = %s', 'x', False),
+                           ('INSERT INTO pools (name) VALUES (%s)', 'x'),
+                           ('SELECT * FROM `pools` where `name` = %s', 'x', False)])
+        return
+
+
+class dirty_tracking_tests(unittest.TestCase):
+
+    def setUp(self):
+        self.bc = bacula_tools.Bacula_Factory()
+        self.pool = bacula_tools.Pool(
+            {bacula_tools.ID: 1, bacula_tools.NAME: 'x'})
+        return
+
+    def test_clean_after_init(self):
+        with mock.patch.object(self.bc, 'do_sql') as m:
+            self.assertEquals(self.pool._save(), ())
+            self.assertEquals(m.call_count, 0)
+        return
+
+    def test_only_dirty_keys_written(self):
+        with mock.patch.object(self.bc, 'do_sql') as m:
+            self.pool.set(bacula_tools.NAME, 'y')
+            self.assertEquals(m.call_args[0],
+                              ('UPDATE pools SET `name` = %s WHERE id = %s', ('y', 1)))
+            self.pool.set(bacula_tools.NAME, 'y')
+            self.assertEquals(m.call_count, 2)
+            self.pool._save()
+            self.assertEquals(m.call_count, 2)
+        return
+
+    def test_batch(self):
+        with mock.patch.object(self.bc, 'do_sql') as m:
+            with self.pool.batch():
+                self.pool.set(bacula_tools.NAME, 'y')
+                with self.pool.batch():
+                    self.pool.set(bacula_tools.LABELFORMAT, 'z')
+                self.assertEquals(m.call_count, 0)
+            self.assertEquals(m.call_count, 1)
+            self.assertEquals(m.call_args[0][1], ('z', 'y', 1))
+        return
+
+    def test_apply_row_keeps_pending(self):
+        self.pool[bacula_tools.NAME] = 'pending'
+        self.pool._apply_row({bacula_tools.ID: 1, bacula_tools.NAME: 'x',
+                              bacula_tools.LABELFORMAT: 'loaded'})
+        self.assertEquals(self.pool[bacula_tools.NAME], 'pending')
+        self.assertEquals(self.pool[bacula_tools.LABELFORMAT], 'loaded')
+        return
+
+
+class password_matrix_tests(unittest.TestCase):
+
+    def setUp(self):
+        self.bc = bacula_tools.Bacula_Factory()
+        self.director = bacula_tools.Director({bacula_tools.ID: 5})
+        self.clients = [bacula_tools.Client({bacula_tools.ID: 1}),
+                        bacula_tools.Client({bacula_tools.ID: 3})]
+        return
+
+    def test_matrix(self):
+        with mock.patch.object(self.bc, 'do_sql', return_value=[(1, 2, 5, 1, 'secret'), (1, 2, 6, 4, 'other')]) as m:
+            matrix = bacula_tools.PasswordStore.Matrix(
+                self.clients, [self.director])
+            self.assertEquals(m.call_count, 1)
+            self.assertEquals(m.call_args[0][1], (1, 2, 3, 2, 5, 1))
+        self.assertEquals(
+            matrix.password(self.clients[0], self.director), 'secret')
+        self.assertEquals(
+            matrix.password(self.clients[1], self.director), None)
+        self.assertEquals(matrix.directors(self.clients[0]),
+                          [(5, 1, 'secret'), (6, 4, 'other')])
+        self.assertEquals(matrix.objects(self.director), [(1, 2, 'secret')])
+        self.assertEquals(bacula_tools.PasswordStore(
+            self.clients[0], self.director, matrix).password, 'secret')
+        return
+
+    def test_find(self):
+        with mock.patch.object(self.bc, 'do_sql', return_value=[(1, 2, 5, 1, 'secret')]) as m:
+            pw = bacula_tools.PasswordStore.Find(self.clients[0])
+            self.assertEquals(m.call_count, 1)
+        self.assertEquals([(x.where_arguments, x.password) for x in pw],
+                          [((1, 2, 5, 1), 'secret')])
+        return
+
+    def test_store_many(self):
+        with mock.patch.object(self.bc, 'do_sql') as m:
+            bacula_tools.PasswordStore.store_many(
+                [(self.clients[0], self.director, 'one'),
+                 (self.clients[1], self.director, 'two'),
+                 (self.clients[1], self.director, None)])
+            self.assertEquals(m.call_count, 2)
+            self.assertTrue('ON DUPLICATE KEY UPDATE' in m.call_args_list[0][0][0])
+            self.assertEquals(m.call_args_list[0][0][1],
+                              (1, 2, 5, 1, 'one', 3, 2, 5, 1, 'two'))
+            self.assertEquals(m.call_args_list[1][0][1], (3, 2, 5, 1))
+        return
+
+
 class database_storage_tests(unittest.TestCase):
 
     def setUp(self):
@@ -317,6 +720,272 @@ class guess_schedule_and_fileset_tests(unittest.TestCase):
         return
 
 
+class fragment_cache_tests(unittest.TestCase):
+
+    def setUp(self):
+        self.filename = '/tmp/test_fragments'
+        self.render = mock.MagicMock(return_value='Job {}')
+        return
+
+    def tearDown(self):
+        os.unlink(self.filename)
+        return
+
+    def test_get_and_save(self):
+        cache = bacula_tools.FragmentCache(self.filename)
+        self.assertEquals(cache.get(('jobs', 1), 'a', self.render), 'Job {}')
+        self.assertEquals(cache.get(('jobs', 2), 'a', self.render), 'Job {}')
+        cache.save()
+        cache = bacula_tools.FragmentCache(self.filename)
+        self.assertEquals(cache.get(('jobs', 1), 'a', self.render), 'Job {}')
+        self.assertEquals(cache.get(('jobs', 2), 'b', self.render), 'Job {}')
+        self.assertEquals((cache.hits, cache.misses, self.render.call_count), (1, 1, 3))
+        return
+
+    def test_unused_and_fresh(self):
+        cache = bacula_tools.FragmentCache(self.filename)
+        cache.get(('jobs', 1), 'a', self.render)
+        cache.get(('jobs', 2), 'a', self.render)
+        cache.save()
+        cache = bacula_tools.FragmentCache(self.filename)
+        cache.get(('jobs', 1), 'a', self.render)
+        cache.save()
+        self.assertEquals(sorted(bacula_tools.FragmentCache(self.filename).fragments),
+                          [('jobs', 1)])
+        self.assertEquals(bacula_tools.FragmentCache(self.filename, fresh=True).fragments, {})
+        return
+
+
+class director_renderer_tests(unittest.TestCase):
+
+    # What generate_configuration wrote for the resources in setUp, back when
+    # it instantiated and searched for them one at a time: each one followed
+    # by a blank line, in this order.
+    EXPECTED = """Director {
+  Name = "dir"
+  DirAddress = dir.example.com
+  Password = "secret"
+  Dirport = 9101
+  Messages = "None"
+}
+
+
+Catalog {
+  Name = "MyCatalog"
+  Dbname = "bacula"
+}
+
+
+Messages {
+  Name = "Daemon"
+  console = all
+}
+
+
+Messages {
+  Name = "Standard"
+  mail = root = all
+}
+
+
+Fileset {
+  Name = "Full Set"
+}
+
+
+Client {
+  Name = "c1"
+ Catalog = "None"
+  Password = "c1pass"
+  Address = c1.example.com
+  Fdport = 9102
+  Maximumconcurrentjobs = 1
+}
+
+
+JobDefs {
+  Name = "DefaultJob"
+  Replace = "always"
+}
+
+
+Job {
+  Name = "Backup c1"
+  Replace = "always"
+}
+
+
+Pool {
+  Name = "Default"
+  Pooltype = Backup
+}
+
+
+Counter {
+  Name = "Tapes"
+}
+
+
+"""
+
+    def setUp(self):
+        self.director = bacula_tools.Director({
+            'id': 1, 'name': 'dir', 'address': 'dir.example.com', 'password': 'secret'})
+        client = bacula_tools.Client({'id': 2, 'name': 'c1', 'address': 'c1.example.com'})
+        # What each Find() returns, in the order the database would return it
+        self.found = {
+            bacula_tools.Catalog: [bacula_tools.Catalog({'id': 1, 'name': 'MyCatalog', 'dbname': 'bacula'})],
+            bacula_tools.Messages: [bacula_tools.Messages({'id': 2, 'name': 'Daemon', 'data': 'console = all'}),
+                                    bacula_tools.Messages({'id': 1, 'name': 'Standard', 'data': 'mail = root = all'})],
+            bacula_tools.Fileset: [bacula_tools.Fileset({'id': 1, 'name': 'Full Set'})],
+            bacula_tools.Schedule: [],
+            bacula_tools.Client: [client],
+            bacula_tools.JobDef: [bacula_tools.JobDef({'id': 1, 'name': 'DefaultJob', 'jobdef': 1})],
+            bacula_tools.Job: [bacula_tools.Job({'id': 2, 'name': 'Backup c1'})],
+            bacula_tools.Storage: [],
+            bacula_tools.Pool: [bacula_tools.Pool({'id': 1, 'name': 'Default'})],
+            bacula_tools.Console: [],
+            bacula_tools.Counter: [bacula_tools.Counter({'id': 1, 'name': 'Tapes'})],
+        }
+        self.passwords = bacula_tools.PasswordMatrix({
+            (2, client.IDTAG, 1, self.director.IDTAG): 'c1pass'})
+        self.patches = [mock.patch.object(bacula_tools.Director, 'search', return_value=self.director),
+                        mock.patch.object(bacula_tools.PasswordStore, 'Matrix', return_value=self.passwords)]
+        for kls, found in self.found.items():
+            self.patches.append(mock.patch.object(kls, 'Find', return_value=found))
+        for patch in self.patches:
+            patch.start()
+        for obj in self.found[bacula_tools.Fileset] + self.found[bacula_tools.Schedule]:
+            obj.entries = []
+        for obj in self.found[bacula_tools.JobDef] + self.found[bacula_tools.Job]:
+            obj.scripts = []
+        self.tmpdir = tempfile.mkdtemp()
+        return
+
+    def tearDown(self):
+        for patch in self.patches:
+            patch.stop()
+        shutil.rmtree(self.tmpdir)
+        return
+
+    def test_render(self):
+        self.assertEquals(bacula_tools.DirectorRenderer('dir').render(), self.EXPECTED)
+        return
+
+    def test_write(self):
+        filename = os.path.join(self.tmpdir, 'bacula-dir.conf')
+        config_file = bacula_tools.ConfigFile(filename)
+        bacula_tools.DirectorRenderer('dir').write(config_file)
+        config_file.close()
+        self.assertEquals(open(filename).read(), config_file.FILEHEADER + self.EXPECTED)
+        return
+
+    def test_queries(self):
+        renderer = bacula_tools.DirectorRenderer('dir').load()
+        self.assertEquals(renderer.sections[0], [self.director])
+        # Messages are now written in order of name, rather than link order
+        kwargs = bacula_tools.Messages.Find.call_args[1]
+        self.assertEquals(kwargs['order_by'], bacula_tools.NAME)
+        self.assertTrue('ref_id = 1 AND link_type = %d' % self.director.IDTAG in kwargs['explicit_where'])
+        bacula_tools.Catalog.Find.assert_called_once_with(director_id=1)
+        self.assertEquals(bacula_tools.JobDef.Find.call_args[1]['jobdef'], 1)
+        # Clients are written out with the password they share with this director
+        self.assertEquals(self.found[bacula_tools.Client][0].director_id, 1)
+        bacula_tools.PasswordStore.Matrix.assert_called_once_with(directors=[self.director])
+        return
+
+
+class daemon_renderer_tests(unittest.TestCase):
+
+    def test_render(self):
+        client = bacula_tools.Client({'id': 3, 'name': 'c1'})
+        director = bacula_tools.Director({'id': 1, 'name': 'd1'})
+        console = bacula_tools.Console({'id': 2, 'name': 'mon'})
+        renderer = bacula_tools.DaemonRenderer(bacula_tools.FD)
+        renderer.daemons = [client]
+        renderer.passwords = bacula_tools.PasswordMatrix({
+            (3, client.IDTAG, 2, console.IDTAG): 'p2',
+            (3, client.IDTAG, 1, director.IDTAG): 'p1'})
+        renderer.holders = {(3, client.IDTAG): [(1, director.IDTAG), (2, console.IDTAG)]}
+        renderer.directors = {(1, director.IDTAG): director, (2, console.IDTAG): console}
+        renderer.devices = {}
+        renderer.loaded = True
+        renderer.messages = {3: [bacula_tools.Messages({'id': 4, 'name': 'm', 'data': 'x'})]}
+        for obj in [director, console]:
+            obj.passwords = renderer.passwords
+        with mock.patch.object(bacula_tools.Client, 'search', return_value=client):
+            (daemon, fragments), = list(renderer)
+        self.assertEquals(daemon, client)
+        self.assertEquals([x.split('\n')[1] for x in fragments],
+                          ['  Name = "c1"', '  Name = "d1"', '  Name = "mon"', '  Name = "m"'])
+        self.assertTrue('Password = "p1"' in fragments[1])
+        self.assertTrue('Password = "p2"' in fragments[2])
+        return
+
+    def test_single_daemon(self):
+        storage = bacula_tools.Storage({'id': 3, 'name': 's1'})
+        renderer = bacula_tools.DaemonRenderer(bacula_tools.SD, [storage])
+        with mock.patch.object(bacula_tools.PasswordStore, 'Matrix',
+                               return_value=bacula_tools.PasswordMatrix()), \
+                mock.patch.object(bacula_tools.Director, 'Find', return_value=[]), \
+                mock.patch.object(bacula_tools.Console, 'Find', return_value=[]), \
+                mock.patch.object(renderer.bc, 'do_sql', return_value=[]) as do_sql:
+            renderer.load()
+        # Only the links for the daemon we asked for are fetched
+        queries = [x[0][0] for x in do_sql.call_args_list]
+        self.assertTrue('AND ref_id IN (3) ORDER BY id' in queries[0])
+        self.assertTrue('WHERE storage_id IN (3) ORDER BY id' in queries[1])
+        self.assertEquals(renderer.daemons, [storage])
+        return
+
+
+class config_service_tests(unittest.TestCase):
+
+    def setUp(self):
+        import bacula_tools.webconfig
+        self.service = bacula_tools.webconfig.ConfigService(interval=0)
+        self.service.bc = mock.MagicMock()
+        self.service.bc.config_stamp.return_value = 1
+        client = bacula_tools.Client({'id': 3, 'name': 'Host'})
+        self.renderer = mock.patch('bacula_tools.DaemonRenderer',
+                                   return_value=[(client, ['Client {}', 'Director {}'])])
+        self.renderer.start()
+        return
+
+    def tearDown(self):
+        self.renderer.stop()
+        return
+
+    def get(self, query, status='200 OK', **environ):
+        start_response = mock.MagicMock()
+        environ['QUERY_STRING'] = query
+        body = ''.join(self.service(environ, start_response))
+        self.assertEquals(start_response.call_args[0][0], status)
+        self.headers = dict(start_response.call_args[0][1])
+        return body
+
+    def test_cached(self):
+        body = self.get('hostname=host')
+        self.assertTrue(body.endswith('\nClient {}\nDirector {}\n'))
+        self.assertEquals(self.get('hostname=host&hash=1'),
+                          '\n%s\n' % __import__('hashlib').md5(body).hexdigest())
+        # Rendered once, in bulk, for both requests
+        self.assertEquals(bacula_tools.DaemonRenderer.call_count, 1)
+        self.service.bc.config_stamp.return_value = 2
+        self.get('hostname=host')
+        self.assertEquals(bacula_tools.DaemonRenderer.call_count, 2)
+        self.assertEquals(self.service.bc.release.call_count, 3)
+        return
+
+    def test_etag(self):
+        digest = self.get('hostname=host&hash=1').strip()
+        self.assertEquals(self.headers['ETag'], '"%s"' % digest)
+        self.assertEquals(self.get('hostname=host', '304 Not Modified',
+                                   HTTP_IF_NONE_MATCH='"x", W/"%s"' % digest), '')
+        self.assertTrue(self.get('hostname=host', HTTP_IF_NONE_MATCH='"x"'))
+        return
+
+
 class configfile_tests(unittest.TestCase):
 
     def setUp(self):
@@ -358,6 +1027,15 @@ class configfile_tests(unittest.TestCase):
         self.assertNotEqual(data, newdata)
         return
 
+    def test_stamp(self):
+        self.assertFalse(bacula_tools.ConfigFile.current(self.testfile, 'd1 5'))
+        c = bacula_tools.ConfigFile(self.testfile, 'd1 5')
+        c.close(self.contents)
+        self.assertTrue(bacula_tools.ConfigFile.current(self.testfile, 'd1 5'))
+        self.assertFalse(bacula_tools.ConfigFile.current(self.testfile, 'd1 6'))
+        os.unlink(self.testfile + '.stamp')
+        return
+
 
 @mock.patch('socket.socket', autospec=True)
 @mock.patch('sys.stderr', autospec=True)
@@ -407,3 +1085,145 @@ class bsock_tests(unittest.TestCase):
             sock.assert_has_calls([mock.call.send('version')])
         sock.reset_mock()
         return
+
+    def test_recv_all(self, stderr, sock):
+        data = (pack('!i', 7) + 'Version' + pack('!i', bacula_tools.BNET_HEARTBEAT) +
+                pack('!i', 0) + pack('!i', 5) + ': 5.2' + pack('!i', bacula_tools.BNET_EOD))
+        stream = [data]
+
+        def recv_into(view, count):
+            # Never more than 3 bytes at a time, to exercise short reads
+            chunk, stream[0] = stream[0][:min(count, 3)], stream[0][min(count, 3):]
+            view[:len(chunk)] = chunk
+            return len(chunk)
+        b = bacula_tools.BSock('foo', 'bar', 'me', 777)
+        b.connection.recv_into.side_effect = recv_into
+        self.assertEquals(b.recv_all(), 'Version: 5.2')
+        self.assertEquals(b.last_signal, bacula_tools.BNET_EOD)
+        b.connection.sendall.assert_called_once_with(
+            pack('!i', bacula_tools.BNET_HB_RESPONSE))
+        return
+
+    def test_deadline(self, stderr, sock):
+        b = bacula_tools.BSock('foo', 'bar', 'me', 777, timeout=5,
+                               deadline=time.time() + 2)
+        timeout = b.connection.settimeout.call_args[0][0]
+        self.assertTrue(0 < timeout <= 2)
+        b.deadline = time.time() - 1
+        self.assertRaises(socket.timeout, b.send, 'status')
+        return
+
+    def test_deadline_short_reads(self, stderr, sock):
+        b = bacula_tools.BSock('foo', 'bar', 'me', 777)
+
+        def recv_into(view, count):
+            # One byte at a time, and the deadline passes part way through
+            b.deadline = time.time() - 1
+            view[:1] = '\0'
+            return 1
+        b.connection.recv_into.side_effect = recv_into
+        self.assertRaises(socket.timeout, b.recv)
+        self.assertEquals(b.connection.recv_into.call_count, 1)
+        return
+
+
+class director_session_tests(unittest.TestCase):
+
+    def setUp(self):
+        self.events = []
+        self.packets = ['one', None, 'two', None, 'th', 'ree', None]
+        test = self
+
+        def recv(self):
+            packet = test.packets.pop(0)
+            test.events.append(('recv', packet))
+            self.last_signal = None if packet else bacula_tools.BNET_EOD
+            return packet or ''
+        self.patches = [
+            mock.patch('bacula_tools.BSock.__init__', new=lambda *x, **y: None),
+            mock.patch('bacula_tools.BSock.auth', autospec=True),
+            mock.patch('bacula_tools.BSock.send', autospec=True,
+                       side_effect=lambda self, x: test.events.append(('send', x))),
+            mock.patch('bacula_tools.BSock.recv', new=recv),
+            mock.patch('bacula_tools.BSock.close', autospec=True,
+                       side_effect=lambda self: test.events.append(('close',)))]
+        for patch in self.patches:
+            patch.start()
+        self.session = bacula_tools.DirectorSession(
+            {bacula_tools.ADDRESS: 'foo', bacula_tools.PASSWORD: 'bar',
+             bacula_tools.DIRPORT: 9101}, window=2)
+        return
+
+    def tearDown(self):
+        for patch in self.patches:
+            patch.stop()
+        return
+
+    def test_pipeline(self):
+        self.assertEquals(bacula_tools.BSock.auth.call_count, 1)
+        results = list(self.session.pipeline(['a', 'b', 'c']))
+        self.assertEquals(results, [('a', 'one'), ('b', 'two'), ('c', 'three')])
+        # The second command goes out before the first response is read
+        self.assertEquals(self.events[:3], [('send', 'a'), ('send', 'b'), ('recv', 'one')])
+        self.assertEquals(self.events.index(('send', 'c')), 4)
+        return
+
+    def test_stopped_early(self):
+        for command, response in self.session.pipeline(['a', 'b']):
+            break
+        # The response to b is read, and the session left open for more
+        self.assertEquals(self.packets, ['th', 'ree', None])
+        self.assertFalse(('close',) in self.events)
+        self.assertEquals(self.session.command('c'), 'three')
+        return
+
+    def test_failure(self):
+        self.packets = ['one', None]
+        pipeline = self.session.pipeline(['a', 'b'])
+        self.assertEquals(next(pipeline), ('a', 'one'))
+        self.assertRaises(IndexError, next, pipeline)
+        # The stream can't be trusted after that
+        self.assertTrue(('close',) in self.events)
+        return
+
+
+@mock.patch('asyncore.dispatcher.close')
+@mock.patch('asyncore.dispatcher.connect')
+@mock.patch('asyncore.dispatcher.create_socket')
+class async_bsock_tests(unittest.TestCase):
+
+    def frame(self, message):
+        return pack('!i', len(message)) + message
+
+    def test_version(self, create, connect, close):
+        results = []
+        b = bacula_tools.AsyncBSock('foo', 'bar', 'me', 777)
+        connect.assert_called_once_with(('foo', 777))
+        b.version(callback=results.append)
+        b.connected = True
+        b.handle_connect()
+        self.assertEquals(b.outgoing, self.frame('version'))
+        data = self.frame('Version: 5.2.6') + self.frame(' (21 February 2012)\n')
+        # Split mid-packet, as the network is wont to do
+        b._received(data[:7])
+        b._received(data[7:] + pack('!i', -1))
+        self.assertEquals(results, ['Version: 5.2.6 (21 February 2012)\n'])
+        close.assert_called_once_with()
+        return
+
+    def test_auth_failure(self, create, connect, close):
+        errors = []
+        b = bacula_tools.AsyncBSock('foo', 'bar', 'me', 777)
+        b.auth(errback=errors.append)
+        b.version(errback=errors.append)
+        b.connected = True
+        b.handle_connect()
+        self.assertEquals(b.outgoing, self.frame('Hello me calling\n'))
+        b._received(self.frame('auth cram-md5 <1.145269@foolishness>'))
+        try:
+            b._received(self.frame('1999 no\n'))
+        except ValueError:
+            b.handle_error()
+        self.assertEquals(len(errors), 2)
+        self.assertTrue(isinstance(errors[0], ValueError))
+        return